@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Compares a new obspy Client per request (with the service discovery of a
+fresh process) with the shared client of codebase.clients (pooled
+connections, services cached on disk) for the per-station waveform
+requests of the section plot: wall time and the number of HTTP requests
+and connections. With --failure-rate, the stand-in answers that fraction
+of the queries with HTTP 503 and the number of failed station requests is
+reported as well.
+
+    python benchmarks/bench_clients.py --latency 0.05 --failure-rate 0.2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from obspy import UTCDateTime
+from obspy.clients.fdsn import Client
+from codebase import config
+from codebase.clients import client_manager
+from benchmarks.fdsn_standin import FDSNStandIn, default_stations
+
+
+def fetch_all(get_client, sta_codes, starttime, endtime):
+    """ Request the waveforms of every station; returns the number of failures """
+    failures = 0
+    for code in sta_codes:
+        try:
+            get_client().get_waveforms("S", code, "*", "EH*", starttime, endtime)
+        except Exception:
+            failures += 1
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="artificial latency per HTTP request in seconds")
+    parser.add_argument("--connection-latency", type=float, default=0.1,
+                        help="artificial latency per new connection in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    sta_codes = default_stations()["S"]
+    starttime = UTCDateTime(2024, 1, 1, 12)
+    endtime = starttime + 600
+    config.request_backoff = 0.05
+    client_manager.service_cache.filename = os.path.join(tempfile.mkdtemp(), "services.json")
+
+    # The same port for all runs, as the services are cached per URL
+    port = None
+    for name in ("new Client per request", "shared client", "shared client (warm)"):
+        with FDSNStandIn(latency=args.latency, failure_rate=args.failure_rate, port=port or 0,
+                         connection_latency=args.connection_latency) as server:
+            port = int(server.url.rsplit(":", 1)[1])
+            config.fdsn_servers["ETH"] = server.url
+            # Forget the services discovered in this process, as after a restart
+            Client._Client__service_discovery_cache.clear()
+            client_manager.clear()
+            if name == "new Client per request":
+                get_client = lambda: Client(server.url)
+            else:
+                get_client = lambda: client_manager.get("ETH")
+            start = time.perf_counter()
+            failures = fetch_all(get_client, sta_codes, starttime, endtime)
+            wall = time.perf_counter() - start
+            print(f"{name:24s} {wall:7.2f} s  {server.request_count:4d} requests  "
+                  f"{server.connection_count:4d} connections  "
+                  f"{failures:3d} of {len(sta_codes)} stations failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the wall time of the sequential per-station download loop with the
+concurrent and the bulk download used by the "All seismograms" section plot.
+The waveform cache is disabled for the timing. The waveforms
+are served by a local FDSN stand-in with an artificial latency per request.
+
+    python benchmarks/bench_download.py --latency 0.5 --workers 8
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from obspy import UTCDateTime
+from codebase import config
+from codebase.seisplot import get_waveforms
+from codebase.download import get_all_waveforms, get_all_waveforms_bulk
+from benchmarks.fdsn_standin import FDSNStandIn, default_stations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="artificial latency per HTTP request in seconds")
+    parser.add_argument("--workers", type=int, default=config.download_workers,
+                        help="number of concurrent downloads")
+    parser.add_argument("--region", default="worldwide", choices=config.regions.keys())
+    args = parser.parse_args()
+
+    timewindow_start, timewindow_end = config.regions[args.region]["filt-time-range"]
+    origin_time = UTCDateTime(2024, 1, 1, 12)
+    sta_codes = default_stations()["S"]
+
+    config.use_waveform_cache = False
+    with FDSNStandIn(latency=args.latency) as server:
+        config.fdsn_servers["ETH"] = server.url
+
+        # Warm up the service discovery so that it is not part of the timing
+        get_waveforms(origin_time, timewindow_start, timewindow_end, sta_codes[0])
+
+        start = time.perf_counter()
+        sequential = [get_waveforms(origin_time, timewindow_start, timewindow_end, code)
+                      for code in sta_codes]
+        t_sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        concurrent = get_all_waveforms(origin_time, timewindow_start, timewindow_end,
+                                       sta_codes, max_workers=args.workers)
+        t_concurrent = time.perf_counter() - start
+
+        start = time.perf_counter()
+        bulk = get_all_waveforms_bulk(origin_time, timewindow_start, timewindow_end,
+                                      sta_codes, network="S", max_workers=args.workers)
+        t_bulk = time.perf_counter() - start
+
+    n_sequential = sum(1 for st in sequential if st)
+    n_concurrent = sum(1 for st in concurrent.values() if st)
+    n_bulk = sum(1 for st in bulk.values() if st)
+    print(f"Stations: {len(sta_codes)}, region: {args.region}, "
+          f"latency: {args.latency:.2f} s/request")
+    print(f"Sequential: {t_sequential:7.2f} s ({n_sequential} streams)")
+    print(f"Concurrent: {t_concurrent:7.2f} s ({n_concurrent} streams, "
+          f"{args.workers} workers)")
+    print(f"Bulk:       {t_bulk:7.2f} s ({n_bulk} streams, "
+          f"chunks of {config.bulk_chunk_size} stations)")
+    print(f"Speed-up:   {t_sequential / t_concurrent:7.1f}x concurrent, "
+          f"{t_sequential / t_bulk:7.1f}x bulk")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the vectorized geodesics of codebase.geodesy with a loop over
+obspy's gps2dist_azimuth for random station/event pairs: wall time and the
+maximum differences of distance, azimuth and back-azimuth. Also times the
+distances and the angular distances only of all stations to a full
+year's catalog in one call.
+
+    python benchmarks/bench_geodesy.py --pairs 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+from obspy.geodetics import gps2dist_azimuth
+from codebase.geodesy import geodesics, station_event_degrees, station_event_geodesics
+
+
+def angle_difference(a, b):
+    """ Absolute difference of two angles in degrees """
+    return np.abs((a - b + 180.0) % 360.0 - 180.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pairs", type=int, default=20000)
+    parser.add_argument("--stations", type=int, default=200)
+    parser.add_argument("--events", type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    lat1, lat2 = rng.uniform(-89, 89, (2, args.pairs))
+    lon1, lon2 = rng.uniform(-180, 180, (2, args.pairs))
+
+    start = time.perf_counter()
+    reference = np.array([gps2dist_azimuth(*pair) for pair in zip(lat1, lon1, lat2, lon2)])
+    t_loop = time.perf_counter() - start
+    start = time.perf_counter()
+    distance, azimuth, back_azimuth, _ = geodesics(lat1, lon1, lat2, lon2)
+    t_vectorized = time.perf_counter() - start
+
+    print(f"{args.pairs} pairs: gps2dist_azimuth loop {t_loop:.3f} s, "
+          f"vectorized {t_vectorized:.3f} s")
+    print(f"  max difference: distance {np.abs(distance * 1000.0 - reference[:, 0]).max():.2e} m, "
+          f"azimuth {angle_difference(azimuth, reference[:, 1]).max():.2e} deg, "
+          f"back-azimuth {angle_difference(back_azimuth, reference[:, 2]).max():.2e} deg")
+
+    sta_lats = rng.uniform(45.8, 47.8, args.stations)
+    sta_lons = rng.uniform(6.0, 10.5, args.stations)
+    event_lats = rng.uniform(-89, 89, args.events)
+    event_lons = rng.uniform(-180, 180, args.events)
+    start = time.perf_counter()
+    _, _, _, degrees = station_event_geodesics(sta_lats, sta_lons, event_lats, event_lons)
+    t_geodesics = time.perf_counter() - start
+    start = time.perf_counter()
+    matrix = station_event_degrees(sta_lats, sta_lons, event_lats, event_lons)
+    t_degrees = time.perf_counter() - start
+    print(f"{args.stations} stations x {args.events} events: geodesics {t_geodesics:.3f} s, "
+          f"angular distances only {t_degrees:.3f} s "
+          f"(max difference {np.abs(matrix - degrees).max():.2e} deg)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Wall time of the location map (mapplot.plot_map, including savefig) per
+region with the features drawn on every click and with the background from
+the basemap cache. The render time is measured with savefig replaced by a
+single draw of the figure, as the PNG encoding in savefig does not depend
+on the cache. The station inventory is served by the local FDSN stand-in.
+
+    python benchmarks/bench_map.py --repeat 3
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from obspy import UTCDateTime
+from obspy.core.event import Event, EventDescription, Magnitude, Origin
+from codebase import config, mapplot
+from codebase.basemap import basemap_cache
+from codebase.batch import HeadlessRaspberryShake
+from benchmarks.fdsn_standin import FDSNStandIn, default_stations
+
+# Event location per region
+epicenters = {"switzerland": (46.9, 7.4), "europe": (38.1, 23.5), "worldwide": (37.2, 37.0)}
+
+
+def time_map(raspberry, repeat, render_only=False):
+    """
+    Return the best wall time of plot_map out of repeat runs. With
+    render_only the figure is drawn once instead of saved.
+    """
+    savefig = plt.savefig
+    if render_only:
+        mapplot.plt.savefig = lambda *args, **kwargs: plt.gcf().canvas.draw()
+    times = []
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            mapplot.plot_map(raspberry)
+            times.append(time.perf_counter() - start)
+            plt.close('all')
+    finally:
+        mapplot.plt.savefig = savefig
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with FDSNStandIn() as server, tempfile.TemporaryDirectory() as directory:
+        config.fdsn_servers["ETH"] = server.url
+        os.chdir(directory)
+        basemap_cache.directory = os.path.join(directory, "basemaps")
+
+        for region, (lat, lon) in epicenters.items():
+            raspberry = HeadlessRaspberryShake(region)
+            raspberry.query_stations()
+            raspberry.select(station=default_stations()["S"][0], event=Event(
+                origins=[Origin(time=UTCDateTime(2024, 1, 1), latitude=lat,
+                                longitude=lon, depth=10000)],
+                magnitudes=[Magnitude(mag=5.0)],
+                event_descriptions=[EventDescription(text=region)]))
+
+            config.use_basemap_cache = False
+            t_features = time_map(raspberry, args.repeat, render_only=True)
+            t_features_total = time_map(raspberry, args.repeat)
+            config.use_basemap_cache = True
+            start = time.perf_counter()
+            basemap_cache.get(region)
+            t_render = time.perf_counter() - start
+            t_cached = time_map(raspberry, args.repeat, render_only=True)
+            t_cached_total = time_map(raspberry, args.repeat)
+            print(f"{region:12s}: render with features {t_features:6.3f} s, "
+                  f"cached {t_cached:6.3f} s (basemap once {t_render:5.2f} s); "
+                  f"with savefig {t_features_total:5.2f} s and {t_cached_total:5.2f} s")
+
+
+if __name__ == "__main__":
+    main()
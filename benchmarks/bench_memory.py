@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Peak memory of a full section plot (plot_all_seismograms) of a worldwide
+event with all seismo-at-school stations, with the processed traces on
+the heap and with the memory-mapped trace store and memory limit. Every
+configuration runs in a fresh process against the FDSN stand-in; the
+traced Python/NumPy peak during the plot and the growth of the peak
+resident set size of the process are reported.
+
+    python benchmarks/bench_memory.py --latency 0.0
+
+Measured with 45 stations of 80 min (one core, stand-in without latency):
+
+    heap                      9.75 s  traced peak    445.6 MiB  peak RSS growth    538.0 MiB
+    trace store              10.63 s  traced peak    120.9 MiB  peak RSS growth    111.1 MiB
+    trace store, 64 MiB      10.92 s  traced peak     36.9 MiB  peak RSS growth      0.0 MiB
+
+The peak RSS growth is relative to the peak before the plot (the
+inventory download), so it is 0 when the plot stays below that.
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from codebase.catalogcache import event_magnitude
+from benchmarks.fdsn_standin import FDSNStandIn, synthetic_catalog
+
+# Configurations: name and settings of codebase.config
+configurations = [
+    ("heap", {"use_trace_store": False, "section_memory_limit": None}),
+    ("trace store", {"use_trace_store": True, "section_memory_limit": 256 * 1024**2}),
+    ("trace store, 64 MiB", {"use_trace_store": True, "section_memory_limit": 64 * 1024**2}),
+]
+
+
+def run(url, settings, region, event, queue):
+    """ Child process: plot the section of the event """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from codebase import config
+    from codebase.batch import HeadlessRaspberryShake
+    from codebase.inventorycache import inventory_cache
+    from codebase import seisallplot
+
+    directory = tempfile.mkdtemp()
+    config.fdsn_servers["ETH"] = config.fdsn_servers["IRIS"] = url
+    inventory_cache.filename = os.path.join(directory, "inventory.json")
+    config.use_waveform_cache = False
+    config.use_availability_check = False
+    config.gui_async = False
+    config.use_prefetch = False
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+    raspberry = HeadlessRaspberryShake(region)
+    raspberry.query_stations()
+    raspberry.select(event=event)
+
+    os.chdir(directory)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        seisallplot.plot_all_seismograms(raspberry)
+    wall = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    plt.close("all")
+    rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) * 1024
+    traces = [line for line in output.getvalue().splitlines() if "Number of seismograms" in line]
+    queue.put((wall, peak, rss_growth, traces[0] if traces else "no seismograms"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--region", default="worldwide")
+    parser.add_argument("--year", type=int, default=2024)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    # The largest event of the synthetic catalog of the stand-in
+    event = max(synthetic_catalog(args.year), key=event_magnitude)
+    context = multiprocessing.get_context("spawn")
+    with FDSNStandIn(latency=args.latency) as server:
+        for name, settings in configurations:
+            queue = context.Queue()
+            process = context.Process(target=run, args=(server.url, settings, args.region,
+                                                        event, queue))
+            process.start()
+            process.join()
+            if queue.empty():
+                print(f"{name:22s} failed with exit code {process.exitcode}")
+                continue
+            wall, peak, rss_growth, traces = queue.get()
+            print(f"{name:22s} {wall:7.2f} s  traced peak {peak / 1024**2:8.1f} MiB  "
+                  f"peak RSS growth {rss_growth / 1024**2:8.1f} MiB  ({traces})")
+
+
+if __name__ == "__main__":
+    main()
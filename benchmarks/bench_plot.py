@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Render and savefig time of a worldwide section (80 minutes at 100 Hz for
+every RaspberryShake station) and of a 3-component seismogram, with and
+without the min/max envelope decimation of the plotting modules.
+
+    python benchmarks/bench_plot.py --stations 45
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+from codebase import config
+from codebase.seisallplot import plot_section_traces
+from codebase.seisplot import plot_three_component_seismogram
+
+
+def synthetic_traces(n_stations, duration, sampling_rate=100.0):
+    """ Noise traces with a spike, one per station (Z component) """
+    rng = np.random.default_rng(42)
+    npts = int(duration * sampling_rate)
+    traces = []
+    for idx in range(n_stations):
+        data = rng.standard_normal(npts)
+        data[rng.integers(npts)] = 50.0
+        traces.append(Trace(data=data, header={
+            "network": "S", "station": f"ST{idx:03d}", "channel": "EHZ",
+            "starttime": UTCDateTime(2024, 1, 1), "sampling_rate": sampling_rate}))
+    return traces
+
+
+def time_section(traces, timewindow_end):
+    distances = list(np.linspace(100, 9000, len(traces)))
+    labels = [f"S.{tr.stats.station}" for tr in traces]
+    start = time.perf_counter()
+    fig, ax = plt.subplots(figsize=(10, 12))
+    plot_section_traces(ax, traces, distances, labels, timewindow_end)
+    ax.set_xlim(0, timewindow_end)
+    fig.canvas.draw()
+    t_render = time.perf_counter() - start
+    fig.savefig(io.BytesIO(), format="png", dpi=config.plot_dpi, bbox_inches='tight')
+    t_total = time.perf_counter() - start
+    plt.close(fig)
+    return t_render, t_total - t_render
+
+
+def time_three_component(traces):
+    stream = Stream([tr.copy() for tr in traces[:3]])
+    for tr, component in zip(stream, "ZNE"):
+        tr.stats.channel = "EH" + component
+    start = time.perf_counter()
+    fig, (axZ, axN, axE) = plt.subplots(nrows=3, ncols=1, figsize=(11, 4),
+                                        sharex=True, sharey=True)
+    plot_three_component_seismogram(stream, axZ, axN, axE)
+    fig.canvas.draw()
+    t_render = time.perf_counter() - start
+    fig.savefig(io.BytesIO(), format="png", dpi=config.plot_dpi, bbox_inches='tight')
+    t_total = time.perf_counter() - start
+    plt.close(fig)
+    return t_render, t_total - t_render
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--stations", type=int, default=45)
+    args = parser.parse_args()
+
+    timewindow_end = config.regions["worldwide"]["filt-time-range"][1]
+    traces = synthetic_traces(args.stations, timewindow_end)
+    print(f"{args.stations} traces x {traces[0].stats.npts} samples, dpi={config.plot_dpi}")
+
+    for envelope in (False, True):
+        config.plot_envelope = envelope
+        name = "envelope" if envelope else "full    "
+        render, save = time_section(traces, timewindow_end)
+        print(f"Section     {name}: render {render:6.2f} s, savefig {save:6.2f} s")
+        render, save = time_three_component(traces)
+        print(f"3-component {name}: render {render:6.2f} s, savefig {save:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
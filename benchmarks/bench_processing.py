@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the pre-processing of the seismogram plots at the recorded sample
+rate with the decimated path (bandpass, decimation to the 'sampling-rate' of
+the region, response removal, trim). Reports the wall time of both and
+checks that the decimated output matches the full-rate output at the
+common samples within the tolerance, relative to the peak amplitude.
+The per-station processing of the section plot is also compared with the
+batched 2-D processing (process_section) of all stations, which is then
+repeated with the response spectra from the response cache.
+
+The peak amplitude of the decimated trace can only be smaller, as the
+maximum may fall between two samples. For a sine at the frequency f it is
+at most 1 - cos(pi * f / sampling-rate) smaller, i.e. up to 7 % at the
+centre of the passband and at the default rates of five times fmax.
+
+    python benchmarks/bench_processing.py --stations 45 --tolerance 1e-3
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+from codebase import config
+from codebase.processing import process_section, process_stream
+from codebase.responsecache import response_cache
+from benchmarks.fdsn_standin import _response
+
+
+def synthetic_stream(n_stations, duration, fmin, fmax, sampling_rate=100.0):
+    """
+    Vertical component traces in counts with noise and a wave packet in the
+    passband, with the response of the FDSN stand-in attached
+    """
+    rng = np.random.default_rng(42)
+    npts = int(duration * sampling_rate) + 1
+    t = np.arange(npts) / sampling_rate
+    response = _response()
+    stream = Stream()
+    for idx in range(n_stations):
+        onset = duration * rng.uniform(0.2, 0.6)
+        f0 = np.sqrt(fmin * fmax)
+        packet = np.exp(-((t - onset) * f0 / 2.0) ** 2) * np.sin(2 * np.pi * f0 * (t - onset))
+        data = 1e5 * packet + 1e3 * rng.standard_normal(npts)
+        tr = Trace(data=data, header={
+            "network": "S", "station": f"ST{idx:03d}", "channel": "EHZ",
+            "starttime": UTCDateTime(2024, 1, 1), "sampling_rate": sampling_rate})
+        tr.stats.response = response
+        stream += tr
+    return stream
+
+
+def compare(full, decimated):
+    """ Maximum difference at the common samples and peak ratio, relative to the peak """
+    errors, peak_errors = [], []
+    for tr_full, tr_dec in zip(full, decimated):
+        factor = int(round(tr_dec.stats.delta / tr_full.stats.delta))
+        common = tr_full.data[::factor][:tr_dec.stats.npts]
+        peak = np.abs(tr_full.data).max()
+        errors.append(np.abs(common - tr_dec.data[:len(common)]).max() / peak)
+        peak_errors.append(abs(np.abs(tr_dec.data).max() - peak) / peak)
+    return max(errors), max(peak_errors)
+
+
+def compare_section(stream, fmin, fmax, starttime, endtime, sampling_rate):
+    """
+    Time the per-station processing, the batched processing and the repeated
+    batched processing of the section. Returns the times and the maximum
+    difference relative to the peak amplitude.
+    """
+    response_cache.clear()
+    start = time.perf_counter()
+    serial = [process_stream(Stream([tr.copy()]), fmin, fmax, starttime, endtime,
+                             sampling_rate)[0] for tr in stream]
+    t_serial = time.perf_counter() - start
+    response_cache.clear()
+    start = time.perf_counter()
+    batched, peaks = process_section([Stream([tr.copy()]) for tr in stream], fmin, fmax,
+                                     starttime, endtime, sampling_rate)
+    t_batched = time.perf_counter() - start
+    start = time.perf_counter()
+    process_section([Stream([tr.copy()]) for tr in stream], fmin, fmax,
+                    starttime, endtime, sampling_rate)
+    t_repeated = time.perf_counter() - start
+
+    error = 0.0
+    for tr_serial, tr_batched, peak in zip(serial, batched, peaks):
+        reference = np.abs(tr_serial.data).max()
+        error = max(error, np.abs(tr_serial.data - tr_batched.data).max() / reference,
+                    abs(peak - reference) / reference)
+    return t_serial, t_batched, t_repeated, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--stations", type=int, default=45)
+    parser.add_argument("--tolerance", type=float, default=1e-3,
+                        help="maximum difference relative to the peak amplitude")
+    parser.add_argument("--peak-tolerance", type=float, default=0.1,
+                        help="maximum relative difference of the peak amplitudes")
+    args = parser.parse_args()
+
+    failed = False
+    for region, parameters in config.regions.items():
+        fmin, fmax = parameters["filt-freq-range"]
+        timewindow_start, timewindow_end = parameters["filt-time-range"]
+        sampling_rate = parameters["sampling-rate"]
+        stream = synthetic_stream(args.stations, timewindow_end, fmin, fmax)
+        starttime = stream[0].stats.starttime + timewindow_start
+        endtime = stream[0].stats.starttime + timewindow_end
+
+        start = time.perf_counter()
+        full = process_stream(stream.copy(), fmin, fmax, starttime, endtime)
+        t_full = time.perf_counter() - start
+        start = time.perf_counter()
+        decimated = process_stream(stream.copy(), fmin, fmax, starttime, endtime,
+                                   sampling_rate)
+        t_decimated = time.perf_counter() - start
+
+        error, peak_error = compare(full, decimated)
+        ok = error <= args.tolerance and peak_error <= args.peak_tolerance
+        failed = failed or not ok
+        print(f"{region:12s} {stream[0].stats.sampling_rate:g} -> "
+              f"{decimated[0].stats.sampling_rate:g} Hz: "
+              f"full {t_full:6.2f} s, decimated {t_decimated:6.2f} s, "
+              f"max difference {error:.2e}, peak {peak_error:.2e} "
+              f"{'ok' if ok else 'FAILED'}")
+
+        t_serial, t_batched, t_repeated, error = compare_section(
+            stream, fmin, fmax, starttime, endtime, sampling_rate)
+        ok = error <= args.tolerance
+        failed = failed or not ok
+        print(f"{region:12s} section of {len(stream)} stations: per station "
+              f"{t_serial:6.2f} s, batched {t_batched:6.2f} s, "
+              f"repeated {t_repeated:6.2f} s, "
+              f"max difference {error:.2e} {'ok' if ok else 'FAILED'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
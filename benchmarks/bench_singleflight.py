@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Simulates a classroom: several processes (the kernels of the students)
+sharing one cache directory start the same query at the same time, the
+event catalog of a year and the waveforms of the seismo-at-school
+stations. Compares the number of requests to the FDSN stand-in and the
+wall time without and with single-flight coordination, and prints the
+hit/wait/fetch counters summed over all processes.
+
+    python benchmarks/bench_singleflight.py --processes 20 --latency 0.2
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from obspy import UTCDateTime
+from codebase import config
+from codebase.catalogcache import catalog_cache
+from codebase.clients import client_manager
+from codebase.seisplot import download_waveforms
+from codebase.singleflight import single_flight
+from codebase.waveformcache import waveform_cache
+from benchmarks.fdsn_standin import FDSNStandIn, default_stations
+
+
+def student(url, directory, use_single_flight, barrier, sta_codes):
+    """ One kernel: the catalog and the waveforms of all stations """
+    config.fdsn_servers["ETH"] = url
+    config.use_single_flight = use_single_flight
+    catalog_cache.directory = os.path.join(directory, "catalogs")
+    waveform_cache.directory = os.path.join(directory, "waveforms")
+    client_manager.service_cache.filename = os.path.join(directory, "fdsn_services.json")
+    single_flight.directory = os.path.join(directory, "inflight")
+    barrier.wait()
+    catalog = catalog_cache.get_events("ETH", 2024, "switzerland", 2.5)
+    starttime = UTCDateTime(2024, 1, 1, 12)
+    for code in sta_codes:
+        download_waveforms("S", code, "EHZ", starttime, starttime + 600, config.download_timeout)
+    return len(catalog)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, default=20)
+    parser.add_argument("--stations", type=int, default=5,
+                        help="number of stations requested by every process")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="artificial latency per HTTP request in seconds")
+    args = parser.parse_args()
+
+    sta_codes = default_stations()["S"][:args.stations]
+    context = multiprocessing.get_context("fork")
+    for use_single_flight in (False, True):
+        directory = tempfile.mkdtemp()
+        try:
+            with FDSNStandIn(latency=args.latency) as server:
+                barrier = context.Barrier(args.processes)
+                start = time.perf_counter()
+                processes = [context.Process(target=student,
+                                             args=(server.url, directory, use_single_flight,
+                                                   barrier, sta_codes))
+                             for _ in range(args.processes)]
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+                wall = time.perf_counter() - start
+                name = "single-flight" if use_single_flight else "independent"
+                print(f"{name:14s} {wall:7.2f} s  {server.request_count:4d} requests  "
+                      f"{sum(process.exitcode != 0 for process in processes)} failed")
+                if use_single_flight:
+                    single_flight.directory = os.path.join(directory, "inflight")
+                    print("               ", single_flight.statistics(shared=True))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
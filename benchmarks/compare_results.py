@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Compares two result files of the benchmark suite (suite.py). For every
+region and scenario the median wall time, median CPU time and peak memory
+of the new run are shown relative to the baseline. Changes above the
+threshold are marked, and the exit status is 1 if a scenario got slower.
+
+    python benchmarks/compare_results.py results/base.json results/new.json --threshold 0.1
+"""
+import argparse
+import json
+import statistics
+import sys
+
+
+def load(filename):
+    """ Return the report and its results keyed by (region, scenario) """
+    with open(filename) as f:
+        report = json.load(f)
+    return report, {(r["region"], r["scenario"]): r for r in report["results"]}
+
+
+def ratio(new, base):
+    if not base or new is None:
+        return None
+    return new / base
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change of the wall time counted as regression")
+    args = parser.parse_args()
+
+    base_report, base = load(args.base)
+    new_report, new = load(args.new)
+    print(f"base {base_report.get('commit')} ({base_report.get('created')}), "
+          f"new {new_report.get('commit')} ({new_report.get('created')})")
+    print(f"{'region':12s} {'scenario':22s} {'wall base':>10s} {'wall new':>10s} "
+          f"{'wall':>7s} {'cpu':>7s} {'memory':>7s}")
+
+    regressions = 0
+    for key in sorted(set(base) & set(new)):
+        b, n = base[key], new[key]
+        wall_base, wall_new = statistics.median(b["wall"]), statistics.median(n["wall"])
+        ratios = [ratio(wall_new, wall_base),
+                  ratio(statistics.median(n["cpu"]), statistics.median(b["cpu"])),
+                  ratio(n["peak_memory"], b["peak_memory"])]
+        mark = ""
+        if ratios[0] is not None and ratios[0] > 1 + args.threshold:
+            mark = "  slower"
+            regressions += 1
+        elif ratios[0] is not None and ratios[0] < 1 - args.threshold:
+            mark = "  faster"
+        if n.get("errors") and not b.get("errors"):
+            mark += "  new errors"
+        print(f"{key[0]:12s} {key[1]:22s} {wall_base:9.3f}s {wall_new:9.3f}s " +
+              " ".join(f"{r:6.2f}x" if r is not None else f"{'-':>7s}" for r in ratios) + mark)
+
+    for key in sorted(set(base) ^ set(new)):
+        print(f"{key[0]:12s} {key[1]:22s} only in {'base' if key in base else 'new'}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the FDSN web services used by the codebase. It serves
+the station, event, dataselect and availability endpoints with an
+artificial latency per
+request, so that the plots and download strategies can be timed without
+hitting the live ETH/IRIS services.
+
+The answers come from recorded fixtures if a fixture directory is given
+(stations.xml, events.xml and waveforms.mseed, see record_fixtures.py) and
+are synthesized otherwise: StationXML and noise miniSEED for the
+seismo-at-school stations, and a fixed pseudo-random catalog per year.
+A fraction of the queries can be answered with an error status
+(failure injection).
+
+Usage from a benchmark:
+
+    with FDSNStandIn(latency=0.5, failure_rate=0.1) as server:
+        config.fdsn_servers["ETH"] = server.url
+        ...
+"""
+import copy
+import fnmatch
+import io
+import os
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from obspy import Catalog, Stream, Trace, UTCDateTime, read, read_events, read_inventory
+from obspy.clients.fdsn.header import DEFAULT_PARAMETERS
+from obspy.core.event import Event, EventDescription, Magnitude, Origin
+from obspy.core.inventory import Channel, Inventory, Network, Response, Station
+
+from codebase import config
+
+# Sampling rate and channel codes of the synthetic stations per network
+_network_channels = {"S": ("EH", 100.0), "CH": ("HH", 100.0)}
+
+
+def default_stations():
+    """ Return the station codes per network of the seismo-at-school setup """
+    s_codes = [station[0] for station in config.rs_sta_list]
+    ch_codes = sorted({station[2] for station in config.rs_sta_list if station[2]})
+    return {"S": s_codes, "CH": ch_codes}
+
+
+def _seed(*parts):
+    """ Deterministic seed for the synthetic data of a station """
+    return zlib.crc32(".".join(parts).encode())
+
+
+def _station_coordinates(network, station):
+    """ Pseudo-random but fixed coordinates inside Switzerland """
+    rng = np.random.default_rng(_seed(network, station))
+    return 45.8 + 2.0 * rng.random(), 6.0 + 4.5 * rng.random(), 300 + 1500 * rng.random()
+
+
+def _response():
+    """ Simple velocity sensor response in counts/(m/s) """
+    return Response.from_paz(zeros=[0j, 0j], poles=[-4.44 + 4.44j, -4.44 - 4.44j],
+                             stage_gain=3.99e8, input_units="M/S",
+                             output_units="COUNTS")
+
+
+def _full_response():
+    """
+    Response with a sensor, a digitizer and two FIR decimation stages (333
+    coefficients), as the RESP level responses of the real networks
+    """
+    global _full_response_example
+    if _full_response_example is None:
+        network = read_inventory().select(network="BW", station="RJOB", channel="EHZ")[0]
+        _full_response_example = max(
+            (channel.response for station in network for channel in station),
+            key=lambda response: len(response.response_stages))
+    return _full_response_example
+
+
+_full_response_example = None
+
+
+def realistic_stations(n_ch=200, n_s=150):
+    """
+    Return the default station codes per network, completed with generated
+    codes to the size of the full CH and S inventories
+    """
+    stations = default_stations()
+    for network, size in (("CH", n_ch), ("S", n_s)):
+        codes = stations[network]
+        codes += [f"X{idx:03d}" for idx in range(size - len(codes))]
+    return stations
+
+
+def synthetic_inventory(selected, level, epochs=1, full_responses=False):
+    """
+    Inventory of the (network, station, channel) triples at the given level.
+    Every channel has ``epochs`` yearly epochs since 2015 (the last one is
+    open) and the simple or full response at the response level.
+    """
+    networks = {}
+    for network, station, channel in selected:
+        lat, lon, elev = _station_coordinates(network, station)
+        net = networks.setdefault(network, Network(code=network, stations=[]))
+        stations = {sta.code: sta for sta in net.stations}
+        if station not in stations:
+            stations[station] = Station(code=station, latitude=lat, longitude=lon,
+                                        elevation=elev,
+                                        start_date=UTCDateTime(2015, 1, 1))
+            net.stations.append(stations[station])
+        if level not in ("channel", "response", "resp"):
+            continue
+        _, sampling_rate = _network_channels.get(network, ("HH", 100.0))
+        for epoch in range(epochs):
+            response = None
+            if level != "channel":
+                response = _full_response() if full_responses else _response()
+            stations[station].channels.append(Channel(
+                code=channel, location_code="", latitude=lat, longitude=lon,
+                elevation=elev, depth=0.0, sample_rate=sampling_rate,
+                start_date=UTCDateTime(2015 + epoch, 1, 1),
+                end_date=UTCDateTime(2016 + epoch, 1, 1) if epoch < epochs - 1 else None,
+                response=response))
+    return Inventory(networks=list(networks.values()), source="FDSNStandIn")
+
+
+def synthetic_catalog(year, box=(-90.0, 90.0, -180.0, 180.0), n_events=300, min_mag=2.0):
+    """
+    Fixed pseudo-random catalog of the year with Gutenberg-Richter
+    magnitudes (b = 1) above min_mag inside the (minlat, maxlat, minlon,
+    maxlon) box
+    """
+    rng = np.random.default_rng(_seed("events", str(year), *(str(value) for value in box)))
+    starttime = UTCDateTime(year, 1, 1)
+    seconds = UTCDateTime(year + 1, 1, 1) - starttime
+    events = []
+    for idx, offset in enumerate(np.sort(rng.uniform(0, seconds, n_events))):
+        origin = Origin(time=starttime + float(offset),
+                        latitude=float(rng.uniform(box[0], box[1])),
+                        longitude=float(rng.uniform(box[2], box[3])),
+                        depth=float(rng.uniform(0, 1000 * rng.choice([30, 100, 600]))))
+        magnitude = Magnitude(mag=round(float(min_mag + rng.exponential(1 / np.log(10))), 1),
+                              magnitude_type="M")
+        events.append(Event(resource_id=f"smi:local/standin/{year}/{idx}",
+                            origins=[origin], magnitudes=[magnitude],
+                            event_descriptions=[EventDescription(
+                                text=f"Synthetic event {idx}", type="region name")]))
+    return Catalog(events=events)
+
+
+def _wadl(service):
+    """ Minimal WADL listing the default parameters of the service """
+    params = "".join(f'<param name="{name}" style="query" type="xs:string"/>'
+                     for name in DEFAULT_PARAMETERS[service])
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<application xmlns="http://wadl.dev.java.net/2009/02" '
+            'xmlns:xs="http://www.w3.org/2001/XMLSchema">'
+            f'<resources base="/fdsnws/{service}/1/">'
+            '<resource path="query"><method id="query" name="GET"><request>'
+            f'{params}</request></method></resource>'
+            '</resources></application>').encode()
+
+
+def _matches(code, patterns):
+    """ FDSN style matching of a code against a comma separated pattern list """
+    if patterns is None:
+        return True
+    for pattern in patterns.split(","):
+        pattern = "" if pattern == "--" else pattern
+        if fnmatch.fnmatchcase(code, pattern):
+            return True
+    return False
+
+
+class FDSNStandIn:
+    """
+    Threaded HTTP server implementing the FDSN station, event, dataselect
+    and availability endpoints. ``latency`` seconds are added to every request and
+    ``connection_latency`` seconds to every new connection (as the TCP and
+    TLS handshakes of a remote server; connections are kept alive). The
+    fraction ``failure_rate`` of the queries (of ``failure_services``, by
+    default all) are answered with the HTTP status ``failure_status``.
+    The stations in ``no_data`` (network.station codes) are in the
+    inventory but have no waveforms.
+    """
+    def __init__(self, stations=None, latency=0.0, host="127.0.0.1", port=0,
+                 fixtures=None, failure_rate=0.0, failure_status=503,
+                 failure_services=None, seed=0, connection_latency=0.0, no_data=()):
+        self.stations = stations if stations is not None else default_stations()
+        self.no_data = set(no_data)
+        self.latency = latency
+        self.connection_latency = connection_latency
+        self.connection_count = 0
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.failure_services = failure_services
+        self.request_count = 0
+        self.failure_count = 0
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._load_fixtures(fixtures)
+
+        standin = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with standin._lock:
+                    standin.connection_count += 1
+                if standin.connection_latency > 0:
+                    time.sleep(standin.connection_latency)
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                standin._handle(self)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                standin._handle(self, self.rfile.read(length).decode())
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def _load_fixtures(self, directory):
+        """ Read the recorded fixtures that exist in the directory """
+        self.inventory = self.catalog = self.waveforms = None
+        if directory is None:
+            return
+        filename = os.path.join(directory, "stations.xml")
+        if os.path.exists(filename):
+            self.inventory = read_inventory(filename)
+        filename = os.path.join(directory, "events.xml")
+        if os.path.exists(filename):
+            self.catalog = read_events(filename)
+        filename = os.path.join(directory, "waveforms.mseed")
+        if os.path.exists(filename):
+            self.waveforms = read(filename)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Request handling
+    def _handle(self, handler, body=None):
+        with self._lock:
+            self.request_count += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        url = urlparse(handler.path)
+        parts = url.path.strip("/").split("/")
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if len(parts) != 4 or parts[0] != "fdsnws":
+            return self._reply(handler, 404, b"Not found")
+        service, resource = parts[1], parts[3]
+
+        if resource == "application.wadl" and service in DEFAULT_PARAMETERS:
+            return self._reply(handler, 200, _wadl(service), "application/xml")
+        if resource == "version":
+            return self._reply(handler, 200, b"1.1.0", "text/plain")
+        if resource != "query":
+            return self._reply(handler, 404, b"Not found")
+
+        # Failure injection
+        if self.failure_services is None or service in self.failure_services:
+            with self._lock:
+                failed = self._rng.random() < self.failure_rate
+                self.failure_count += int(failed)
+            if failed:
+                return self._reply(handler, self.failure_status, b"Injected failure")
+
+        # POST requests carry one "NET STA LOC CHA START END" line per selection
+        queries = [query]
+        if body is not None:
+            options = {}
+            queries = []
+            for line in body.splitlines():
+                if "=" in line:
+                    key, value = line.split("=", 1)
+                    options[key.strip()] = value.strip()
+                elif line.strip():
+                    net, sta, loc, cha, start, end = line.split()
+                    queries.append({"network": net, "station": sta, "location": loc,
+                                    "channel": cha, "starttime": start, "endtime": end})
+            queries = [dict(options, **q) for q in queries]
+
+        if service == "station":
+            payload = self._stationxml(queries)
+            content_type = "application/xml"
+        elif service == "dataselect":
+            payload = self._miniseed(queries)
+            content_type = "application/vnd.fdsn.mseed"
+        elif service == "event":
+            payload = self._quakeml(query)
+            content_type = "application/xml"
+        elif service == "availability":
+            payload = self._availability(queries)
+            content_type = "text/plain"
+        else:
+            return self._reply(handler, 404, b"Not found")
+
+        if payload is None:
+            return self._reply(handler, 204, b"")
+        return self._reply(handler, 200, payload, content_type)
+
+    @staticmethod
+    def _reply(handler, code, body, content_type="text/plain"):
+        handler.send_response(code)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _select(self, query):
+        """ Return the (network, station, channel) triples matching the query """
+        selected = []
+        for network, codes in self.stations.items():
+            if not _matches(network, query.get("network", query.get("net"))):
+                continue
+            band, _ = _network_channels.get(network, ("HH", 100.0))
+            for station in codes:
+                if not _matches(station, query.get("station", query.get("sta"))):
+                    continue
+                if not _matches("", query.get("location", query.get("loc"))):
+                    continue
+                for component in "ZNE":
+                    channel = band + component
+                    if _matches(channel, query.get("channel", query.get("cha"))):
+                        selected.append((network, station, channel))
+        return selected
+
+    def _recorded_stationxml(self, queries, level):
+        """ StationXML of the recorded inventory matching the queries, or None """
+        networks = []
+        for network in self.inventory:
+            if not any(_matches(network.code, q.get("network", q.get("net"))) for q in queries):
+                continue
+            stations = []
+            for station in network:
+                channels = [channel for channel in station if any(
+                    _matches(station.code, q.get("station", q.get("sta"))) and
+                    _matches(channel.location_code, q.get("location", q.get("loc"))) and
+                    _matches(channel.code, q.get("channel", q.get("cha"))) for q in queries)]
+                if len(channels) == 0:
+                    continue
+                station = copy.copy(station)
+                if level == "station":
+                    station.channels = []
+                elif level == "channel":
+                    station.channels = [copy.copy(channel) for channel in channels]
+                    for channel in station.channels:
+                        channel.response = None
+                else:
+                    station.channels = channels
+                stations.append(station)
+            if stations:
+                network = copy.copy(network)
+                network.stations = stations
+                networks.append(network)
+        if len(networks) == 0:
+            return None
+        buf = io.BytesIO()
+        Inventory(networks=networks, source="FDSNStandIn").write(buf, format="STATIONXML")
+        return buf.getvalue()
+
+    def _stationxml(self, queries):
+        if self.inventory is not None:
+            return self._recorded_stationxml(
+                queries, queries[0].get("level", "station").lower())
+
+        selected = list(dict.fromkeys(
+            triple for query in queries for triple in self._select(query)))
+        if len(selected) == 0:
+            return None
+        level = queries[0].get("level", "station").lower()
+
+        buf = io.BytesIO()
+        synthetic_inventory(selected, level).write(buf, format="STATIONXML")
+        return buf.getvalue()
+
+    def _quakeml(self, query):
+        """ QuakeML of the recorded or synthetic events matching the query """
+        starttime = UTCDateTime(query.get("starttime", query.get("start")))
+        endtime = UTCDateTime(query.get("endtime", query.get("end", UTCDateTime())))
+        if self.catalog is not None:
+            events = self.catalog
+        else:
+            events = Catalog()
+            for year in range(starttime.year, endtime.year + 1):
+                events += synthetic_catalog(year)
+
+        def value(*names, default):
+            for name in names:
+                if name in query:
+                    return float(query[name])
+            return default
+
+        min_mag = value("minmagnitude", "minmag", default=-10.0)
+        max_mag = value("maxmagnitude", "maxmag", default=10.0)
+        min_lat = value("minlatitude", "minlat", default=-90.0)
+        max_lat = value("maxlatitude", "maxlat", default=90.0)
+        min_lon = value("minlongitude", "minlon", default=-180.0)
+        max_lon = value("maxlongitude", "maxlon", default=180.0)
+
+        selected = Catalog()
+        for event in events:
+            origin = event.preferred_origin() or event.origins[0]
+            magnitude = (event.preferred_magnitude() or event.magnitudes[0]).mag
+            if starttime <= origin.time <= endtime and min_mag <= magnitude <= max_mag and \
+                    min_lat <= origin.latitude <= max_lat and \
+                    min_lon <= origin.longitude <= max_lon:
+                selected.append(event)
+        if len(selected) == 0:
+            return None
+        buf = io.BytesIO()
+        selected.write(buf, format="QUAKEML")
+        return buf.getvalue()
+
+    def _recorded_traces(self, query, starttime, endtime):
+        """ Recorded traces matching the query, cut to the window """
+        stream = Stream([tr for tr in self.waveforms
+                         if _matches(tr.stats.network, query.get("network", query.get("net"))) and
+                         _matches(tr.stats.station, query.get("station", query.get("sta"))) and
+                         _matches(tr.stats.location, query.get("location", query.get("loc"))) and
+                         _matches(tr.stats.channel, query.get("channel", query.get("cha")))])
+        return stream.slice(starttime, endtime)
+
+    def _waveforms(self, queries):
+        """ Recorded or synthetic traces of the queries """
+        stream = Stream()
+        for query in queries:
+            starttime = UTCDateTime(query.get("starttime", query.get("start")))
+            endtime = UTCDateTime(query.get("endtime", query.get("end")))
+            recorded = Stream()
+            if self.waveforms is not None:
+                recorded = self._recorded_traces(query, starttime, endtime)
+            # Windows that were not recorded are synthesized
+            if len(recorded) > 0:
+                stream += recorded
+            else:
+                stream += self._traces(self._select(query), starttime, endtime)
+        stream.traces = [tr for tr in stream
+                         if f"{tr.stats.network}.{tr.stats.station}" not in self.no_data]
+        return stream
+
+    def _miniseed(self, queries):
+        stream = self._waveforms(queries)
+        if len(stream) == 0:
+            return None
+
+        buf = io.BytesIO()
+        stream.write(buf, format="MSEED", encoding="STEIM2")
+        return buf.getvalue()
+
+    def _availability(self, queries):
+        """ Text format availability: one line per channel with its time span """
+        lines = [f"{tr.stats.network} {tr.stats.station} {tr.stats.location or '--'} "
+                 f"{tr.stats.channel} M {tr.stats.sampling_rate:g} "
+                 f"{tr.stats.starttime} {tr.stats.endtime}"
+                 for tr in self._waveforms(queries)]
+        if len(lines) == 0:
+            return None
+        header = "#Network Station Location Channel Quality SampleRate Earliest Latest"
+        return "\n".join([header] + lines).encode()
+
+    def _traces(self, selected, starttime, endtime):
+        """ Synthetic noise traces for the selected channels """
+        stream = Stream()
+        for network, station, channel in selected:
+            _, sampling_rate = _network_channels.get(network, ("HH", 100.0))
+            npts = int((endtime - starttime) * sampling_rate) + 1
+            rng = np.random.default_rng(_seed(network, station, channel))
+            data = (rng.standard_normal(npts) * 1000).astype(np.int32)
+            stream += Trace(data=data, header={
+                "network": network, "station": station, "location": "",
+                "channel": channel, "starttime": starttime,
+                "sampling_rate": sampling_rate})
+        return stream
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Records the fixtures of the benchmark suite for a region profile into
+benchmarks/fixtures/<region>/:
+
+    stations.xml     full inventories of the CH and S networks (responses)
+    events.xml       catalog of the year for the region
+    waveforms.mseed  raw waveforms of the largest event for all S stations
+                     and the SED station next to the selected station
+    fixture.json     year, event and station used by the scenarios
+
+With --source live the data is downloaded from the services in
+config.fdsn_servers. With --source synthetic only a synthetic catalog in
+the region is written, and the FDSN stand-in synthesizes the inventory and
+the waveforms, so the suite also runs offline. The fixtures are not part of
+the repository.
+
+    python benchmarks/record_fixtures.py --region worldwide --year 2024 --source live
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from obspy import UTCDateTime
+from codebase import config
+from codebase.batch import HeadlessRaspberryShake
+from codebase.catalogcache import event_magnitude
+from codebase.clients import get_client
+from benchmarks.fdsn_standin import synthetic_catalog
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# Event box (minlat, maxlat, minlon, maxlon) of the synthetic catalogs
+region_boxes = {"switzerland": (45.5, 48.0, 5.5, 11.0),
+                "europe": (38.0, 70.0, -15.0, 30.0),
+                "worldwide": (-90.0, 90.0, -180.0, 180.0)}
+
+
+def largest_event(catalog):
+    """ Return the event with the largest magnitude """
+    return max(catalog, key=event_magnitude)
+
+
+def record_live(raspberry, directory, station):
+    """ Download the inventories, the catalog and the waveforms of the largest event """
+    inventories = raspberry.download_inventories()
+    (inventories["CH"] + inventories["S"]).write(
+        os.path.join(directory, "stations.xml"), format="STATIONXML")
+    raspberry.set_inventories(inventories)
+
+    catalog = raspberry.fetch_catalog()
+    if len(catalog) == 0:
+        raise RuntimeError("No events found for the region and year")
+    catalog.write(os.path.join(directory, "events.xml"), format="QUAKEML")
+
+    event = largest_event(catalog)
+    raspberry.select(event=event, station=station)
+    origin_time = (event.preferred_origin() or event.origins[0]).time
+    start, end = config.regions[raspberry.region]["filt-time-range"]
+    bulk = [("S", code, "*", "EH*", origin_time + start, origin_time + end)
+            for code in raspberry.get_station_index().codes.get("S", [])]
+    sed_station = raspberry.get_sed_station()
+    if sed_station:
+        bulk.append(("CH", sed_station, "*", "HH*", origin_time + start, origin_time + end))
+    stream = get_client("ETH").get_waveforms_bulk(bulk)
+    stream.write(os.path.join(directory, "waveforms.mseed"), format="MSEED")
+    return event
+
+
+def record_synthetic(raspberry, directory):
+    """ Write a synthetic catalog of the region; the rest is synthesized by the stand-in """
+    catalog = synthetic_catalog(raspberry.year, region_boxes[raspberry.region],
+                                min_mag=float(raspberry.min_mag))
+    catalog.write(os.path.join(directory, "events.xml"), format="QUAKEML")
+    return largest_event(catalog)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--region", default="worldwide", choices=config.regions.keys())
+    parser.add_argument("--year", type=int, default=UTCDateTime().year - 1)
+    parser.add_argument("--station", default=config.rs_sta_list[0][0],
+                        help="RaspberryShake station of the single-station scenarios")
+    parser.add_argument("--source", default="live", choices=["live", "synthetic"])
+    parser.add_argument("--output", default=fixtures_dir)
+    args = parser.parse_args()
+
+    directory = os.path.join(args.output, args.region)
+    os.makedirs(directory, exist_ok=True)
+    for name in ("stations.xml", "events.xml", "waveforms.mseed"):
+        if os.path.exists(os.path.join(directory, name)):
+            os.remove(os.path.join(directory, name))
+
+    raspberry = HeadlessRaspberryShake(args.region, args.year)
+    if args.source == "live":
+        event = record_live(raspberry, directory, args.station)
+    else:
+        event = record_synthetic(raspberry, directory)
+
+    with open(os.path.join(directory, "fixture.json"), "w") as f:
+        json.dump({"region": args.region, "year": args.year, "station": args.station,
+                   "event": str(event.resource_id), "min_mag": raspberry.min_mag,
+                   "source": args.source, "recorded": str(UTCDateTime())}, f, indent=1)
+    print(f"Fixtures of {args.region} written to {directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the entry points of the GUI: setup_gui (also on warm
+caches with a full size inventory, setup_gui_warm), query_stations,
+query_web_services, seismogram_plot, plot_all_seismograms, plot_map and
+plot_ray_paths, for every region profile. All web services are served by
+the local FDSN stand-in from the recorded fixtures of the region
+(benchmarks/fixtures/<region>, see record_fixtures.py) or from synthetic
+data, with configurable latency and failure injection.
+
+Every scenario reports the wall time and CPU time of each repetition, and
+the peak of the traced Python/NumPy memory in one extra run. By default
+each repetition starts with empty caches (in a temporary directory); with
+--warm the caches are kept between the repetitions. The travel-time table
+is shared (build it first with python -m codebase.traveltimes).
+
+The results are written as JSON and can be compared between versions with
+compare_results.py:
+
+    python benchmarks/suite.py --regions switzerland,europe --repeat 3
+    python benchmarks/compare_results.py results/old.json results/new.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Absolute path, as the scenarios run in a temporary working directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from codebase import config
+from codebase.availability import availability_index
+from codebase.basemap import basemap_cache
+from codebase.batch import HeadlessRaspberryShake
+from codebase.catalogcache import catalog_cache, event_magnitude
+from codebase.clients import client_manager
+from codebase.inventorycache import inventory_cache
+from codebase.responsecache import response_cache
+from codebase.routing import routing_table
+from codebase.singleflight import single_flight
+from codebase.waveformcache import waveform_cache
+from benchmarks.fdsn_standin import (FDSNStandIn, default_stations, realistic_stations,
+                                     synthetic_inventory)
+from benchmarks.record_fixtures import fixtures_dir
+
+results_dir = os.path.join(os.path.dirname(__file__), "results")
+
+
+def _plot(module, function):
+    """ Scenario calling a plotting function of a codebase module """
+    def run(raspberry):
+        import importlib
+        getattr(importlib.import_module(f"codebase.{module}"), function)(raspberry)
+    return run
+
+
+def _select_event(raspberry, fixture):
+    """ Load the inventory and select the event of the fixture """
+    raspberry.query_stations()
+    catalog = raspberry.fetch_catalog()
+    events = [event for event in catalog if str(event.resource_id) == fixture["event"]]
+    raspberry.select(event=events[0] if events else max(catalog, key=event_magnitude))
+
+
+def _fill_caches(raspberry, fixture):
+    """
+    Store a fresh inventory of the size of the full CH and S inventories at
+    the RESP level (three epochs per channel, FIR stages) and the catalog,
+    as after an earlier start
+    """
+    bands = {"CH": "HH", "S": "EH"}
+    inventory_cache._write({
+        network: synthetic_inventory([(network, code, bands[network] + component)
+                                      for code in codes for component in "ZNE"],
+                                     "response", epochs=3, full_responses=True)
+        for network, codes in realistic_stations().items()})
+    raspberry.fetch_catalog()
+
+
+# Scenarios: name -> (preparation or None, function)
+scenarios = {
+    "setup_gui": (None, lambda raspberry: raspberry.setup_gui()),
+    "setup_gui_warm": (_fill_caches, lambda raspberry: raspberry.setup_gui()),
+    "query_stations": (None, lambda raspberry: raspberry.query_stations()),
+    "query_web_services": (None, lambda raspberry: raspberry.query_web_services()),
+    "seismogram_plot": (_select_event, _plot("seisplot", "seismogram_plot")),
+    "plot_all_seismograms": (_select_event, _plot("seisallplot", "plot_all_seismograms")),
+    "plot_map": (_select_event, _plot("mapplot", "plot_map")),
+    "plot_ray_paths": (_select_event, _plot("raypathplot", "plot_ray_paths")),
+}
+
+
+def load_fixture(directory, region):
+    """ Return the fixture description of the region (year, event, station) """
+    try:
+        with open(os.path.join(directory, "fixture.json")) as f:
+            return json.load(f)
+    except OSError:
+        return {"region": region, "year": 2024, "station": config.rs_sta_list[0][0],
+                "event": None, "source": "synthetic (no fixtures)"}
+
+
+def reset_caches(directory):
+    """ Point all caches to an empty directory and forget the in-memory state """
+    inventory_cache.filename = os.path.join(directory, "inventory.json")
+    catalog_cache.directory = os.path.join(directory, "catalogs")
+    catalog_cache._catalogs.clear()
+    waveform_cache.directory = os.path.join(directory, "waveforms")
+    waveform_cache._index = None
+    waveform_cache._index_stat = None
+    basemap_cache.directory = os.path.join(directory, "basemaps")
+    basemap_cache._basemaps.clear()
+    response_cache.clear()
+    routing_table.clear_no_data()
+    availability_index.filename = os.path.join(directory, "availability.json")
+    availability_index.reload()
+    client_manager.service_cache.filename = os.path.join(directory, "fdsn_services.json")
+    client_manager.clear()
+    single_flight.directory = os.path.join(directory, "inflight")
+    single_flight.clear()
+
+
+def new_raspberry(fixture, prepare):
+    """ Headless GUI object of the fixture, prepared with prepare(raspberry, fixture) """
+    raspberry = HeadlessRaspberryShake(fixture["region"], fixture["year"],
+                                       fixture.get("min_mag"))
+    raspberry.select(station=fixture["station"])
+    if prepare is not None:
+        prepare(raspberry, fixture)
+    return raspberry
+
+
+def measure(func, trace_memory=False):
+    """ Run func and return the wall time, CPU time, traced peak memory and error """
+    if trace_memory:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    plt.close('all')
+    return wall, cpu, peak, error
+
+
+def run_scenario(name, fixture, server, repeat, warm, workdir):
+    """ Run one scenario repeat times plus once with memory tracing """
+    prepare, func = scenarios[name]
+    result = {"region": fixture["region"], "scenario": name, "wall": [], "cpu": [],
+              "peak_memory": None, "requests": 0, "errors": []}
+    for run in range(repeat + 1):
+        trace_memory = run == repeat
+        if not warm or run == 0:
+            reset_caches(tempfile.mkdtemp(dir=workdir))
+        # The preparation is not timed and runs without failure injection
+        failure_rate, server.failure_rate = server.failure_rate, 0.0
+        try:
+            raspberry = new_raspberry(fixture, prepare)
+        finally:
+            server.failure_rate = failure_rate
+        requests = server.request_count
+        wall, cpu, peak, error = measure(lambda: func(raspberry), trace_memory)
+        if trace_memory:
+            result["peak_memory"] = peak
+        else:
+            result["wall"].append(wall)
+            result["cpu"].append(cpu)
+            result["requests"] = server.request_count - requests
+        if error and error not in result["errors"]:
+            result["errors"].append(error)
+    return result
+
+
+def git_commit():
+    """ Return the current commit of the repository, or None """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--regions", default=",".join(config.regions.keys()))
+    parser.add_argument("--scenarios", default=",".join(scenarios.keys()))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warm", action="store_true", help="keep the caches between repetitions")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="latency per request of the FDSN stand-in in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="fraction of the queries answered with HTTP 503")
+    parser.add_argument("--no-data", type=float, default=0.0,
+                        help="fraction of the seismo-at-school stations without waveforms")
+    parser.add_argument("--fixtures", default=fixtures_dir)
+    parser.add_argument("--output", default=None, help="JSON file of the results")
+    args = parser.parse_args()
+
+    fixtures = os.path.abspath(args.fixtures)
+    config.gui_async = False
+    config.use_prefetch = False
+    commit = git_commit()
+    sta_codes = default_stations()["S"]
+    no_data = [f"S.{code}" for code in sta_codes[:round(args.no_data * len(sta_codes))]]
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for region in args.regions.split(","):
+                directory = os.path.join(fixtures, region)
+                fixture = load_fixture(directory, region)
+                with FDSNStandIn(fixtures=directory, latency=args.latency,
+                                 failure_rate=args.failure_rate, no_data=no_data) as server:
+                    config.fdsn_servers["ETH"] = config.fdsn_servers["IRIS"] = server.url
+                    for name in args.scenarios.split(","):
+                        result = run_scenario(name, fixture, server, args.repeat,
+                                              args.warm, workdir)
+                        results.append(result)
+                        print(f"{region:12s} {name:22s} wall {statistics.median(result['wall']):7.3f} s  "
+                              f"cpu {statistics.median(result['cpu']):7.3f} s  "
+                              f"peak {result['peak_memory'] / 1024**2:8.1f} MiB  "
+                              f"{result['requests']:4d} requests"
+                              + (f"  errors: {'; '.join(result['errors'])}" if result["errors"] else ""))
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {"repeat": args.repeat, "warm": args.warm, "latency": args.latency,
+                    "failure_rate": args.failure_rate, "no_data": args.no_data},
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        results_dir, f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}_{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
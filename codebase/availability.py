@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Local index of the data availability of the stations, built from the
+earlier downloads and availability queries. The windows that returned no
+data are recorded per station, so that a station known to have no data
+for the window of an event is skipped before downloading, also in later
+sessions. A download that finds data removes the overlapping windows.
+As data can still arrive after an event (the stations upload with a
+delay), a no-data observation made shortly after the window expires after
+config.no_data_ttl seconds; observations made more than
+config.availability_settle_time seconds after the window are kept.
+
+The index file lives in the cache directory and may be shared by several
+processes: it is changed under a lock file and merged with the copy on
+disk.
+"""
+import json
+import os
+import threading
+import time
+from obspy import UTCDateTime
+from codebase import config
+from codebase.singleflight import file_lock
+
+
+class AvailabilityIndex:
+    """ Observed windows without data per station """
+    def __init__(self, filename):
+        self.filename = filename
+        self._stations = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _valid(self, observation, now):
+        start, end, observed = observation
+        return observed - end > config.availability_settle_time or \
+            now - observed <= config.no_data_ttl
+
+    def _load(self):
+        if self._stations is None:
+            self._stations = self._read()
+        return self._stations
+
+    def record(self, network, sta_codes, starttime, endtime, has_data):
+        """ Record that the stations had data (or none) in the window """
+        now = time.time()
+        start, end = UTCDateTime(starttime).timestamp, UTCDateTime(endtime).timestamp
+        with self._lock, file_lock(self.filename + ".lock"):
+            # Merge with the observations of the other processes
+            stations = self._read()
+            changed = False
+            for sta_code in sta_codes:
+                key = f"{network}.{sta_code}"
+                observations = [observation for observation in stations.get(key, [])
+                                if self._valid(observation, now) and
+                                not (has_data and observation[0] < end and observation[1] > start)
+                                and (observation[0], observation[1]) != (start, end)]
+                if not has_data:
+                    observations.append([start, end, now])
+                if observations != stations.get(key, []):
+                    changed = True
+                if observations:
+                    stations[key] = observations
+                else:
+                    stations.pop(key, None)
+            self._stations = stations
+            if not changed:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+                tmp_file = self.filename + f".{os.getpid()}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(stations, f)
+                os.replace(tmp_file, self.filename)
+            except OSError:
+                pass
+
+    def has_no_data(self, network, sta_code, starttime, endtime):
+        """ Return True if a valid observation without data covers the window """
+        now = time.time()
+        start, end = UTCDateTime(starttime).timestamp, UTCDateTime(endtime).timestamp
+        with self._lock:
+            observations = self._load().get(f"{network}.{sta_code}", [])
+        return any(obs_start <= start and obs_end >= end and
+                   self._valid((obs_start, obs_end, observed), now)
+                   for obs_start, obs_end, observed in observations)
+
+    def reload(self):
+        """ Read the observations of the other processes at the next lookup """
+        with self._lock:
+            self._stations = None
+
+    def clear(self):
+        with self._lock:
+            self._stations = None
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+
+
+# Index shared by all plots
+availability_index = AvailabilityIndex(config.availability_index_file)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the static background of the location map per region. The map
+features (stock image, borders, lakes, rivers, coastlines and gridlines)
+only depend on the region, so they are rendered once into a raster. The
+raster is kept in memory and stored on disk as PNG together with its
+projected extent, and plot_map only draws the event and the stations on
+top of it.
+"""
+import json
+import os
+import threading
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import matplotlib.image as mpimg
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from codebase import config
+
+# Size of the map figure in inches
+figsize = (11, 11)
+
+
+def region_projection(region):
+    """ Return the projection and the lon/lat extent of the map of the region """
+    if region == "switzerland":
+        return (ccrs.AlbersEqualArea(central_longitude=8.5, central_latitude=46.5),
+                (5.5, 11., 45.5, 48))
+    if region == "europe":
+        return ccrs.PlateCarree(), (45, -15, 70., 30)
+    return ccrs.PlateCarree(), (-180, 180., -90, 90)
+
+
+def add_static_features(ax, region):
+    """ Draw the map features that do not change between the clicks """
+    if region == "switzerland":
+        ax.add_feature(cfeature.BORDERS)
+        ax.add_feature(cfeature.LAKES, alpha=0.5)
+        ax.add_feature(cfeature.RIVERS)
+    else:
+        ax.stock_img()
+    ax.gridlines()
+    ax.coastlines()
+
+
+def render_basemap(region, dpi):
+    """
+    Render the static features of the region in a map figure of the same
+    layout as plot_map. Returns the RGBA raster of the axes area and its
+    extent in projected coordinates (x0, x1, y0, y1).
+    """
+    projection, extent = region_projection(region)
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, projection=projection)
+    ax.set_extent(extent)
+    add_static_features(ax, region)
+    ax.spines['geo'].set_visible(False)
+    canvas.draw()
+
+    # Cut the axes area out of the rendered figure (the buffer starts at the
+    # top while the window extent is measured from the bottom)
+    bbox = ax.get_window_extent()
+    height = canvas.buffer_rgba().shape[0]
+    x0, x1 = int(round(bbox.x0)), int(round(bbox.x1))
+    y0, y1 = height - int(round(bbox.y1)), height - int(round(bbox.y0))
+    image = np.array(canvas.buffer_rgba())[y0:y1, x0:x1]
+    return image, tuple(float(value) for value in ax.get_extent())
+
+
+class BasemapCache:
+    """ Rendered map backgrounds per region and resolution, in memory and on disk """
+    def __init__(self, directory):
+        self.directory = directory
+        self._basemaps = {}
+        self._lock = threading.Lock()
+
+    def _filename(self, region, dpi):
+        return os.path.join(self.directory, f"{region}_{dpi}dpi")
+
+    def _read(self, region, dpi):
+        """ Return the cached raster and extent from disk, or None """
+        filename = self._filename(region, dpi)
+        try:
+            with open(filename + ".json") as f:
+                meta = json.load(f)
+            image = (mpimg.imread(filename + ".png") * 255).round().astype(np.uint8)
+        except (OSError, ValueError):
+            return None
+        if meta.get("figsize") != list(figsize) or \
+                list(image.shape[:2]) != meta.get("shape"):
+            return None
+        return image, tuple(meta["extent"])
+
+    def _write(self, region, dpi, image, extent):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self._filename(region, dpi)
+        tmp_suffix = f".{os.getpid()}.tmp"
+        mpimg.imsave(filename + tmp_suffix + ".png", image)
+        os.replace(filename + tmp_suffix + ".png", filename + ".png")
+        with open(filename + tmp_suffix, "w") as f:
+            json.dump({"region": region, "figsize": list(figsize),
+                       "shape": list(image.shape[:2]), "extent": list(extent)}, f)
+        os.replace(filename + tmp_suffix, filename + ".json")
+
+    def get(self, region, dpi=None):
+        """ Return the raster and projected extent of the region's background """
+        dpi = dpi or config.plot_dpi
+        with self._lock:
+            key = (region, dpi)
+            if key not in self._basemaps:
+                basemap = self._read(region, dpi)
+                if basemap is None:
+                    basemap = render_basemap(region, dpi)
+                    try:
+                        self._write(region, dpi, *basemap)
+                    except OSError:
+                        pass
+                self._basemaps[key] = basemap
+            return self._basemaps[key]
+
+    def draw(self, ax, region, dpi=None):
+        """ Draw the cached background of the region on the map axes """
+        image, extent = self.get(region, dpi)
+        ax.imshow(image, origin='upper', extent=extent, transform=ax.projection,
+                  interpolation='nearest')
+        ax.set_extent(extent, crs=ax.projection)
+
+    def clear(self):
+        """ Remove all cached backgrounds from memory and disk """
+        with self._lock:
+            self._basemaps.clear()
+            for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+                os.remove(os.path.join(self.directory, name))
+
+
+# Cache instance shared by all maps
+basemap_cache = BasemapCache(config.basemap_cache_dir)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch engine that renders the plots of many earthquakes without
+the widgets. The plotting functions are driven by HeadlessRaspberryShake,
+which answers the same getters as the GUI from a fixed selection. Events
+are spread over a process pool with one event per worker.
+
+The products of every event are written to their own directory, named after
+the origin time and event id, so the output is deterministic. An event
+directory is only moved in place when all its products have been rendered
+(or have failed, see render_event), so an interrupted run can simply be
+restarted and skips the finished events.
+
+Command line, e.g. all M6+ earthquakes of 2024 for two stations:
+
+    python -m codebase.batch --year 2024 --region worldwide --min-mag 6.0 \\
+        --stations GBERN,KSSO --output products --workers 4
+
+or an event list from a QuakeML file:
+
+    python -m codebase.batch --quakeml events.xml --region europe --output products
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from obspy import read_events
+from codebase import config
+from codebase.gui import RaspberryShake, correct_region_key
+
+# Products rendered per event, and per station of the event
+event_products = ['section']
+station_products = ['map', 'seismogram', 'raypaths']
+
+
+class HeadlessRaspberryShake(RaspberryShake):
+    """
+    RaspberryShake with a fixed selection instead of widgets. The plotting
+    modules can be called with it exactly as with the GUI object.
+    """
+    def __init__(self, region, year=None, min_mag=None):
+        super().__init__()
+        self.region = correct_region_key(region)
+        self.year = year
+        self.min_mag = min_mag if min_mag is not None else config.regions[self.region]['magnitudes'][0]
+        self.event = None
+        self.station = None
+
+    def select(self, event=None, station=None):
+        """ Set the selected earthquake and RaspberryShake station code """
+        if event is not None:
+            self.event = event
+        if station is not None:
+            self.station = station
+
+    def get_selected_region(self):
+        return self.region
+
+    def get_selected_year(self):
+        return self.year
+
+    def get_selected_min_mag(self):
+        return self.min_mag
+
+    def get_selected_station(self):
+        for station in self.stations:
+            if station[0] == self.station:
+                return station[3]
+        return self.station or ""
+
+    def get_selected_earthquake(self):
+        return str(self.event.resource_id) if self.event is not None else None
+
+    def get_earthquake_quakeml(self):
+        return self.event
+
+
+def event_directory_name(event):
+    """ Deterministic directory name of an event: origin time and id hash """
+    origin = event.preferred_origin() or event.origins[0]
+    digest = hashlib.sha1(str(event.resource_id).encode()).hexdigest()[:8]
+    return f"{origin.time.strftime('%Y%m%dT%H%M%S')}_{digest}"
+
+
+# State of a worker process
+_worker = {}
+
+
+def _init_worker(region):
+    """ Load the inventory once per worker process """
+    import matplotlib
+    matplotlib.use("Agg")
+    config.gui_async = False
+    config.use_prefetch = False
+    raspberry = HeadlessRaspberryShake(region)
+    raspberry.query_stations()
+    _worker['raspberry'] = raspberry
+
+
+def _render(func, raspberry, directory):
+    """
+    Run a plotting function with its figures saved in directory. Returns the
+    new files, or the error of the plot as "<type>: <message>".
+    """
+    before = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+    try:
+        func(raspberry, directory=directory)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    after = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+    return sorted(after - before)
+
+
+def render_event(event, station_codes, output_dir, products=None, raspberry=None):
+    """
+    Render the products of one event into output_dir/<event directory>.
+    Returns the event directory. Events whose directory exists are skipped.
+
+    A product that fails or writes no file (e.g. no data) does not stop the
+    event: products.json lists the rendered products with their files, and
+    the failed and empty products separately, so that the event is not
+    rendered again on the next run.
+    """
+    from codebase import mapplot, raypathplot, seisallplot, seisplot
+
+    products = products or event_products + station_products
+    raspberry = raspberry or _worker['raspberry']
+    raspberry.select(event=event)
+
+    directory = os.path.join(output_dir, event_directory_name(event))
+    if os.path.exists(os.path.join(directory, "products.json")):
+        return directory
+
+    partial = directory + ".partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    rendered, empty, failed = {}, [], {}
+
+    def render(product, func, path):
+        result = _render(func, raspberry, os.path.join(partial, path))
+        name = product if path == "" else f"{path}/{product}"
+        if isinstance(result, str):
+            failed[name] = result
+        elif result:
+            rendered[name] = [os.path.join(path, filename) for filename in result]
+        else:
+            empty.append(name)
+
+    if 'section' in products:
+        render('section', seisallplot.plot_all_seismograms, "")
+
+    plots = {'map': mapplot.plot_map, 'seismogram': seisplot.seismogram_plot,
+             'raypaths': raypathplot.plot_ray_paths}
+    for sta_code in station_codes:
+        raspberry.select(station=sta_code)
+        for product in station_products:
+            if product in products:
+                render(product, plots[product], sta_code)
+
+    with open(os.path.join(partial, "products.json"), "w") as f:
+        json.dump({"event": str(event.resource_id), "region": raspberry.region,
+                   "stations": list(station_codes), "products": rendered,
+                   "empty": empty, "failed": failed}, f, indent=1)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(partial, directory)
+    return directory
+
+
+def _render_worker(event, station_codes, output_dir, products):
+    return render_event(event, station_codes, output_dir, products)
+
+
+def render_events(events, region, station_codes, output_dir, products=None, workers=None):
+    """
+    Render the products of all events in a process pool, one event per
+    worker. Finished events are skipped. Returns the list of directories.
+    """
+    events = sorted(events, key=lambda event: (event.preferred_origin() or event.origins[0]).time)
+    todo = [event for event in events if not os.path.exists(
+        os.path.join(output_dir, event_directory_name(event), "products.json"))]
+    print(f"{len(events)} events, {len(events) - len(todo)} already rendered")
+
+    directories = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(region,)) as executor:
+        futures = {executor.submit(_render_worker, event, station_codes, output_dir,
+                                   products): event for event in todo}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            try:
+                directories.append(future.result())
+                with open(os.path.join(directories[-1], "products.json")) as f:
+                    summary = json.load(f)
+                status = f"done, {len(summary['products'])} products"
+                if summary["empty"]:
+                    status += f", {len(summary['empty'])} without data"
+                if summary["failed"]:
+                    status += f", {len(summary['failed'])} failed"
+            except Exception as e:
+                status = f"failed: {e}"
+            print(f"[{n_done}/{len(todo)}] {event_directory_name(futures[future])} {status}")
+    return directories
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render the seismogram, section, map and ray-path plots of many events.")
+    events = parser.add_mutually_exclusive_group(required=True)
+    events.add_argument("--quakeml", help="QuakeML file with the events")
+    events.add_argument("--year", type=int, help="query the events of this year")
+    parser.add_argument("--region", default="worldwide",
+                        help="region profile of config.regions (also selects the server)")
+    parser.add_argument("--min-mag", help="minimum magnitude for the query")
+    parser.add_argument("--stations", default=None,
+                        help="comma separated RaspberryShake codes (default: all)")
+    parser.add_argument("--products", default=",".join(event_products + station_products),
+                        help="comma separated products: " + ", ".join(event_products + station_products))
+    parser.add_argument("--output", default="products", help="output directory")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    args = parser.parse_args(argv)
+
+    region = correct_region_key(args.region)
+    if args.quakeml:
+        catalog = read_events(args.quakeml)
+    else:
+        catalog = HeadlessRaspberryShake(region, args.year, args.min_mag).fetch_catalog()
+
+    if args.stations:
+        station_codes = [code.strip() for code in args.stations.split(",")]
+    else:
+        station_codes = [station[0] for station in config.rs_sta_list]
+
+    os.makedirs(args.output, exist_ok=True)
+    render_events(list(catalog), region, station_codes, os.path.abspath(args.output),
+                  products=args.products.split(","), workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
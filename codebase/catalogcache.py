@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the yearly event catalogs queried by
+RaspberryShake.query_web_services. A catalog is fetched once per server,
+year and region at the lowest magnitude offered for the region, and any
+higher minimum magnitude is filtered locally. Catalogs of past years do
+not change anymore and are kept on disk permanently as QuakeML. The catalog of the
+current year is refreshed incrementally by fetching only the events after
+the last cached origin time. Identical queries of processes sharing the
+cache directory are sent only once (see singleflight); the other processes
+read the fetched events from a QuakeML file.
+"""
+import os
+import threading
+import time
+from obspy import Catalog, UTCDateTime, read_events
+from obspy.clients.fdsn.header import FDSNNoDataException
+from codebase import config
+from codebase.clients import get_client
+from codebase.singleflight import single_flight
+
+
+def event_magnitude(event):
+    """ Return the magnitude of the event used for the filtering """
+    magnitude = event.preferred_magnitude() or event.magnitudes[0]
+    return magnitude.mag
+
+
+def event_time(event):
+    """ Return the origin time of the event """
+    origin = event.preferred_origin() or event.origins[0]
+    return origin.time
+
+
+def _write_catalog(filename, catalog):
+    """ Write the catalog as QuakeML, replacing the file atomically """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_file = filename + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    catalog.write(tmp_file, format="QUAKEML")
+    os.replace(tmp_file, filename)
+
+
+class CatalogCache:
+    """ Yearly catalogs per server and region, on disk for the past years """
+    def __init__(self, directory, refresh_interval):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self._catalogs = {}
+        self._lock = threading.Lock()
+
+    def _filename(self, server, year, region):
+        server = server.replace("://", "_").replace("/", "_").replace(":", "_")
+        return os.path.join(self.directory, f"{server}_{year}_{region}.xml")
+
+    def _read(self, filename):
+        """ Return the entry stored on disk (complete past year) or None """
+        try:
+            return {"catalog": read_events(filename, format="QUAKEML"),
+                    "fetched_at": os.path.getmtime(filename), "complete": True}
+        except Exception:
+            return None
+
+    def _write(self, filename, entry):
+        _write_catalog(filename, entry["catalog"])
+
+    @staticmethod
+    def _fetch(server, starttime, endtime, min_mag, query):
+        """ Query the event service; an empty result gives an empty catalog """
+        key = ("events", config.fdsn_servers.get(server, server), str(starttime),
+               str(endtime), min_mag, tuple(sorted(query.items())))
+        # The events are passed to the waiting processes in a file named
+        # after the key
+        filename = single_flight.data_path(key, ".xml")
+        fetched = []
+
+        def _query():
+            try:
+                catalog = get_client(server).get_events(starttime=starttime, endtime=endtime,
+                                                         minmagnitude=min_mag, **query)
+            except FDSNNoDataException:
+                catalog = Catalog()
+            fetched.append(catalog)
+            if config.use_single_flight:
+                try:
+                    _write_catalog(filename, catalog)
+                except OSError:
+                    pass
+
+        single_flight.run(key, _query)
+        if fetched:
+            return fetched[0]
+        try:
+            return read_events(filename, format="QUAKEML")
+        except Exception:
+            _query()
+            return fetched[0]
+
+    def get_events(self, server, year, region, min_mag, **query):
+        """
+        Return the events of the year with a magnitude of at least ``min_mag``
+        from the given server ('ETH' or 'IRIS', see config.fdsn_servers).
+        ``query`` holds the additional query parameters of the region (e.g.
+        the latitude/longitude box) and must not change for a given region.
+        """
+        year = int(year)
+        region = region.lower()
+        base_mag = min(float(mag) for mag in config.regions[region]['magnitudes'])
+        start = UTCDateTime(f"{year}-01-01T00:00:00")
+        end = UTCDateTime(f"{year}-12-31T23:59:59")
+        filename = self._filename(server, year, region)
+        key = (server, year, region)
+        is_past_year = year < UTCDateTime().year
+
+        # The lock only guards the entries: the fetches run outside of it (so
+        # that a slow query does not block the lookups of other years) and
+        # identical fetches are coalesced by single_flight
+        with self._lock:
+            entry = self._catalogs.get(key)
+        if entry is None:
+            entry = self._read(filename)
+
+        if entry is None:
+            # First query of the year: fetch at the lowest magnitude of the region
+            catalog = self._fetch(server, start, end, base_mag, query)
+            entry = {"catalog": catalog, "fetched_at": time.time(), "complete": is_past_year}
+            if is_past_year:
+                self._write(filename, entry)
+
+        elif (is_past_year and not entry.get("complete")) or \
+                (not is_past_year and time.time() - entry["fetched_at"] > self.refresh_interval):
+            # Current year, or a year that has ended since it was cached: only
+            # the events after the last cached origin time
+            catalog = entry["catalog"]
+            last_time = max((event_time(event) for event in catalog), default=start)
+            try:
+                new_events = self._fetch(server, last_time, end, base_mag, query)
+            except Exception:
+                if is_past_year:
+                    raise
+                new_events = Catalog()
+            known = {str(event.resource_id) for event in catalog}
+            events = [event for event in new_events if str(event.resource_id) not in known]
+            events += list(catalog)
+            events.sort(key=event_time, reverse=True)
+            entry = {"catalog": Catalog(events=events), "fetched_at": time.time(),
+                     "complete": is_past_year}
+            if is_past_year:
+                self._write(filename, entry)
+
+        with self._lock:
+            current = self._catalogs.get(key)
+            if current is None or current["fetched_at"] <= entry["fetched_at"]:
+                self._catalogs[key] = entry
+
+        min_mag = float(min_mag)
+        return Catalog(events=[event for event in entry["catalog"]
+                               if event_magnitude(event) >= min_mag])
+
+    def clear(self):
+        """ Forget all catalogs, including the ones on disk """
+        with self._lock:
+            self._catalogs.clear()
+            if os.path.isdir(self.directory):
+                for filename in os.listdir(self.directory):
+                    if filename.endswith(".xml"):
+                        os.remove(os.path.join(self.directory, filename))
+
+
+# Cache shared by all RaspberryShake instances
+catalog_cache = CatalogCache(config.catalog_cache_dir, config.catalog_refresh_interval)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Shared FDSN clients. Constructing an obspy Client discovers the services
+of the provider with several HTTP requests, and every request opens a new
+connection. The client manager creates one client per provider and
+timeout and shares it between all threads. Its requests go through one
+keep-alive connection pool (a requests Session) and are retried with
+exponential backoff on connection errors and temporary server errors
+(429, 500, 502, 503, 504). The discovered services are kept on disk, so a
+new process or batch worker does not discover them again.
+
+PooledClient overrides private methods of the obspy Client. Their
+signatures are checked at import; if a newer obspy changed them, plain
+obspy clients are used instead (without the shared pool, the retries and
+the service cache).
+"""
+import copy
+import inspect
+import io
+import json
+import os
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from obspy import UTCDateTime
+from obspy.clients.fdsn import Client
+from obspy.clients.fdsn.client import raise_on_error
+from codebase import config
+
+# HTTP status codes that are worth another attempt
+retry_status_codes = {429, 500, 502, 503, 504}
+
+# Parameters of the private methods of the obspy Client overridden by
+# PooledClient, as in the obspy versions it was written for (1.4, 1.5)
+_overridden_methods = {
+    "_discover_services": ["self"],
+    "_download": ["self", "url", "return_string", "data", "use_gzip", "content_type"],
+}
+
+
+def _overrides_match():
+    """ Return True if the overridden methods of the obspy Client are unchanged """
+    for name, parameters in _overridden_methods.items():
+        try:
+            signature = inspect.signature(getattr(Client, name))
+        except (AttributeError, TypeError, ValueError):
+            return False
+        if list(signature.parameters) != parameters:
+            return False
+    return True
+
+
+use_pooled_clients = _overrides_match()
+if not use_pooled_clients:
+    print("The private methods of the obspy FDSN Client have changed; using plain "
+          "clients without connection pool, retries and service cache.", file=sys.stderr)
+
+
+# Parameter types of the discovered services (see obspy's WADLParser)
+_parameter_types = {cls.__name__: cls for cls in (str, float, int, bool, UTCDateTime)}
+
+
+def _encode_services(value):
+    """ JSON encoding of the parameter types and times of the services """
+    if isinstance(value, type) and _parameter_types.get(value.__name__) is value:
+        return {"__type__": value.__name__}
+    if isinstance(value, UTCDateTime):
+        return {"__time__": str(value)}
+    raise TypeError(f"Cannot store {value!r} in the service cache")
+
+
+def _decode_services(value):
+    if "__type__" in value:
+        return _parameter_types[value["__type__"]]
+    if "__time__" in value:
+        return UTCDateTime(value["__time__"])
+    return value
+
+
+class ServiceCache:
+    """ Services of the FDSN providers in a JSON file, with a time-to-live """
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def _read(self):
+        """ Return the entries by the JSON encoded provider key """
+        try:
+            with open(self.filename) as f:
+                return json.load(f, object_hook=_decode_services)
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def _write(self, entries):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp_file = self.filename + f".{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(entries, f, default=_encode_services)
+            os.replace(tmp_file, self.filename)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def get(self, key):
+        """ Return the cached services of the provider or None """
+        with self._lock:
+            entry = self._read().get(json.dumps(key))
+        if entry is None or time.time() - entry["timestamp"] > self.ttl:
+            return None
+        return entry["services"]
+
+    def put(self, key, services):
+        with self._lock:
+            entries = self._read()
+            entries[json.dumps(key)] = {"timestamp": time.time(), "services": services}
+            try:
+                self._write(entries)
+            except (OSError, TypeError, ValueError):
+                pass
+
+    def clear(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+def request(session, url, headers, data=None, timeout=None):
+    """
+    GET (or POST with data) the URL with retries. Returns the HTTP status
+    code and the content, or None and the exception after the last attempt.
+    """
+    for attempt in range(config.request_retries + 1):
+        try:
+            if data is None:
+                response = session.get(url, headers=headers, timeout=timeout)
+            else:
+                response = session.post(url, headers=headers, data=data, timeout=timeout)
+            code, content = response.status_code, response.content
+        except requests.Timeout as e:
+            # A timeout is not retried, the caller waited long enough
+            return None, e
+        except requests.RequestException as e:
+            code, content = None, e
+        if code is not None and code not in retry_status_codes:
+            return code, content
+        if attempt < config.request_retries:
+            time.sleep(config.request_backoff * 2 ** attempt)
+    return code, content
+
+
+class PooledClient(Client):
+    """
+    obspy FDSN client whose requests share the connection pool of the
+    client manager and are retried, and whose discovered services are
+    cached on disk.
+    """
+    def __init__(self, base_url, session, service_cache, timeout=None):
+        self.session = session
+        self.service_cache = service_cache
+        super().__init__(base_url, timeout=timeout or config.download_timeout)
+
+    def _discover_services(self):
+        key = (self.base_url, self.url_subpath, tuple(sorted(self._service_mappings.items())))
+        services = self.service_cache.get(key)
+        if services is not None:
+            self.services = copy.deepcopy(services)
+            return
+        super()._discover_services()
+        self.service_cache.put(key, self.services)
+
+    def _download(self, url, return_string=False, data=None, use_gzip=None,
+                  content_type=None):
+        # Authenticated requests need the url opener of obspy
+        if self.user is not None:
+            return super()._download(url, return_string, data, use_gzip, content_type)
+        if use_gzip is None:
+            use_gzip = self.use_gzip
+        headers = self.request_headers.copy()
+        headers["Accept-Encoding"] = "gzip" if use_gzip else "identity"
+        if content_type:
+            headers["Content-Type"] = content_type
+        code, content = request(self.session, url, headers, data, self.timeout)
+        raise_on_error(code, io.BytesIO(content) if code is not None else content)
+        return content if return_string else io.BytesIO(content)
+
+
+class ClientManager:
+    """ One shared client per FDSN provider and timeout """
+    def __init__(self, service_cache):
+        self.service_cache = service_cache
+        self._clients = {}
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """ HTTP session with the keep-alive connection pool of all clients """
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4,
+                                  pool_maxsize=max(config.download_workers, 10))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def get(self, server, timeout=None):
+        """
+        Return the client of the server, a key of config.fdsn_servers (or a
+        provider name or URL accepted by the obspy Client)
+        """
+        base_url = config.fdsn_servers.get(server, server)
+        timeout = timeout or config.download_timeout
+        with self._lock:
+            key = (base_url, timeout)
+            if key not in self._clients:
+                if use_pooled_clients:
+                    self._clients[key] = PooledClient(base_url, self.session,
+                                                      self.service_cache, timeout)
+                else:
+                    self._clients[key] = Client(base_url, timeout=timeout)
+            return self._clients[key]
+
+    def clear(self):
+        """ Forget the clients and close the connections """
+        with self._lock:
+            self._clients.clear()
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+# Clients shared by all modules
+client_manager = ClientManager(ServiceCache(config.service_cache_file, config.service_cache_ttl))
+
+
+def get_client(server="ETH", timeout=None):
+    """ Return the shared client of the server """
+    return client_manager.get(server, timeout)
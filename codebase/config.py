@@ -2,6 +2,7 @@
 """ 
 Configuration file for the codebase package 
 """
+import os
 from obspy.taup import TauPyModel
 
 # Seismic wave velocities:
@@ -11,22 +12,151 @@ vs = 3.4 # km/s S-Welle
 # Model for predicting phase arrivals
 model = TauPyModel(model="iasp91")
 
-# Parameters per region scale
+# Resolution of the saved figures. Long traces are reduced to a min/max
+# pair per pixel column before plotting (plot_envelope).
+plot_dpi = 200
+plot_envelope = True
+
+# FDSN web service providers. The values are passed to the obspy Client and
+# can be replaced by a base URL, e.g. "http://localhost:8080" for a local mirror.
+fdsn_servers = {"ETH": "ETH", "IRIS": "IRIS"}
+
+# Shared FDSN clients: requests that fail with a connection error or a
+# temporary server error (HTTP 429, 5xx) are retried request_retries times,
+# after request_backoff, 2 * request_backoff, ... seconds. The services
+# discovered for every provider are kept on disk for service_cache_ttl.
+request_retries = 3
+request_backoff = 0.5  # s
+service_cache_ttl = 7 * 24 * 3600  # s
+
+# Sources of the waveforms, tried in this order for every station window:
+# ("sds", <directory>) for a local SDS miniSEED archive and ("fdsn", <key of
+# fdsn_servers>) for a web service, e.g. [("sds", "/data/sds"), ("fdsn", "ETH")]
+waveform_sources = [("fdsn", "ETH")]
+# StationXML file with the responses of the archived channels. None takes
+# them from the inventory loaded by the GUI.
+sds_inventory = None
+
+# Timing of the stages of the queries and plots: a summary table after every
+# query or plot, and the spans as JSON and Chrome trace in timing_dir (None
+# for the working directory)
+use_timing = False
+timing_dir = None
+
+# Concurrent waveform downloads for the "All seismograms" section plot
+download_workers = 8   # maximum number of simultaneous requests
+download_timeout = 30  # s, timeout for a single request
+
+# Bulk download: one dataselect request per network (split into chunks of
+# at most bulk_chunk_size stations, fewer for long windows under the
+# section_memory_limit) instead of one request per station
+use_bulk_download = True
+bulk_chunk_size = 50
+
+# Time in s for which a station window without data is not requested again
+no_data_ttl = 3600
+
+# Data-availability pre-check of the section plot: stations without data
+# for the event window are skipped before downloading. They are known from
+# the earlier downloads (availability_index_file) and from one query per
+# network to the FDSN availability service. The service is updated with a
+# delay, so the stations it lists without data are only skipped for windows
+# that ended more than availability_service_delay seconds ago.
+use_availability_check = True
+use_availability_service = True
+availability_service_delay = 6 * 3600  # s
+# No-data observations made this long after the window are kept for good
+availability_settle_time = 24 * 3600  # s
+
+# GUI: run the queries and plots in the background, and wait gui_debounce
+# seconds after the last change of the year/region/magnitude before querying
+gui_async = True
+gui_debounce = 0.3  # s
+
+# Speculative prefetch of the waveforms of the selected earthquake
+use_prefetch = True
+prefetch_workers = 1      # downloads at a time, to leave bandwidth for the plots
+prefetch_cache_size = 8   # number of prefetched streams kept in memory
+
+# Local directory for all caches of the package. Point SEISMO_AT_SCHOOL_CACHE
+# of all kernels (e.g. of a JupyterHub) to one directory to share the caches.
+cache_dir = os.environ.get("SEISMO_AT_SCHOOL_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache", "seismo_at_school"))
+
+# Identical web service requests of all processes sharing cache_dir are sent
+# only once: the others wait up to single_flight_timeout seconds for the
+# first one and reuse its result for single_flight_ttl seconds
+use_single_flight = True
+single_flight_dir = os.path.join(cache_dir, "inflight")
+single_flight_ttl = 60  # s
+single_flight_timeout = 120  # s
+single_flight_prune_interval = 600  # s, expired results and lock files are removed
+
+# On-disk cache of the station inventories. An expired inventory is still
+# used while a new one is downloaded in the background.
+inventory_cache_file = os.path.join(cache_dir, "inventory.json")
+inventory_cache_ttl = 24 * 3600  # s
+
+# Observed data availability of the stations (see use_availability_check)
+availability_index_file = os.path.join(cache_dir, "availability.json")
+
+# Discovered services of the FDSN providers (see request_retries)
+service_cache_file = os.path.join(cache_dir, "fdsn_services.json")
+
+# Cache of the yearly event catalogs. Past years are stored on disk, the
+# current year is refreshed at most every catalog_refresh_interval seconds.
+catalog_cache_dir = os.path.join(cache_dir, "catalogs")
+catalog_refresh_interval = 300  # s
+
+# Pre-rendered backgrounds of the location map per region (features,
+# coastlines and gridlines), kept in memory and on disk
+use_basemap_cache = True
+basemap_cache_dir = os.path.join(cache_dir, "basemaps")
+
+# On-disk cache of the downloaded waveforms (miniSEED and responses)
+use_waveform_cache = True
+waveform_cache_dir = os.path.join(cache_dir, "waveforms")
+waveform_cache_size = 1024**3  # bytes, least recently used windows are evicted
+waveform_cache_access_interval = 60  # s, the access times of cache hits are written in batches
+
+# Memory limit of the cache of the evaluated response spectra
+response_cache_size = 256 * 1024**2  # bytes, least recently used spectra are evicted
+
+# Maximum number of traces processed together as one 2-D array for the
+# section plot (limits the memory of the batched filter and FFT)
+section_batch_size = 32
+
+# Memory budget of the section plot. The stations are downloaded in groups
+# whose streams need about half of section_memory_limit, and the processing
+# batches are limited to the other half. With
+# use_trace_store, the processed samples are kept in a memory-mapped file in
+# trace_store_dir (None for the temporary directory) instead of the heap,
+# and the raw streams are released as soon as their trace is processed.
+section_memory_limit = 256 * 1024**2  # bytes, None for no limit
+use_trace_store = True
+trace_store_dir = None
+
+# Parameters per region scale. The waveforms are decimated after the
+# bandpass filter to 'sampling-rate' (Hz, about five times the upper corner
+# frequency). None keeps the recorded sample rate.
 regions = {
     "worldwide": {'distance': 9000, 
                   'magnitudes': ['6.0','6.5','7.0'],
                   'filt-freq-range': (0.1, 0.8),
-                  'filt-time-range': (0, 80*60)
+                  'filt-time-range': (0, 80*60),
+                  'sampling-rate': 4.0
                   },
     "europe": {'distance': 6000, 
                 'magnitudes': ['4.0','5.0','6.0'],
                'filt-freq-range': (0.7, 2.0),
-               'filt-time-range': (0, 10*60)
+               'filt-time-range': (0, 10*60),
+               'sampling-rate': 10.0
                },
     "switzerland": {'distance': 200, 
                     'magnitudes': ['2.0','2.5','3.5','4.0'],
                     'filt-freq-range': (2.0, 20.0),
-                    'filt-time-range': (0, 1.5*60)
+                    'filt-time-range': (0, 1.5*60),
+                    'sampling-rate': None
                     }
 }
 
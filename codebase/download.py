@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent download of the waveforms of many stations. The requests are
+almost entirely network wait, so they are run in a bounded thread pool
+and the results are handed back to the caller for processing. The bulk
+mode combines the stations of a network into a few requests to the
+waveform sources. The availability check before the downloads leaves out
+the stations that have no data for the window. With a component, only
+its channels are requested (e.g. EHZ instead of EH*), and the bulk chunks
+are sized to the memory budget of the section plot.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from obspy import Stream
+from codebase import config, waveformsource
+from codebase.seisplot import get_waveforms
+from codebase.waveformcache import waveform_cache
+from codebase.routing import component_channels, routing_table
+from codebase.availability import availability_index
+from codebase.singleflight import single_flight
+from codebase.timing import propagate, span
+
+# Channels requested for each network
+network_channels = {"S": "EH*", "CH": "HH*"}
+
+# Highest sampling rate of the channels of each network (Hz), for the memory
+# estimate of the downloads
+network_sampling_rates = {"S": 100.0, "CH": 200.0}
+
+# Bytes held per sample of a download: the miniSEED records and the decoded
+# samples, with some margin
+download_bytes_per_sample = 8
+
+
+def station_group_size(network, timewindow_start, timewindow_end, component=None):
+    """
+    Return the number of stations of the network whose downloaded streams
+    fit into half of config.section_memory_limit (the other half is left to
+    the processing, see processing.process_section), or None without limit
+    """
+    if not config.section_memory_limit:
+        return None
+    components = 1 if component else 3
+    station_bytes = components * (timewindow_end - timewindow_start + 120) * \
+        network_sampling_rates.get(network, 200.0) * download_bytes_per_sample
+    return max(1, int(config.section_memory_limit / 2 // station_bytes))
+
+
+def _get_station_waveforms(origin_time, timewindow_start, timewindow_end, sta_code, timeout,
+                           component):
+    """ get_waveforms of one station as span of its own """
+    with span("station", station=sta_code):
+        return get_waveforms(origin_time, timewindow_start, timewindow_end, sta_code, timeout,
+                             component)
+
+
+def _component(stream, component):
+    """ Only the traces of the component if given, to release the others early """
+    if stream is None or component is None:
+        return stream
+    return stream.select(component=component)
+
+
+def check_availability(origin_time, timewindow_start, timewindow_end, sta_codes,
+                       network="S", timeout=None):
+    """
+    Splits the stations of a network into the ones to download and the
+    ones without data for the window. Stations are known to have no data
+    from earlier requests (routing table and availability index) or
+    because no waveform source lists them for the window, with one
+    availability query per source. Returns both lists.
+    """
+    if timeout is None:
+        timeout = config.download_timeout
+    starttime = origin_time + timewindow_start - 60
+    endtime = origin_time + timewindow_end + 60
+
+    sta_codes = list(dict.fromkeys(sta_codes))
+    no_data = {sta_code for sta_code in sta_codes
+               if routing_table.has_no_data(network, sta_code, starttime, endtime) or
+               availability_index.has_no_data(network, sta_code, starttime, endtime)}
+    candidates = [sta_code for sta_code in sta_codes if sta_code not in no_data]
+
+    # The availability services are updated with a delay, recent windows
+    # are downloaded anyway
+    if config.use_availability_service and len(candidates) > 0 and \
+            time.time() - endtime.timestamp > config.availability_service_delay:
+        available = waveformsource.available_stations(
+            network, candidates, "*", network_channels[network], starttime, endtime, timeout)
+        if available is not None:
+            missing = [sta_code for sta_code in candidates if sta_code not in available]
+            for sta_code in missing:
+                routing_table.mark_no_data(network, sta_code, starttime, endtime)
+            if missing:
+                availability_index.record(network, missing, starttime, endtime, has_data=False)
+            no_data.update(missing)
+
+    return ([sta_code for sta_code in sta_codes if sta_code not in no_data],
+            [sta_code for sta_code in sta_codes if sta_code in no_data])
+
+
+def get_all_waveforms(origin_time, timewindow_start, timewindow_end, sta_codes,
+                      max_workers=None, timeout=None, progress=None, component=None):
+    """
+    Downloads the waveforms of all given stations in parallel.
+
+    At most ``max_workers`` requests are in flight at the same time and each
+    request is aborted after ``timeout`` seconds. ``progress`` is called as
+    ``progress(sta_code, n_done, n_total)`` every time a station completes.
+    With ``component`` (e.g. 'Z'), only the traces of that component are
+    kept. Returns a dictionary with the station code as key and the stream
+    (or None if no data could be downloaded) as value.
+    """
+    if max_workers is None:
+        max_workers = config.download_workers
+    if timeout is None:
+        timeout = config.download_timeout
+
+    sta_codes = list(dict.fromkeys(sta_codes))
+    streams = {}
+    if len(sta_codes) == 0:
+        return streams
+
+    get_station_waveforms = propagate(_get_station_waveforms)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(get_station_waveforms, origin_time, timewindow_start,
+                            timewindow_end, sta_code, timeout, component): sta_code
+            for sta_code in sta_codes}
+
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            sta_code = futures[future]
+            try:
+                streams[sta_code] = _component(future.result(), component)
+            except Exception:
+                streams[sta_code] = None
+
+            if progress is not None:
+                progress(sta_code, n_done, len(sta_codes))
+
+    return streams
+
+
+def get_all_waveforms_bulk(origin_time, timewindow_start, timewindow_end, sta_codes,
+                           network="S", chunk_size=None, max_workers=None,
+                           timeout=None, progress=None, component=None):
+    """
+    Downloads the waveforms of all given stations of a network with bulk
+    dataselect requests of at most ``chunk_size`` stations each. The chunks
+    run concurrently and the returned stream is split per station. Stations
+    missing from the bulk result, e.g. because a chunk failed, fall back to
+    the per-station requests of get_all_waveforms. Returns the same
+    dictionary as get_all_waveforms.
+
+    By default, the chunks hold at most config.bulk_chunk_size stations,
+    and the concurrent chunks at most station_group_size stations in total.
+    """
+    if max_workers is None:
+        max_workers = config.download_workers
+    if chunk_size is None:
+        chunk_size = config.bulk_chunk_size
+        group_size = station_group_size(network, timewindow_start, timewindow_end, component)
+        if group_size is not None:
+            max_workers = min(max_workers, group_size)
+            chunk_size = min(chunk_size, max(1, group_size // max(1, max_workers)))
+    if timeout is None:
+        timeout = config.download_timeout
+
+    sta_codes = list(dict.fromkeys(sta_codes))
+    channel = component_channels(network_channels[network], component)
+    starttime = origin_time + timewindow_start - 60
+    endtime = origin_time + timewindow_end + 60
+    streams = {}
+    n_done = 0
+
+    def _report(sta_code):
+        if progress is not None:
+            progress(sta_code, n_done, len(sta_codes))
+
+    # Windows that are already in the local cache or known to have no data
+    todo = []
+    for sta_code in sta_codes:
+        stream = None
+        if routing_table.has_no_data(network, sta_code, starttime, endtime):
+            streams[sta_code] = None
+        elif config.use_waveform_cache:
+            with span("waveform_cache", station=sta_code):
+                stream = waveform_cache.get(network, sta_code, channel, starttime, endtime)
+            if stream:
+                streams[sta_code] = _component(stream, component)
+        if sta_code in streams:
+            n_done += 1
+            _report(sta_code)
+        else:
+            todo.append(sta_code)
+
+    def _download_chunk(bulk):
+        """
+        Stream of the chunk from all sources and whether all sources answered.
+        The downloads are cached per station; also returns the cached stations
+        and whether all data came from remote sources.
+        """
+        results, complete = waveformsource.get_waveforms_bulk(bulk, timeout)
+        stream, cached = Stream(), []
+        for source_stream, source in results:
+            stream += source_stream
+            if source.remote and config.use_waveform_cache:
+                for sta_code in sorted({tr.stats.station for tr in source_stream}):
+                    waveform_cache.put(network, sta_code, channel, starttime, endtime,
+                                       source_stream.select(station=sta_code))
+                    cached.append(sta_code)
+        return stream, complete, cached, all(source.remote for _, source in results)
+
+    def _fetch_chunk(chunk):
+        bulk = [(network, sta_code, "*", channel, starttime, endtime) for sta_code in chunk]
+        with span("chunk", network=network, stations=len(chunk)):
+            if not config.use_waveform_cache:
+                return _download_chunk(bulk)[:2]
+
+            # The same chunk requested by other processes at the same time is
+            # downloaded once, the others read the stations from the cache
+            downloaded = []
+
+            def _fetch():
+                stream, complete, cached, remote = _download_chunk(bulk)
+                downloaded.append((stream, complete))
+                # Stations read from a local archive are read again by the others
+                return {"stations": cached, "complete": complete and remote}
+
+            summary = single_flight.run(("bulk", network, channel, str(starttime),
+                                         str(endtime), tuple(chunk)), _fetch)
+            if downloaded:
+                return downloaded[0]
+            stream = Stream()
+            for sta_code in summary["stations"]:
+                cached = waveform_cache.get(network, sta_code, channel, starttime, endtime)
+                if not cached:
+                    return _download_chunk(bulk)[:2]
+                stream += cached
+            return stream, summary["complete"]
+
+    chunks = [todo[idx:idx + max(1, chunk_size)] for idx in range(0, len(todo), max(1, chunk_size))]
+    if len(chunks) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+            fetch_chunk = propagate(_fetch_chunk)
+            futures = {executor.submit(fetch_chunk, chunk): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                try:
+                    stream, complete = future.result()
+                except Exception:
+                    continue
+
+                # Split the returned stream per station. Stations of the network
+                # that are missing from the answers of all sources have no data.
+                found, missing = [], []
+                for sta_code in futures[future]:
+                    sta_stream = stream.select(network=network, station=sta_code)
+                    if len(sta_stream) == 0:
+                        route = routing_table.route(sta_code)
+                        if complete and route is not None and route.network == network:
+                            routing_table.mark_no_data(network, sta_code, starttime, endtime)
+                            missing.append(sta_code)
+                            streams[sta_code] = None
+                            n_done += 1
+                            _report(sta_code)
+                        continue
+                    found.append(sta_code)
+                    streams[sta_code] = _component(sta_stream, component)
+                    n_done += 1
+                    _report(sta_code)
+                for sta_codes_observed, has_data in ((found, True), (missing, False)):
+                    if sta_codes_observed:
+                        availability_index.record(network, sta_codes_observed, starttime,
+                                                  endtime, has_data=has_data)
+
+    # Per-station requests for everything the bulk requests did not return
+    missing = [sta_code for sta_code in sta_codes if sta_code not in streams]
+    if len(missing) > 0:
+        offset = n_done
+
+        def _fallback_progress(sta_code, n_fallback, n_total):
+            if progress is not None:
+                progress(sta_code, offset + n_fallback, len(sta_codes))
+
+        streams.update(get_all_waveforms(origin_time, timewindow_start, timewindow_end,
+                                         missing, max_workers=max_workers, timeout=timeout,
+                                         progress=_fallback_progress, component=component))
+    return streams
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 from ipywidgets import widgets, interact, Dropdown, Select
-from IPython.display import display, clear_output
+from IPython.display import display
 import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from obspy import UTCDateTime
-from obspy.clients.fdsn import Client
 from codebase import config
+from codebase.clients import get_client
+from codebase.routing import routing_table
+from codebase.inventorycache import inventory_cache
+from codebase.catalogcache import catalog_cache, event_magnitude
+from codebase.stationindex import StationIndex, set_station_index
+from codebase.timing import profiled, span
 
 # Years that will be used in the dropdown. It cannot exceed the current year
 start_year = 2023
@@ -49,88 +56,125 @@ def correct_region_key(key):
         key = 'worldwide'
     return key.lower()
 
+def _earthquake_info(event):
+    """ Return the earthquake information shown in the dropdown """
+    return f"Magnitude {np.around(event_magnitude(event), decimals=1)}    {event.origins[0].time}    {event.event_descriptions[0].text}" 
+
+
 class RaspberryShake:
     def __init__(self):
         self.stations = config.rs_sta_list
         self.catalog = []
+        self._earthquakes = {}  # dropdown label -> event of the catalog
         self.inventory = None
+        self.station_index = None
         self.language = 'en'
 
+        # Background execution of the queries and plots. Each kind has its own
+        # single worker so that a slow plot never delays the earthquake list.
+        self._executors = {}
+        self._tasks = {}
+        self._query_generation = 0
+        self._debounce_timer = None
+        self._lock = threading.Lock()
+
+        # Output widgets of the plots, created by setup_gui. Without them
+        # (headless) the plots print to stdout.
+        self.plot_output = None
+        self.seis_output = None
+
     def get_language(self):
         """ Return the current language """
         return self.language
     
+    @profiled("query_stations")
     def query_stations(self):
+        """ 
+        Load the station inventories of the Swiss and seismo-at-school networks.
+        The inventories are read from the local cache if available.
+        """
+        with span("inventory_cache"):
+            inventories = inventory_cache.load(self.download_inventories,
+                                               on_refresh=self.set_inventories)
+        with span("set_inventories"):
+            self.set_inventories(inventories)
+
+    def download_inventories(self):
+        """ Download the full inventories of both networks """
         # SED broadband stations:
-        inv_ch = Client("ETH").get_stations(
-            network="CH", station="*", location="--", channel="HH*", level="RESP")
-        inv_ch = inv_ch.select(
-            channel="*Z", station="*", time=UTCDateTime("2050-01-01T01:00:00.000Z"))
+        with span("download_inventory", network="CH"):
+            inv_ch = get_client("ETH").get_stations(
+                network="CH", station="*", location="--", channel="HH*", level="RESP")
 
         # Seismo-at-school RaspberryShake stations
-        inv_s = Client("ETH").get_stations(
-            network="S", station="*",location="--", channel="EH*", level="RESP")
-        inv_s = inv_s.select(
+        with span("download_inventory", network="S"):
+            inv_s = get_client("ETH").get_stations(
+                network="S", station="*",location="--", channel="EH*", level="RESP")
+
+        return {"CH": inv_ch, "S": inv_s}
+
+    def set_inventories(self, inventories):
+        """ Select the vertical channels in operation and update the routing """
+        inv_ch = inventories["CH"].select(
+            channel="*Z", station="*", time=UTCDateTime("2050-01-01T01:00:00.000Z"))
+        inv_s = inventories["S"].select(
             channel="*Z", station="*", time=UTCDateTime("2050-01-01T01:00:00.000Z"))
 
-        # Combine the inventories
+        # Route the waveform requests with all channels and epochs
+        routing_table.update(inventories["CH"] + inventories["S"])
+
+        # Combine the inventories and index them for the getters and plots
         self.inventory = inv_ch + inv_s
+        self.station_index = StationIndex(self.inventory, inventories["CH"] + inventories["S"],
+                                          self.stations, inventory_cache.read_responses)
+        set_station_index(self.station_index)
 
-    def get_CH_inventory(self):
-        """ Return the inventory for Swiss network"""
+    def get_station_index(self):
+        """ Return the index of the station inventory """
         if self.inventory is None:
             self.query_stations()
-        return self.inventory.select(network="CH")
+        return self.station_index
+
+    def get_CH_inventory(self):
+        """ Return the inventory for Swiss network"""
+        return self.get_station_index().network_inventory("CH")
     
     def get_S_inventory(self):
         """ Return the inventory for seismo-at-school network"""
-        if self.inventory is None:
-            self.query_stations()
-        return self.inventory.select(network="S")
+        return self.get_station_index().network_inventory("S")
     
     def query_web_services(self):
         """ Function to query the server with the selected parameters """
+        self.catalog = self.fetch_catalog()
+        return self.catalog
+
+    @profiled("fetch_catalog")
+    def fetch_catalog(self):
+        """ Return the catalog for the selected parameters (without storing it) """
         server = self.get_parameters()['server']
         min_mag = self.get_selected_min_mag()
-        max_mag = 10.0
-        
         year = self.get_selected_year()
-        start = UTCDateTime(f"{year}-01-01T00:00:00")
-        end = UTCDateTime(f"{year}-12-31T23:59:59")
-        
-        # FDSN client
-        client = Client(server)
-        
-        # Query depending on the region
+
+        # Query depending on the region. The catalog of the year is cached
+        # and filtered locally for the selected minimum magnitude.
         region = self.get_selected_region()
         if region.lower() in ['europa', 'europe']:
             # For Europe, server will be IRIS. Downscale the region
             # by adjusting the latitude and longitude
-            min_lat = 38.0
-            max_lat = 70.0
-            min_lon = -15.0
-            max_lon = 30.0
-            
-            try:
-                self.catalog = client.get_events(
-                    starttime=start, endtime=end, minmagnitude=min_mag,
-                    maxmagnitude=max_mag, minlatitude=min_lat, maxlatitude=max_lat, 
-                    minlongitude=min_lon, maxlongitude=max_lon)
-            except:
-                self.catalog = []
-
-            return self.catalog
+            query = {'minlatitude': 38.0, 'maxlatitude': 70.0,
+                     'minlongitude': -15.0, 'maxlongitude': 30.0,
+                     'maxmagnitude': 10.0}
         else:
             # The server is ETH for Switzerland, and IRIS for worldwide
             # No need to downscale the region for either case.
-            try:
-                self.catalog = client.get_events(
-                    starttime=start, endtime=end, minmagnitude=min_mag, 
-                    maxmagnitude=max_mag)
-            except:
-                self.catalog = []
-                
-            return self.catalog
+            query = {'maxmagnitude': 10.0}
+
+        try:
+            with span("catalog", server=server, year=year):
+                return catalog_cache.get_events(
+                    server, year, correct_region_key(region), min_mag, **query)
+        except Exception:
+            return []
 
     def is_region_switzerland(self):
         """ Return True if the selected region is Switzerland """
@@ -152,21 +196,91 @@ class RaspberryShake:
         region = correct_region_key(region)
         return config.regions[region.lower()]['magnitudes']
 
-    def handle_year_changed(self, selection):
-        """ Event to evaluate the year and reset the earthquake list """
-        # Get the new year selection
-        year = selection['new']
-        
+    def run_in_background(self, kind, func, *args):
+        """ 
+        Run the function on the background worker of the given kind ('query'
+        or 'plot'). A task of the same kind that has not started yet is
+        superseded and cancelled. Without config.gui_async, the function
+        runs directly.
+        """
+        if not config.gui_async:
+            func(*args)
+            return None
+
+        if kind == 'plot':
+            func, args = self._paused_prefetch, (func,) + args
+
+        with self._lock:
+            if kind not in self._executors:
+                self._executors[kind] = ThreadPoolExecutor(max_workers=1)
+            previous = self._tasks.get(kind)
+            if previous is not None:
+                previous.cancel()
+            future = self._executors[kind].submit(func, *args)
+            self._tasks[kind] = future
+        future.add_done_callback(self._report_error)
+        return future
+
+    @staticmethod
+    def _paused_prefetch(func, *args):
+        """ Run an explicit plot with the speculative prefetch paused """
+        from codebase.prefetch import prefetcher
+        with prefetcher.paused():
+            func(*args)
+
+    def _report_error(self, future):
+        """ Show the errors of background tasks in the seismogram output """
+        if future.cancelled() or future.exception() is None:
+            return
+        from codebase.plotutils import PlotOutput
+        PlotOutput(self.seis_output).print(f"Error: {future.exception()}", stream="stderr")
+
+    def update_earthquake_list(self):
+        """ 
+        Update the earthquake list for the selected year, region and magnitude. 
+        Rapid changes are debounced, and the result of a superseded query is 
+        discarded so that only the latest selection is applied.
+        """
+        with self._lock:
+            self._query_generation += 1
+            generation = self._query_generation
+
         # Disable the earthquake dropdown until the list is updated
         self.earthquake_combo.options = ["Loading..."]
+        self.earthquake_combo.disabled = True
+
+        if not config.gui_async:
+            self._query_earthquakes(generation)
+            return
+
+        if self._debounce_timer is not None:
+            self._debounce_timer.cancel()
+        self._debounce_timer = threading.Timer(
+            config.gui_debounce, self.run_in_background,
+            args=('query', self._query_earthquakes, generation))
+        self._debounce_timer.daemon = True
+        self._debounce_timer.start()
+
+    def _query_earthquakes(self, generation):
+        """ Query the web services and fill the earthquake list (background) """
+        # Skip the query if the selection changed in the meantime
+        if generation != self._query_generation:
+            return
+        events = self.fetch_catalog()
 
-        # Query the web services
-        events = self.query_web_services()
-        
         # Get the list of earthquakes
-        eq_list = [f"Magnitude {np.around(event.magnitudes[0].mag, decimals=1)}    {event.origins[0].time}    {event.event_descriptions[0].text}" for event in events]
-        
-        # Update the earthquake dropdown
+        eq_list = [_earthquake_info(event) for event in events]
+
+        # The catalog and the events of the labels are published together, so
+        # that get_earthquake_quakeml never resolves a label in another catalog
+        with self._lock:
+            if generation != self._query_generation:
+                return
+            self.catalog = events
+            self._earthquakes = dict(zip(eq_list, events))
+
+        # Update the earthquake dropdown (outside the lock, as the widget
+        # callbacks of the change may need it)
         self.earthquake_combo.options = eq_list
 
         # Display the first earthquake in the list
@@ -176,6 +290,10 @@ class RaspberryShake:
         # Enable the earthquake dropdown
         self.earthquake_combo.disabled = False
 
+    def handle_year_changed(self, selection):
+        """ Event to evaluate the year and reset the earthquake list """
+        self.update_earthquake_list()
+
     def handle_region_changed(self, selection):
         """ Event to evaluate the region and reset magnitudes """
         # Get the new region selection
@@ -186,55 +304,44 @@ class RaspberryShake:
 
     def handle_magnitude_changed(self, selection):
         """ Event to evaluate the magnitude and reset the earthquake list """
-        def _earthquake_info(event):
-            """ Return the earthquake information """
-            return f"Magnitude {np.around(event.magnitudes[0].mag, decimals=1)}    {event.origins[0].time}    {event.event_descriptions[0].text}" 
-        # Get the new magnitude selection
-        magnitude = selection['new']
-        
-        # Get the parameters
-        parameters = self.get_parameters()
-        parameters['min_mag'] = magnitude
-        
-        # Disable the earthquake dropdown until the list is updated
-        self.earthquake_combo.options = ["Loading..."]
+        self.update_earthquake_list()
+
+    def handle_selection_changed(self, selection):
+        """ Event to start the prefetch of the selected earthquake and station """
+        if not config.use_prefetch:
+            return
+        from codebase.prefetch import prefetcher
+
+        if self.earthquake_combo.value not in self.earthquake_combo.options or \
+                self.earthquake_combo.value == "Loading...":
+            prefetcher.cancel()
+            return
+        try:
+            selected_eq = self.get_earthquake_quakeml()
+        except KeyError:
+            prefetcher.cancel()
+            return
 
-        # Query the web services
-        events = self.query_web_services()
-        
-        # Get the list of earthquakes
-        eq_list = [_earthquake_info(event) for event in events]
-        
-        # Update the earthquake dropdown
-        self.earthquake_combo.options = eq_list
-
-        # Display the first earthquake in the list
-        if len(eq_list) > 0:
-            self.earthquake_combo.value = eq_list[0]
-
-        # Enable the earthquake dropdown
-        self.earthquake_combo.disabled = False
+        parameters = self.get_parameters()
+        rs_code = self.get_selected_station().split(',')[0].strip()
+        depth = selected_eq.origins[0].depth
+        prefetcher.prefetch(selected_eq.origins[0].time, parameters['time_min'],
+                            parameters['time_max'], [rs_code, self.get_sed_station()],
+                            depth_in_km=depth / 1000.0 if depth is not None else None)
 
     def get_selected_station(self):
         """ Return the selected station """
         return self.raspberry_combo.value
     
     def get_sed_station(self):
-        """ Return the inventory of the selected station """
+        """ Return the code of the SED station closest to the selected station """
         rs_code = self.get_selected_station().split(',')[0].strip()
-
-        # Find the station in the dictionary
-        for station in self.stations:
-            if station[0] == rs_code:
-                return station[2]
-        return None
+        return self.get_station_index().sed_station(rs_code)
     
     def get_sed_station_inventory(self):
         """ Return the inventory of the selected station """
-        if self.inventory is None:
-            self.query_stations()
         sta_code = self.get_sed_station()
-        return self.inventory.select(station=sta_code)
+        return self.get_station_index().station_inventory(sta_code)
     
     def get_selected_earthquake(self):
         """ Return the selected earthquake """
@@ -242,14 +349,13 @@ class RaspberryShake:
     
     def get_selected_station_inventory(self):
         """ Return the inventory of the selected station """
-        if self.inventory is None:
-            self.query_stations()
         sta_code = self.get_selected_station().split(',')[0].strip()
-        return self.inventory.select(station=sta_code)
+        return self.get_station_index().station_inventory(sta_code)
     
     def get_earthquake_quakeml(self):
-        idx = self.earthquake_combo.options.index(self.earthquake_combo.value)
-        return self.catalog[idx]
+        """ Return the event of the selected earthquake (KeyError if none) """
+        with self._lock:
+            return self._earthquakes[self.earthquake_combo.value]
     
     def get_selected_year(self):
         """ Return the selected year """
@@ -265,8 +371,8 @@ class RaspberryShake:
     
     def get_parameters(self):
         """ Return the query and processing parameters """
-        freq_min, freq_max = config.regions[correct_region_key(self.region_select.value)]['filt-freq-range']
-        time_min, time_max = config.regions[correct_region_key(self.region_select.value)]['filt-time-range']
+        freq_min, freq_max = config.regions[correct_region_key(self.get_selected_region())]['filt-freq-range']
+        time_min, time_max = config.regions[correct_region_key(self.get_selected_region())]['filt-time-range']
 
         if self.get_selected_region().lower() in ['switzerland', 'schweiz']:
             server = 'ETH'
@@ -327,8 +433,8 @@ class RaspberryShake:
         # Use a separate label for the earthquake dropdown
         self.eq_label = widgets.Label(value=_eq_label)
 
-        # Initial fill of the earthquake list
-        self.handle_magnitude_changed({'new': self.magnitude_select.value})
+        # Initial fill of the earthquake list (in the background)
+        self.update_earthquake_list()
 
         # Query the inventory
         self.query_stations()
@@ -361,6 +467,8 @@ class RaspberryShake:
         self.year_combo.observe(self.handle_year_changed, names='value')
         self.region_select.observe(self.handle_region_changed, names='value')
         self.magnitude_select.observe(self.handle_magnitude_changed, names='value')
+        self.earthquake_combo.observe(self.handle_selection_changed, names='value')
+        self.raspberry_combo.observe(self.handle_selection_changed, names='value')
         
         # Create an output widget
         self.plot_output = widgets.Output()
@@ -372,16 +480,26 @@ class RaspberryShake:
 
     def plot_ray_paths(self, event=None):
         """ Plot the ray paths """
+        self.run_in_background('plot', self._plot_ray_paths)
+
+    # The plotting modules are reloaded on every click, so that changes to them
+    # show up without restarting the kernel. State that must outlive a click
+    # (caches, pools, indexes, the tracer) therefore lives in module-level
+    # instances of the modules that are never reloaded (waveformcache,
+    # responsecache, timing, ...), not in the plotting modules.
+    def _plot_ray_paths(self):
         from codebase import raypathplot
         importlib.reload(raypathplot)
         raypathplot.plot_ray_paths(self)
 
     def clear_map(self, event=None):
-        with self.plot_output:
-            clear_output(wait=True)
+        self.plot_output.clear_output(wait=True)
             
     def plot_map(self, event=None):
         """ Plot the location map """
+        self.run_in_background('plot', self._plot_map)
+
+    def _plot_map(self):
         from codebase import mapplot, seisplot
         importlib.reload(mapplot)
         importlib.reload(seisplot)
@@ -391,12 +509,18 @@ class RaspberryShake:
         
     def plot_all_seismograms(self, event=None):
         """ Plot all the seismograms """
+        self.run_in_background('plot', self._plot_all_seismograms)
+
+    def _plot_all_seismograms(self):
         from codebase import seisallplot
         importlib.reload(seisallplot)
         seisallplot.plot_all_seismograms(self)
 
     def plot_seismograms(self, event=None):
         """ Plot the seismograms (not the map) """
+        self.run_in_background('plot', self._plot_seismograms)
+
+    def _plot_seismograms(self):
         from codebase import seisplot
         importlib.reload(seisplot)
         seisplot.seismogram_plot(self)
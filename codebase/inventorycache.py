@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the station inventories queried by
+RaspberryShake.query_stations. The stations and channels of all
+inventories are stored in one JSON file with the download time, and the
+responses as one StationXML file per station, which is only parsed when a
+response of the station is needed (see StationIndex). Parsing the full
+RESP level StationXML took 17 s on every start, the JSON file takes 0.2 s
+(setup_gui_warm in benchmarks/suite.py). A fresh cache is used directly;
+a stale cache is still returned immediately while a background thread
+downloads a new copy. If the server cannot be reached, the cached copy is
+used regardless of its age. Processes sharing the cache directory
+download missing or stale inventories only once (see singleflight).
+"""
+import copy
+import json
+import os
+import shutil
+import threading
+import time
+from obspy import UTCDateTime, read_inventory
+from obspy.core.inventory import Channel, Inventory, Network, Station
+from codebase import config
+from codebase.singleflight import single_flight
+
+
+def _time(value):
+    return None if value is None else value.ns
+
+
+def _utc(value):
+    # Nanoseconds: much faster than parsing the ISO strings
+    return None if value is None else UTCDateTime(ns=value)
+
+
+def _encode_inventory(inventory):
+    """ JSON encoding of the networks, stations and channels (no responses) """
+    return {"source": inventory.source, "networks": [
+        {"code": network.code, "stations": [
+            {"code": station.code, "latitude": station.latitude,
+             "longitude": station.longitude, "elevation": station.elevation,
+             "start_date": _time(station.start_date), "end_date": _time(station.end_date),
+             "channels": [[channel.code, channel.location_code, channel.latitude,
+                           channel.longitude, channel.elevation, channel.depth,
+                           channel.azimuth, channel.dip, channel.sample_rate,
+                           _time(channel.start_date), _time(channel.end_date)]
+                          for channel in station]}
+            for station in network]}
+        for network in inventory]}
+
+
+def _decode_inventory(value):
+    return Inventory(source=value["source"], networks=[
+        Network(code=network["code"], stations=[
+            Station(code=station["code"], latitude=station["latitude"],
+                    longitude=station["longitude"], elevation=station["elevation"],
+                    start_date=_utc(station["start_date"]), end_date=_utc(station["end_date"]),
+                    channels=[Channel(code=code, location_code=location, latitude=latitude,
+                                      longitude=longitude, elevation=elevation, depth=depth,
+                                      azimuth=azimuth, dip=dip, sample_rate=sample_rate,
+                                      start_date=_utc(start), end_date=_utc(end))
+                              for code, location, latitude, longitude, elevation, depth,
+                              azimuth, dip, sample_rate, start, end in station["channels"]])
+            for station in network["stations"]])
+        for network in value["networks"]])
+
+
+class InventoryCache:
+    """ Inventory files with a time-to-live and background refresh """
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self._refresh_thread = None
+        self._lock = threading.Lock()
+
+    def _responses_dir(self):
+        return f"{os.path.splitext(self.filename)[0]}_responses"
+
+    def _response_file(self, network, station):
+        return os.path.join(self._responses_dir(), f"{network}.{station}.xml")
+
+    def _read(self):
+        """
+        Return the cached timestamp and inventories, or (None, None). The
+        channels of the inventories have no response (see read_responses).
+        """
+        try:
+            with open(self.filename) as f:
+                cached = json.load(f)
+            inventories = {name: _decode_inventory(value)
+                           for name, value in cached["inventories"].items()}
+            return cached["timestamp"], inventories
+        except Exception:
+            return None, None
+
+    def _write(self, inventories):
+        # The responses are written before the JSON file that lists the stations
+        os.makedirs(self._responses_dir(), exist_ok=True)
+        tmp_suffix = f".{os.getpid()}.tmp"
+        for inventory in inventories.values():
+            for network in inventory:
+                for station in network:
+                    if all(channel.response is None for channel in station):
+                        continue
+                    filename = self._response_file(network.code, station.code)
+                    station_network = copy.copy(network)
+                    station_network.stations = [station]
+                    Inventory(networks=[station_network], source=inventory.source).write(
+                        filename + tmp_suffix, format="STATIONXML")
+                    os.replace(filename + tmp_suffix, filename)
+        with open(self.filename + tmp_suffix, "w") as f:
+            json.dump({"timestamp": time.time(),
+                       "inventories": {name: _encode_inventory(inventory)
+                                       for name, inventory in inventories.items()}}, f)
+        os.replace(self.filename + tmp_suffix, self.filename)
+
+    def read_responses(self, network, station):
+        """ Return the cached inventory of the station with responses, or None """
+        try:
+            return read_inventory(self._response_file(network, station), format="STATIONXML")
+        except Exception:
+            return None
+
+    def _download(self, fetch):
+        """
+        Download and store the inventories, once for all processes: the
+        others wait and read the stored copy
+        """
+        downloaded = []
+
+        def _fetch():
+            downloaded.append(fetch())
+            try:
+                self._write(downloaded[0])
+            except OSError:
+                pass
+
+        single_flight.run(("inventories", self.filename), _fetch)
+        if downloaded:
+            return downloaded[0]
+        timestamp, inventories = self._read()
+        return inventories if inventories is not None else fetch()
+
+    def _refresh(self, fetch, on_refresh):
+        """ Download new inventories and store them (background thread) """
+        try:
+            inventories = self._download(fetch)
+        except Exception:
+            return
+        finally:
+            with self._lock:
+                self._refresh_thread = None
+        if on_refresh is not None:
+            on_refresh(inventories)
+
+    def is_refreshing(self):
+        """ Return True while a background refresh is running """
+        return self._refresh_thread is not None
+
+    def load(self, fetch, on_refresh=None):
+        """
+        Return the inventories. ``fetch`` is called without arguments to
+        download them. When a stale cache is served, the refresh runs in the
+        background and ``on_refresh`` is called with the new inventories.
+        """
+        timestamp, inventories = self._read()
+
+        # No cache yet: the inventories have to be downloaded now
+        if inventories is None:
+            return self._download(fetch)
+
+        # Stale cache: serve it and refresh in the background
+        if time.time() - timestamp > self.ttl:
+            with self._lock:
+                if self._refresh_thread is None:
+                    self._refresh_thread = threading.Thread(
+                        target=self._refresh, args=(fetch, on_refresh), daemon=True)
+                    self._refresh_thread.start()
+        return inventories
+
+    def clear(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        shutil.rmtree(self._responses_dir(), ignore_errors=True)
+
+
+# Cache shared by all RaspberryShake instances
+inventory_cache = InventoryCache(config.inventory_cache_file, config.inventory_cache_ttl)
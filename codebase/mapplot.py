@@ -4,52 +4,51 @@ Plots the location map of the selected earthquake. The event can be
 reached by the RaspberryShake object, which is the collection of 
 widgets shown in the notebook.
 """
-import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-from IPython.display import display, clear_output
-from obspy.geodetics import gps2dist_azimuth
+from matplotlib.figure import Figure
+from codebase import config
+from codebase.catalogcache import event_magnitude
+from codebase.geodesy import geodesics
+from codebase.plotutils import PlotOutput
+from codebase.basemap import add_static_features, basemap_cache, figsize, region_projection
+from codebase.timing import profiled, span
 
-def plot_map(raspberry):
+@profiled("plot_map", output="plot_output")
+def plot_map(raspberry, directory=None):
     # Get the selected earthquake
     selected_eq  = raspberry.get_earthquake_quakeml()
     lon = selected_eq.origins[0].longitude
     lat = selected_eq.origins[0].latitude
-    mag = selected_eq.magnitudes[0].mag
+    mag = event_magnitude(selected_eq)
     depth = selected_eq.origins[0].depth / 1000.0
     time = selected_eq.origins[0].time
 
     if depth < 0:
         depth = 0.0
         
-    # Make sure the output widget is created
-    if raspberry.plot_output is None:
-        raise ValueError("The output widget is not created")
+    with PlotOutput(raspberry.plot_output, directory) as output:
+        output.clear()
 
-    with raspberry.plot_output:
-        clear_output()
-        
         # Plot the map
-        fig = plt.figure(figsize=(11, 11))
+        fig = Figure(figsize=figsize)
 
         # Setup projections depending on the region scale
         if raspberry.is_region_switzerland():
-            projection = ccrs.AlbersEqualArea(central_longitude = 8.5, 
-                                            central_latitude = 46.5)
-            ax = fig.add_subplot(111, projection=projection)
-            ax.set_extent((5.5, 11., 45.5, 48))
-            ax.add_feature(cfeature.BORDERS)
-            ax.add_feature(cfeature.LAKES, alpha=0.5)
-            ax.add_feature(cfeature.RIVERS)
+            region = "switzerland"
+        elif raspberry.is_region_europe():
+            region = "europe"
         else:
-            projection = ccrs.PlateCarree()
-            ax = fig.add_subplot(111, projection=projection)
-        
-            if raspberry.is_region_europe():
-                ax.set_extent((45, -15, 70.,30))
+            region = "worldwide"
+        projection, extent = region_projection(region)
+        ax = fig.add_subplot(111, projection=projection)
+
+        # Static background from the basemap cache, or drawn from the features
+        with span("basemap", region=region):
+            if config.use_basemap_cache:
+                basemap_cache.draw(ax, region)
             else:
-                ax.set_extent((-180, 180., -90, 90))
-            ax.stock_img()
+                ax.set_extent(extent)
+                add_static_features(ax, region)
 
         # Plot the earthquake location
         ax.plot(lon, lat, 'ro', markersize=14, transform=ccrs.Geodetic())
@@ -58,19 +57,17 @@ def plot_map(raspberry):
         
         # selected station name
         selected_sta_code = raspberry.get_selected_station().split(',')[0].strip()
-        # Inventory of the RaspberryShake stations
-        inventory = raspberry.get_S_inventory()
+        # Coordinates of the RaspberryShake stations
+        index = raspberry.get_station_index()
 
-        for sta in inventory[0]:
-            x = sta.longitude
-            y = sta.latitude 
-            
-            if sta.code == selected_sta_code:
+        for sta_code, x, y in zip(index.codes.get("S", []), index.longitudes.get("S", []),
+                                  index.latitudes.get("S", [])):
+            if sta_code == selected_sta_code:
                 # Draw the GCP from station to earthquake
                 ax.plot([x, lon], [y, lat], 'r--', transform=ccrs.Geodetic())
 
                 # Calculate the distance between the station and the earthquake
-                distance = gps2dist_azimuth(y, x, lat, lon)[0] / 1000.0
+                distance = geodesics(y, x, lat, lon)[0]
 
                 # Text half-way between the station and the earthquake
                 xtext = (x + lon) / 2
@@ -83,26 +80,23 @@ def plot_map(raspberry):
 
                 # Check the region scale to decide if station names should be shown
                 if raspberry.is_region_switzerland():
-                    ax.text(x, y + 0.05, sta.code, transform=ccrs.Geodetic(), 
+                    ax.text(x, y + 0.05, sta_code, transform=ccrs.Geodetic(), 
                             fontsize=10, verticalalignment='bottom', horizontalalignment='center')
             else:
                 ax.plot(x, y, 'kv', markersize=12, transform=ccrs.Geodetic(), alpha=0.5)
 
                 # Check the region scale to decide if station names should be shown
                 if raspberry.is_region_switzerland():
-                    ax.text(x, y + 0.05, sta.code, transform=ccrs.Geodetic(), 
+                    ax.text(x, y + 0.05, sta_code, transform=ccrs.Geodetic(), 
                             fontsize=9, verticalalignment='bottom', horizontalalignment='center')
         
         # Title
         time = time.strftime("%Y-%m-%d %H:%M:%S")
         ax.set_title(f"{time}, Z= {round(depth, 1)} km")
 
-        # Draw standard features
-        ax.gridlines()
-        ax.coastlines()
         ax.set_xlabel('Longitude')
         ax.set_ylabel('Latitude')
     
-        plt.savefig("map.png", dpi=200, bbox_inches='tight')
-        plt.show()
+        with span("savefig"):
+            output.show(fig, "map.png", dpi=config.plot_dpi, bbox_inches='tight')
 
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the plotting modules.
+
+Long high-rate traces are reduced before plotting to a minimum/maximum pair
+per pixel column of the axes. A line through these points covers exactly
+the same pixels as the full trace, so the peaks stay visually exact while
+matplotlib only has to draw a few thousand points instead of hundreds of
+thousands.
+
+The plots run on background threads (see RaspberryShake.run_in_background),
+where capturing the output with the context manager of the output widget
+is not reliable while other threads write output too. PlotOutput therefore
+appends the text and the rendered figures to the widget explicitly.
+"""
+import base64
+import io
+import os
+import sys
+import threading
+import numpy as np
+from codebase import config
+
+# Width in pixels per inch of the figures shown in the notebook
+display_dpi = 100
+
+_output_lock = threading.Lock()
+
+
+class PlotOutput:
+    """
+    Output of a plot into an output widget, from any thread. Without widget
+    (headless), the text goes to stdout and the figures are only saved. The
+    figures are saved in directory (None for the working directory).
+    """
+    def __init__(self, widget=None, directory=None):
+        self.widget = widget
+        self.directory = directory
+        self._clear_pending = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _append(self, output):
+        with _output_lock:
+            if self._clear_pending:
+                self.widget.outputs = (output,)
+                self._clear_pending = False
+                return
+            outputs = self.widget.outputs
+            # Continue the text of the last output of the same stream
+            if output["output_type"] == "stream" and outputs and \
+                    outputs[-1].get("output_type") == "stream" and \
+                    outputs[-1].get("name") == output["name"]:
+                output = dict(output, text=outputs[-1]["text"] + output["text"])
+                outputs = outputs[:-1]
+            self.widget.outputs = outputs + (output,)
+
+    def clear(self, wait=False):
+        """ Clear the widget, with wait at the next output (no flicker) """
+        if self.widget is None:
+            return
+        if wait:
+            self._clear_pending = True
+        else:
+            with _output_lock:
+                self.widget.outputs = ()
+
+    def print(self, *values, sep=" ", end="\n", stream="stdout"):
+        """ Print into the widget like print() """
+        if self.widget is None:
+            print(*values, sep=sep, end=end, file=sys.stderr if stream == "stderr" else sys.stdout)
+            return
+        self._append({"output_type": "stream", "name": stream,
+                      "text": sep.join(str(value) for value in values) + end})
+
+    def show(self, fig, filename=None, **kwargs):
+        """
+        Render the figure once as PNG, write it to filename (if given) and
+        show it in the widget. kwargs are passed to savefig.
+        """
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", **kwargs)
+        png = buffer.getvalue()
+        if filename is not None:
+            if self.directory is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                filename = os.path.join(self.directory, filename)
+            with open(filename, "wb") as f:
+                f.write(png)
+        if self.widget is not None:
+            # Scale from the rendered to the displayed resolution (the width
+            # is in bytes 16-20 of the PNG header)
+            width = int.from_bytes(png[16:20], "big") * display_dpi / kwargs.get("dpi", fig.dpi)
+            self._append({"output_type": "display_data",
+                          "data": {"image/png": base64.b64encode(png).decode("ascii"),
+                                   "text/plain": repr(fig)},
+                          "metadata": {"image/png": {"width": int(width)}}})
+
+
+def pixel_columns(ax, dpi=None):
+    """ Return the number of pixel columns of the axes in the saved figure """
+    dpi = dpi or config.plot_dpi
+    return max(1, int(np.ceil(ax.get_position().width * ax.figure.get_figwidth() * dpi)))
+
+
+def minmax_envelope(data, n_columns):
+    """
+    Reduce the data to the minimum and maximum of each of n_columns bins.
+    Returns the sample indices and values of the kept points in time order.
+    Short data (less than 4 samples per column) is returned unchanged.
+    """
+    data = np.asarray(data)
+    npts = len(data)
+    if n_columns <= 0 or npts <= 4 * n_columns:
+        return np.arange(npts), data
+
+    bin_size = int(np.ceil(npts / n_columns))
+    n_bins = npts // bin_size
+    bins = data[:n_bins * bin_size].reshape(n_bins, bin_size)
+    offsets = np.arange(n_bins) * bin_size
+    imin = bins.argmin(axis=1)
+    imax = bins.argmax(axis=1)
+    # Keep the order of the minimum and maximum within the bin
+    indices = np.column_stack([offsets + np.minimum(imin, imax),
+                               offsets + np.maximum(imin, imax)]).ravel()
+
+    # Remaining samples that do not fill a complete bin
+    if n_bins * bin_size < npts:
+        tail = data[n_bins * bin_size:]
+        start = n_bins * bin_size
+        indices = np.concatenate([indices, start + np.sort([tail.argmin(), tail.argmax()])])
+    return indices, data[indices]
+
+
+def trace_envelope(tr, n_columns, times="relative"):
+    """
+    Return the x and y values to plot the trace with min/max decimation.
+    ``times`` is "relative" for seconds after the trace start or
+    "matplotlib" for matplotlib dates.
+    """
+    if not config.plot_envelope:
+        return tr.times(times), tr.data
+    indices, values = minmax_envelope(tr.data, n_columns)
+    x = indices * tr.stats.delta
+    if times == "matplotlib":
+        x = tr.stats.starttime.matplotlib_date + x / 86400.0
+    return x, values
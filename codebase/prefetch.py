@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Speculative prefetch of the data for the highlighted earthquake. As soon
+as an earthquake or station is selected in the GUI, the waveforms of the
+RaspberryShake and the closest SED station are downloaded in the background
+and the travel-time table rows for the event depth are prepared. The plot
+functions take the streams from a small in-memory cache instead of starting
+the download after the click.
+
+A new selection cancels the prefetch of the previous one. The prefetch uses
+at most config.prefetch_workers downloads at a time and pauses while an
+explicit plot runs, so it never competes with a request of the user.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from codebase import config
+from codebase.seisplot import get_waveforms
+from codebase.traveltimes import travel_times
+
+
+class Prefetcher:
+    """ Background fetches for the current selection with a bounded LRU cache """
+    def __init__(self, max_items=None, max_workers=None):
+        self.max_items = max_items if max_items is not None else config.prefetch_cache_size
+        self.max_workers = max_workers if max_workers is not None else config.prefetch_workers
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._downloading = set()
+        self._taken = set()
+        self._generation = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        self._resume = threading.Event()
+        self._resume.set()
+        self._n_explicit = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(origin_time, timewindow_start, timewindow_end, sta_code):
+        return (str(origin_time), timewindow_start, timewindow_end, sta_code)
+
+    def prefetch(self, origin_time, timewindow_start, timewindow_end, sta_codes, depth_in_km=None):
+        """
+        Start the background downloads for the given event window and
+        stations. Prefetches of an earlier selection are cancelled.
+        """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            self._taken.clear()
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+
+            # The travel-time rows take long to compute, they are prepared on a
+            # thread of their own so that the downloads do not wait for them
+            if depth_in_km is not None:
+                threading.Thread(target=self._prepare_travel_times,
+                                 args=(generation, depth_in_km), daemon=True).start()
+
+            for sta_code in dict.fromkeys(sta_codes):
+                if not sta_code:
+                    continue
+                key = self._key(origin_time, timewindow_start, timewindow_end, sta_code)
+                if key in self._cache:
+                    continue
+                self._pending[key] = self._executor.submit(
+                    self._fetch, generation, key, origin_time, timewindow_start,
+                    timewindow_end, sta_code)
+
+    def cancel(self):
+        """ Cancel all prefetches that have not started yet """
+        with self._lock:
+            self._generation += 1
+            for future in self._pending.values():
+                future.cancel()
+            self._pending = {}
+
+    def _prepare_travel_times(self, generation, depth_in_km):
+        """ Compute the table rows of the depth (background thread) """
+        def proceed():
+            # Pauses during a plot and stops when the selection changes
+            self._resume.wait()
+            return generation == self._generation
+
+        travel_times.prepare(max(depth_in_km, 0.0), proceed)
+
+    def _fetch(self, generation, key, origin_time, timewindow_start, timewindow_end, sta_code):
+        """ Download one window unless the selection changed (background) """
+        self._resume.wait()
+        with self._lock:
+            if generation != self._generation or key in self._taken:
+                self._taken.discard(key)
+                return None
+            self._downloading.add(key)
+        try:
+            stream = get_waveforms(origin_time, timewindow_start, timewindow_end, sta_code)
+        finally:
+            with self._lock:
+                self._downloading.discard(key)
+        with self._lock:
+            if stream:
+                self._cache[key] = stream
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_items:
+                    self._cache.popitem(last=False)
+            if self._pending.get(key) is not None and self._pending[key].done():
+                del self._pending[key]
+        return stream
+
+    def take(self, origin_time, timewindow_start, timewindow_end, sta_code):
+        """
+        Return a copy of the prefetched stream, or None. If the download of
+        the window is already running, wait for it instead of starting a
+        second request. A prefetch of the window that has not started yet is
+        dropped, as the caller downloads the window itself.
+        """
+        key = self._key(origin_time, timewindow_start, timewindow_end, sta_code)
+        with self._lock:
+            stream = self._cache.get(key)
+            future = self._pending.get(key)
+            if stream is None and future is not None and key not in self._downloading:
+                # Queued, or waiting for the end of the pause of the plot
+                if not future.cancel():
+                    self._taken.add(key)
+                del self._pending[key]
+                future = None
+        if stream is None and future is not None:
+            try:
+                stream = future.result(timeout=config.download_timeout)
+            except Exception:
+                stream = None
+
+        with self._lock:
+            if stream is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key in self._cache:
+                self._cache.move_to_end(key)
+        # The plots process the streams in place
+        return stream.copy()
+
+    def paused(self):
+        """ Context manager that pauses the prefetch while an explicit plot runs """
+        return _Pause(self)
+
+    def _pause(self):
+        with self._lock:
+            self._n_explicit += 1
+            self._resume.clear()
+
+    def _unpause(self):
+        with self._lock:
+            self._n_explicit -= 1
+            if self._n_explicit == 0:
+                self._resume.set()
+
+
+class _Pause:
+    def __init__(self, prefetcher):
+        self.prefetcher = prefetcher
+
+    def __enter__(self):
+        self.prefetcher._pause()
+        return self.prefetcher
+
+    def __exit__(self, *exc):
+        self.prefetcher._unpause()
+
+
+# Prefetcher shared by the GUI and the plots
+prefetcher = Prefetcher()
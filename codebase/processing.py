@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-processing of the waveforms shared by the seismogram plots.
+
+The traces are merged, demeaned and bandpass filtered at the recorded
+sample rate. The bandpass also acts as anti-alias filter, so the traces can
+then be decimated to the 'sampling-rate' of the region (a few times the
+upper corner frequency) before the response removal and the trim run on
+far fewer samples. The response is removed as in obspy's remove_response,
+but with the inverted response spectra from the response cache.
+
+process_section does the same for the vertical components of all stations
+of the section plot at once: traces with the same sample rate and length
+are stacked into a 2-D array and every step runs along axis 1.
+"""
+import numpy as np
+from scipy.signal import iirfilter, sosfilt, zpk2sos
+from obspy.signal.invsim import cosine_taper
+from obspy.signal.util import _npts2nfft
+from codebase import config
+from codebase.responsecache import response_cache
+from codebase.tracestore import TraceStore
+from codebase.timing import span
+
+
+def decimate(stream, sampling_rate):
+    """
+    Decimate the traces of the stream by an integer factor to a sample rate
+    of at least sampling_rate Hz. Must be called after a lowpass or bandpass
+    filter well below the new Nyquist frequency, as no anti-alias filter is
+    applied here. Traces that are already slow enough are left unchanged.
+    """
+    if not sampling_rate:
+        return stream
+    for tr in stream:
+        factor = int(tr.stats.sampling_rate // sampling_rate)
+        if factor > 1:
+            tr.decimate(factor, no_filter=True)
+    return stream
+
+
+def process_stream(stream, fmin, fmax, starttime, endtime, sampling_rate=None):
+    """
+    Merge, demean, bandpass filter, decimate to sampling_rate (if given),
+    remove the response (velocity) and trim the stream in place.
+    """
+    with span("merge"):
+        stream.merge(fill_value='interpolate', method=0)
+    with span("filter"):
+        stream.detrend('demean')
+        stream.filter('bandpass', freqmin=fmin, freqmax=fmax, corners=4, zerophase=True)
+    with span("decimate"):
+        decimate(stream, sampling_rate)
+    with span("remove_response"):
+        remove_response(stream)
+    with span("trim"):
+        stream.trim(starttime=starttime, endtime=endtime)
+    return stream
+
+
+def bandpass_sos(fmin, fmax, sampling_rate, corners=4):
+    """ Butterworth bandpass as second-order sections, as obspy's bandpass """
+    fe = 0.5 * sampling_rate
+    z, p, k = iirfilter(corners, [fmin / fe, fmax / fe], btype='band',
+                        ftype='butter', output='zpk')
+    return zpk2sos(z, p, k)
+
+
+def response_spectra(traces, delta, nfft, water_level=60):
+    """
+    Inverted velocity response spectra (one row per trace) with the
+    water level applied, as used by obspy's remove_response. The spectra
+    are taken from the response cache.
+    """
+    spectra = np.empty((len(traces), nfft // 2 + 1), dtype=np.complex128)
+    for row, tr in enumerate(traces):
+        spectra[row] = response_cache.get(tr, delta, nfft, "VEL", water_level)
+    return spectra
+
+
+def deconvolve(data, traces, delta, water_level=60, spectra=None):
+    """
+    Remove the responses of the traces from the rows of data (velocity)
+    as obspy's remove_response does with its defaults: zero mean, 5 %
+    cosine taper and division by the response with a water level. The
+    inverted response spectra can be given instead of the traces.
+    """
+    npts = data.shape[1]
+    data = data - data.mean(axis=1, keepdims=True)
+    data *= cosine_taper(npts, 0.05, sactaper=True, halfcosine=False)
+    nfft = _npts2nfft(npts)
+    spectrum = np.fft.rfft(data, n=nfft, axis=1)
+    spectrum *= response_spectra(traces, delta, nfft, water_level) if spectra is None else spectra
+    spectrum[:, -1] = np.abs(spectrum[:, -1]) + 0.0j
+    return np.fft.irfft(spectrum, axis=1)[:, :npts]
+
+
+def remove_response(stream):
+    """
+    Remove the attached responses of all traces of the stream (velocity),
+    with the response spectra from the response cache
+    """
+    for tr in stream:
+        if tr.stats.npts == 0:
+            continue
+        data = tr.data.astype(np.float64)[np.newaxis, :]
+        tr.data = deconvolve(data, [tr], tr.stats.delta)[0]
+    return stream
+
+
+def _decimation(df, sampling_rate):
+    """ Return the decimation factor to sampling_rate and the new sample rate """
+    factor = int(df // sampling_rate) if sampling_rate else 1
+    return (factor, df / factor) if factor > 1 else (1, df)
+
+
+def _filter_block(data, fmin, fmax, df, sampling_rate):
+    """ Demean, bandpass and decimate the rows of data (in place where possible) """
+    data -= data.mean(axis=1, keepdims=True)
+
+    # Zero-phase bandpass: forward and backward pass along the rows
+    sos = bandpass_sos(fmin, fmax, df)
+    data = sosfilt(sos, data, axis=1)
+    data = sosfilt(sos, data[:, ::-1], axis=1)[:, ::-1]
+
+    factor, df = _decimation(df, sampling_rate)
+    return data[:, ::factor] if factor > 1 else data
+
+
+def _process_block(traces, fmin, fmax, sampling_rate):
+    """
+    Demean, bandpass, decimate and remove the response of traces with the
+    same sample rate and length. Returns the 2-D array and the new sample rate.
+    """
+    df = traces[0].stats.sampling_rate
+    with span("filter", traces=len(traces)):
+        data = np.array([tr.data for tr in traces], dtype=np.float64)
+        data = _filter_block(data, fmin, fmax, df, sampling_rate)
+    df = _decimation(df, sampling_rate)[1]
+
+    with span("remove_response", traces=len(traces)):
+        return deconvolve(data, traces, 1.0 / df), df
+
+
+def process_section(streams, fmin, fmax, starttime, endtime, sampling_rate=None,
+                    component="Z"):
+    """
+    Process the given component of all streams like process_stream, but
+    batched over the traces with the same sample rate and length (at most
+    config.section_batch_size at a time). Returns a list with the processed
+    trace or None for each stream and an array of the peak amplitudes
+    (NaN for the missing traces). With config.use_trace_store, the samples
+    of the processed traces are views of a memory-mapped file and the
+    entries of the streams list are set to None.
+    """
+    traces = [None] * len(streams)
+    with span("merge", traces=len(streams)):
+        for idx, st in enumerate(streams):
+            try:
+                st.merge(fill_value='interpolate', method=0)
+                tr = st.select(component=component)[0]
+                tr.stats.response
+            except Exception:
+                continue
+            if tr.stats.npts > 1:
+                traces[idx] = tr
+
+    # Group the traces by sample rate and number of samples
+    groups = {}
+    for idx, tr in enumerate(traces):
+        if tr is not None:
+            groups.setdefault((tr.stats.sampling_rate, tr.stats.npts), []).append(idx)
+
+    # The batches are limited to half of config.section_memory_limit (the
+    # other half holds the downloaded streams, see
+    # download.station_group_size), about six arrays of the batch are
+    # needed at the same time (samples, two filter passes, the padded
+    # spectrum and the result).
+    batches = []
+    for (_, npts), indices in groups.items():
+        batch_size = config.section_batch_size or len(streams)
+        if config.section_memory_limit:
+            batch_size = min(batch_size, max(1, config.section_memory_limit // 2 // (6 * 8 * npts)))
+        batches += [indices[first:first + batch_size]
+                    for first in range(0, len(indices), batch_size)]
+
+    # With the trace store, the processed samples are kept in a memory-mapped
+    # file. The streams of the list are released once their trace is taken,
+    # the raw samples once the trace is processed.
+    store = None
+    if config.use_trace_store and groups:
+        capacity = sum(len(range(0, npts, _decimation(df, sampling_rate)[0])) * len(indices)
+                       for (df, npts), indices in groups.items())
+        store = TraceStore(capacity)
+        for idx in range(len(streams)):
+            streams[idx] = None
+
+    peaks = np.full(len(streams), np.nan)
+    for rows in batches:
+        block = [traces[idx] for idx in rows]
+        try:
+            data, df = _process_block(block, fmin, fmax, sampling_rate)
+        except Exception:
+            for idx in rows:
+                traces[idx] = None
+            continue
+
+        offsets = []
+        for tr, row in zip(block, data):
+            with span("trim", station=tr.stats.station):
+                before = tr.stats.starttime
+                tr.data = row
+                tr.stats.sampling_rate = df
+                tr.trim(starttime=starttime, endtime=endtime)
+            offsets.append((int(round((tr.stats.starttime - before) * df)), tr.stats.npts))
+
+        # Peak amplitudes of the trimmed rows in one reduction if the
+        # rows were trimmed alike
+        offset, npts = offsets[0]
+        if npts > 0 and offsets.count(offsets[0]) == len(offsets):
+            peaks[rows] = np.abs(data[:, offset:offset + npts]).max(axis=1)
+        else:
+            for idx, tr in zip(rows, block):
+                if tr.stats.npts > 0:
+                    peaks[idx] = np.abs(tr.data).max()
+
+        # The processed samples move to the memory-mapped store
+        if store is not None:
+            for tr in block:
+                tr.data = store.put(tr.data)
+
+    for idx, tr in enumerate(traces):
+        if tr is not None and tr.stats.npts == 0:
+            traces[idx] = None
+    if store is not None:
+        store.close()
+    return traces, peaks
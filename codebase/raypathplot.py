@@ -1,20 +1,21 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from IPython.display import display, clear_output
+from matplotlib.figure import Figure
 import obspy
-from obspy.taup import TauPyModel
 from obspy.clients.fdsn import Client
-from obspy.geodetics import gps2dist_azimuth
 from codebase import config
 from codebase.seisplot import get_waveforms
+from codebase.geodesy import geodesics
+from codebase.plotutils import PlotOutput
+from codebase.timing import profiled, span
 
 # The phases to include in the plot
 phase_list = ['p', 'P', 'PP', 's', 'S', 'SS']
 
-def plot_ray_paths(raspberry):
+@profiled("plot_ray_paths", output="seis_output")
+def plot_ray_paths(raspberry, directory=None):
     """ Plot the ray paths of the selected seismic phases."""
-    with raspberry.seis_output:
-        clear_output(wait=True)
+    with PlotOutput(raspberry.seis_output, directory) as output:
+        output.clear(wait=True)
 
         selected_eq = raspberry.get_earthquake_quakeml()
         eq_depth = selected_eq.origins[0].depth / 1000.0
@@ -25,10 +26,8 @@ def plot_ray_paths(raspberry):
         sta_lon = selected_sta[0][0].longitude
         sta_lat = selected_sta[0][0].latitude
 
-        distance, _, _ = gps2dist_azimuth(eq_lat, eq_lon, sta_lat, sta_lon)
-        distance = distance / 1000.0
-        # Convert km to degrees
-        distance_in_deg = distance / 111.0
+        # Angular distance between the event and the station
+        distance_in_deg = geodesics(eq_lat, eq_lon, sta_lat, sta_lon)[3]
 
         if eq_depth < 0:
             eq_depth = 1.0
@@ -39,13 +38,15 @@ def plot_ray_paths(raspberry):
         else:
             plot_type = 'cartesian'
             
-        model = TauPyModel(model="iasp91")
-        arrivals = model.get_ray_paths(source_depth_in_km=eq_depth, 
-                                       distance_in_degree=distance_in_deg,
-                                       phase_list=phase_list)
+        with span("taup"):
+            arrivals = config.model.get_ray_paths(source_depth_in_km=eq_depth, 
+                                           distance_in_degree=distance_in_deg,
+                                           phase_list=phase_list)
         
-        arrivals.plot_rays(plot_type=plot_type, legend=True, show=False)
+        with span("plot"):
+            fig = Figure()
+            arrivals.plot_rays(plot_type=plot_type, legend=True, show=False, fig=fig)
 
-        plt.savefig("ray_paths.png")
-        plt.show()
+        with span("savefig"):
+            output.show(fig, "ray_paths.png")
 
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory cache of the evaluated and inverted instrument response spectra
+used for the response removal. Only a few dozen channels and window
+lengths occur, so the spectra are reused across traces and clicks instead
+of evaluating the full response of every trace again. The least recently
+used spectra are evicted once the cache exceeds its size limit.
+"""
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+from obspy.signal.invsim import invert_spectrum
+from codebase import config
+from codebase.stationindex import get_station_index
+
+
+def response_epoch(tr):
+    """
+    Identify the response of the trace: the start of the channel epoch from
+    the station index or, for channels not in the index, a hash of the
+    response itself
+    """
+    index = get_station_index()
+    if index is not None:
+        epoch = index.response_epoch(tr.id, tr.stats.starttime)
+        if epoch is not None:
+            return str(epoch)
+    return hashlib.sha1(pickle.dumps(tr.stats.response)).hexdigest()
+
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache of inverted response spectra, keyed by SEED id,
+    response epoch, number of FFT points, sampling interval, output and
+    water level.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._spectra = OrderedDict()
+        self._size = 0
+
+    def get(self, tr, delta, nfft, output="VEL", water_level=60):
+        """
+        Return the inverted response spectrum of the trace for nfft points
+        at the sampling interval delta. The returned array must not be
+        modified.
+        """
+        key = (tr.id, response_epoch(tr), nfft, float(delta), output, water_level)
+        with self._lock:
+            spectrum = self._spectra.get(key)
+            if spectrum is not None:
+                self._spectra.move_to_end(key)
+                self.hits += 1
+                return spectrum
+            self.misses += 1
+
+        spectrum, _ = tr.stats.response.get_evalresp_response(delta, nfft, output=output)
+        if water_level is None:
+            spectrum[0] = 0.0
+            spectrum[1:] = 1.0 / spectrum[1:]
+        else:
+            invert_spectrum(spectrum, water_level)
+        spectrum.flags.writeable = False
+
+        with self._lock:
+            if key not in self._spectra:
+                self._spectra[key] = spectrum
+                self._size += spectrum.nbytes
+                self._evict()
+        return spectrum
+
+    def _evict(self):
+        """ Remove the least recently used spectra above the size limit """
+        while self._size > self.max_bytes and len(self._spectra) > 1:
+            _, spectrum = self._spectra.popitem(last=False)
+            self._size -= spectrum.nbytes
+
+    def clear(self):
+        """ Remove all spectra """
+        with self._lock:
+            self._spectra.clear()
+            self._size = 0
+
+    def statistics(self):
+        """ Return the hit and miss counters and the size of the cache """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._spectra),
+                "size": self._size,
+                "max_size": self.max_bytes,
+            }
+
+
+# Cache instance shared by all plots
+response_cache = ResponseCache(config.response_cache_size)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Routing table of the stations, built from the inventory loaded by
+RaspberryShake.query_stations. It maps every station code to its network,
+channels, location codes and operating epochs, so that get_waveforms can
+send exactly one correctly targeted request instead of trying the
+seismo-at-school network first and the Swiss network second. Windows for
+which a station returned no data are remembered as well and skipped.
+"""
+import threading
+import time
+from obspy import UTCDateTime
+from codebase import config
+
+
+def component_channels(channels, component):
+    """
+    Restrict a channel pattern to one component, e.g. 'EH*,HH*' to
+    'EHZ,HHZ' for 'Z'. Without component the pattern is returned unchanged.
+    """
+    if not component:
+        return channels
+    patterns = []
+    for pattern in channels.split(","):
+        if pattern == "*":
+            pattern = "??*"
+        if len(pattern) == 3 and pattern.endswith("*"):
+            pattern = pattern[:2] + component
+        patterns.append(pattern)
+    return ",".join(patterns)
+
+
+class StationRoute:
+    """ Network, channel pattern, location pattern and epochs of a station """
+    def __init__(self, network, station):
+        self.network = network
+        self.station = station
+        self.channels = set()
+        self.locations = set()
+        self.epochs = []
+
+    @property
+    def channel(self):
+        """ Channel pattern for the request, e.g. 'EH*' for EHZ/EHN/EHE """
+        bands = sorted({channel[:2] for channel in self.channels})
+        return ",".join(f"{band}*" for band in bands) if bands else "*"
+
+    @property
+    def location(self):
+        """ Location pattern for the request ('--' is the empty location code) """
+        locations = sorted(location or "--" for location in self.locations)
+        return ",".join(locations) if locations else "*"
+
+    def covers(self, starttime, endtime):
+        """ Return True if one of the epochs overlaps the time window """
+        for start, end in self.epochs:
+            if (start is None or start <= endtime) and (end is None or end >= starttime):
+                return True
+        return False
+
+
+class RoutingTable:
+    """
+    Station code -> route lookup with a negative cache for time windows
+    without data.
+    """
+    def __init__(self, no_data_ttl=None):
+        self.no_data_ttl = no_data_ttl if no_data_ttl is not None else config.no_data_ttl
+        self._routes = {}
+        self._no_data = {}
+        self._lock = threading.Lock()
+
+    def update(self, inventory):
+        """ (Re)build the routes from an inventory with channel information """
+        routes = {}
+        for network in inventory:
+            for station in network:
+                route = routes.setdefault(station.code, StationRoute(network.code, station.code))
+                for channel in station:
+                    route.channels.add(channel.code)
+                    route.locations.add(channel.location_code)
+                    route.epochs.append((channel.start_date, channel.end_date))
+                if len(station.channels) == 0:
+                    route.epochs.append((station.start_date, station.end_date))
+        with self._lock:
+            self._routes = routes
+
+    def knows(self, sta_code):
+        """ Return True if the station is in the routing table """
+        return sta_code in self._routes
+
+    def route(self, sta_code):
+        """ Return the route of a station or None if the station is unknown """
+        return self._routes.get(sta_code)
+
+    def mark_no_data(self, network, sta_code, starttime, endtime):
+        """ Remember that the station had no data in the time window """
+        with self._lock:
+            self._no_data[(network, sta_code, str(starttime), str(endtime))] = time.time()
+
+    def has_no_data(self, network, sta_code, starttime, endtime):
+        """
+        Return True if the station is known to have no data in the window,
+        either because no epoch covers it or because an earlier request for
+        the same window returned nothing.
+        """
+        route = self._routes.get(sta_code)
+        if route is not None and route.network == network and \
+                not route.covers(UTCDateTime(starttime), UTCDateTime(endtime)):
+            return True
+        key = (network, sta_code, str(starttime), str(endtime))
+        with self._lock:
+            marked = self._no_data.get(key)
+            if marked is None:
+                return False
+            if time.time() - marked > self.no_data_ttl:
+                del self._no_data[key]
+                return False
+            return True
+
+    def clear_no_data(self):
+        with self._lock:
+            self._no_data.clear()
+
+
+# Routing table shared by all plots
+routing_table = RoutingTable()
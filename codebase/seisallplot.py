@@ -3,15 +3,17 @@
 Plots vertical component seismograms from all stations 
 for the selected earthquake.
 """
-import matplotlib.pyplot as plt
 import numpy as np
-from IPython.display import display, clear_output
-import obspy
-from obspy.taup import TauPyModel
-from obspy.clients.fdsn import Client
-from obspy.geodetics import gps2dist_azimuth
+from matplotlib.figure import Figure
 from codebase import config
-from codebase.seisplot import get_waveforms
+from codebase.catalogcache import event_magnitude
+from codebase.download import (check_availability, get_all_waveforms, get_all_waveforms_bulk,
+                               station_group_size)
+from codebase.traveltimes import travel_times
+from codebase.plotutils import PlotOutput, pixel_columns, trace_envelope
+from codebase.processing import process_section
+from codebase.geodesy import geodesics, kilometers_to_degrees
+from codebase.timing import profiled, span
 
 # Network codes to plot
 networks_to_plot = ['S']
@@ -19,42 +21,73 @@ networks_to_plot = ['S']
 # Colors for the networks
 network_colors = {'CH': 'tab:cyan', 'S': 'black'}
 
-def plot_all_seismograms(raspberry):
+def plot_section_traces(ax, traces, distances, labels, timewindow_end):
+    """ 
+    Plots the traces at their distances with individually scaled amplitudes
+    and the station names on the right-hand side of the axes.
+    """
+    n_columns = pixel_columns(ax)
+
+    for idx, trace in enumerate(traces):
+        net = trace.stats.network
+
+        # Plot with individually scaled amplitudes. Long traces are reduced
+        # to a min/max pair per pixel column.
+        with span("plot_trace", station=trace.stats.station):
+            times, data = trace_envelope(trace, n_columns)
+            ax.plot(times, 5 * data / max(abs(trace.data)) + distances[idx],
+                    color=network_colors[net], label=labels[idx], linewidth=0.25,
+                    alpha=0.5)
+
+        # # Plot with relative amplitudes with respect to the maximum peak amplitude
+        # ax.plot(trace.times(), 50 * trace.data / max(peak_amplitudes) + distances[idx],  
+        #         color=network_colors[net], label=labels[idx], linewidth=0.5, 
+        #         alpha=0.8)
+        
+        
+        # Plot the station names right-hand side of the seismograms outside the plot area
+        ax.text(timewindow_end + 1, distances[idx], labels[idx], 
+                fontsize=8,  verticalalignment='center', 
+                horizontalalignment='left', color=network_colors[net], 
+                clip_on=False)
+
+
+@profiled("plot_all_seismograms", output="seis_output")
+def plot_all_seismograms(raspberry, directory=None):
     # Time windows and frequencies for the seismograms, depending the region scale
     if raspberry.is_region_switzerland():
         timewindow_start = config.regions["switzerland"]["filt-time-range"][0]
         timewindow_end = config.regions["switzerland"]["filt-time-range"][1]
         fmin, fmax = config.regions["switzerland"]["filt-freq-range"]
+        sampling_rate = config.regions["switzerland"]["sampling-rate"]
     elif raspberry.is_region_europe():
         timewindow_start = config.regions["europe"]["filt-time-range"][0]
         timewindow_end = config.regions["europe"]["filt-time-range"][1]
         fmin, fmax = config.regions["europe"]["filt-freq-range"]
+        sampling_rate = config.regions["europe"]["sampling-rate"]
     else:
         timewindow_start = config.regions["worldwide"]["filt-time-range"][0]
         timewindow_end = config.regions["worldwide"]["filt-time-range"][1]
         fmin, fmax = config.regions["worldwide"]["filt-freq-range"]
+        sampling_rate = config.regions["worldwide"]["sampling-rate"]
     
     # Use the seismogram plot output widget.
-    with raspberry.seis_output:
-        clear_output(wait=True)
+    with PlotOutput(raspberry.seis_output, directory) as output:
+        output.clear(wait=True)
 
         # Get the selected earthquake
         selected_eq  = raspberry.get_earthquake_quakeml()
         lon = selected_eq.origins[0].longitude
         lat = selected_eq.origins[0].latitude
-        mag = selected_eq.magnitudes[0].mag
+        mag = event_magnitude(selected_eq)
         depth = selected_eq.origins[0].depth / 1000.0
         origin_time = selected_eq.origins[0].time
 
         if depth < 0:
             depth = 0.0
 
-        # Combine all the networks into one inventory
-        inventory = obspy.Inventory()
-        if 'S' in networks_to_plot:
-            inventory += raspberry.get_S_inventory()
-        if 'CH' in networks_to_plot:
-            inventory += raspberry.get_CH_inventory()
+        # Station index with the codes and coordinates of all networks
+        index = raspberry.get_station_index()
 
         # Lists to store the distances, traces and labels
         distances = []
@@ -64,112 +97,120 @@ def plot_all_seismograms(raspberry):
         label_locs = []
         peak_amplitudes = []
 
-        # Loop over the networks
-        for net_idx, network in enumerate(networks_to_plot):
-            stations = inventory[net_idx]
-            # total number of stations
-            total_steps = len(stations)
-            
-            for sta_idx, station in enumerate(stations):
-                sta_lat = station.latitude
-                sta_lon = station.longitude
-                station_name = station.code
-                
-                # Get the seismogram. Use a try-except block to catch any errors and pass them.
-                try:
-                    st = get_waveforms(origin_time, timewindow_start, timewindow_end, station_name)
-
-                    # Calculate the progress percentage
-                    progress = (sta_idx + 1) / total_steps * 100
-                    # Print the progress percentage on the same line
-                    print(f"{network}.{station_name} --- Progress: {progress:.2f}%", end='\r')
-                    
+        # Download the waveforms of the stations concurrently and report
+        # the progress as the stations complete
+        def _progress(sta_code, n_done, n_total):
+            progress = n_done / n_total * 100
+            output.print(f"{sta_code} --- Progress: {progress:.2f}%", end='\r')
+
+        # The stations are downloaded and processed in groups that fit into
+        # the memory budget (config.section_memory_limit), so that only the
+        # raw streams of one group are held at a time
+        skipped = []
+        selected, processed, peaks = [], [], []
+        for network in networks_to_plot:
+            sta_codes = index.codes.get(network, [])
+            coordinates = dict(zip(sta_codes, zip(index.latitudes.get(network, []),
+                                                  index.longitudes.get(network, []))))
+            # Stations without data for the event window are not downloaded
+            if config.use_availability_check:
+                with span("availability", network=network, stations=len(sta_codes)):
+                    sta_codes, no_data = check_availability(
+                        origin_time, timewindow_start, timewindow_end, sta_codes,
+                        network=network)
+                skipped += [f"{network}.{sta_code}" for sta_code in no_data]
+
+            group_size = station_group_size(network, timewindow_start, timewindow_end, "Z") \
+                or max(1, len(sta_codes))
+            for first in range(0, len(sta_codes), group_size):
+                group = sta_codes[first:first + group_size]
+
+                def _group_progress(sta_code, n_done, n_group, offset=first,
+                                    n_total=len(sta_codes)):
+                    _progress(sta_code, offset + n_done, n_total)
+
+                with span("download", network=network, stations=len(group)):
+                    if config.use_bulk_download:
+                        streams = get_all_waveforms_bulk(
+                            origin_time, timewindow_start, timewindow_end, group,
+                            network=network, progress=_group_progress, component="Z")
+                    else:
+                        streams = get_all_waveforms(
+                            origin_time, timewindow_start, timewindow_end, group,
+                            progress=_group_progress, component="Z")
+
+                # Stations with data, in the order of the index. The streams
+                # are only referenced by section_streams, so that
+                # process_section can release them one by one.
+                group_selected = []
+                section_streams = []
+                for station_name in group:
+                    st = streams.pop(station_name, None)
                     if st and len(st) > 0:
-                        # Calculate the distance
-                        distance, _, _ = gps2dist_azimuth(lat, lon, sta_lat, sta_lon)
-                        distance = distance / 1000.0
-                        
-                        # Filter the seismogram
-                        st.merge(fill_value='interpolate', method=0)
-                        st.detrend("demean")
-                        tr = st.select(component="Z")[0]
-                        tr.remove_response(output="VEL")
-                        tr.filter("bandpass", freqmin=fmin, freqmax=fmax, corners=4, zerophase=True)
-                        tr.trim(starttime=origin_time, endtime=origin_time + timewindow_end)
-
-                        # Add the trace to the list
-                        traces.append(tr)
-                        distances.append(distance)
-                        peak_amplitudes.append(max(abs(tr.data)))
-                        dist_labels.append(round(distance, 1))
-                        labels.append(f"{network}.{station_name}")
-                        label_locs.append(distance)
-                except Exception as e:
-                    pass
-
-        print("")
-        print(f"Number of seismograms: {len(traces)}")
+                        group_selected.append((network, station_name) + coordinates[station_name])
+                        section_streams.append(st)
+                streams = st = None
+
+                # Filter, decimate and remove the response of the vertical
+                # components of the group at once. Stations that fail are
+                # returned as None.
+                with span("process", stations=len(group_selected)):
+                    group_processed, group_peaks = process_section(
+                        section_streams, fmin, fmax, origin_time,
+                        origin_time + timewindow_end, sampling_rate)
+                section_streams = None
+                selected += group_selected
+                processed += group_processed
+                peaks += list(group_peaks)
+
+        # Distances of all stations to the event in km
+        station_distances = geodesics(lat, lon, [sta_lat for _, _, sta_lat, _ in selected],
+                                      [sta_lon for _, _, _, sta_lon in selected])[0]
+
+        for (network, station_name, _, _), tr, peak, distance in zip(
+                selected, processed, peaks, station_distances):
+            if tr is None:
+                continue
+
+            # Add the trace to the list
+            traces.append(tr)
+            distances.append(distance)
+            peak_amplitudes.append(peak)
+            dist_labels.append(round(distance, 1))
+            labels.append(f"{network}.{station_name}")
+            label_locs.append(distance)
+
+        output.print("")
+        if skipped:
+            output.print(f"Stations skipped without data ({len(skipped)}): {', '.join(skipped)}")
+        output.print(f"Number of seismograms: {len(traces)}")
 
         if len(traces) == 0:
-            print("No seismograms found for the selected earthquake.")
+            output.print("No seismograms found for the selected earthquake.")
             return
         
         # Plot the seismograms at their respective distances. The amplitudes
         # are normalized to the maximum amplitude of each trace similar to
         # obspy section plot. It is also possible to plot the seismograms with
         # relative amplitudes normalized with the maximum of the peak amplitudes.
-        fig, ax = plt.subplots(figsize=(10, 12))
-
-        for idx, trace in enumerate(traces):
-            net = trace.stats.network
-
-            # Plot with individually scaled amplitudes
-            ax.plot(trace.times(), 5 * trace.data / max(abs(trace.data)) + distances[idx],
-                    color=network_colors[net], label=labels[idx], linewidth=0.25,
-                    alpha=0.5)
-
-            # # Plot with relative amplitudes with respect to the maximum peak amplitude
-            # ax.plot(trace.times(), 50 * trace.data / max(peak_amplitudes) + distances[idx],  
-            #         color=network_colors[net], label=labels[idx], linewidth=0.5, 
-            #         alpha=0.8)
-            
-            
-            # Plot the station names right-hand side of the seismograms outside the plot area
-            ax.text(timewindow_end + 1, distances[idx], labels[idx], 
-                    fontsize=8,  verticalalignment='center', 
-                    horizontalalignment='left', color=network_colors[net], 
-                    clip_on=False)
+        fig = Figure(figsize=(10, 12))
+        ax = fig.subplots()
+        with span("plot"):
+            plot_section_traces(ax, traces, distances, labels, timewindow_end)
             
-        model = TauPyModel(model='iasp91')
-        p = []
-        s = []
-        p_dist = []
-        s_dist = []
-        for d in distances + [max(distances) + 50]:
-            # P-wave arrival
-            arrivals = model.get_ray_paths(
-                source_depth_in_km=depth, 
-                distance_in_degree=d/111., 
-                phase_list=config.p_phases)
-            
-            p.append(arrivals[0].time)
-            p_dist.append(d)
-
-            # S-wave arrival
-            arrivals = model.get_ray_paths(
-                source_depth_in_km=depth, 
-                distance_in_degree=d/111., 
-                phase_list=config.s_phases)
-            
-            s.append(arrivals[0].time)
-            s_dist.append(d)
-
-        # Sort the distances and travel times tigether
-        p, p_dist = zip(*sorted(zip(p, p_dist)))
-        s, s_dist = zip(*sorted(zip(s, s_dist)))
-
-        ax.plot(p, p_dist, color='red', label='P', linewidth=2.0, linestyle=':')
-        ax.plot(s, s_dist, color='blue', label='S', linewidth=2.0, linestyle=':') 
+        # First arriving P and S as dense curves from the travel-time table.
+        # Without the table rows of the depth, TauP is called only at the
+        # station distances.
+        with span("travel_times"):
+            if travel_times.covers(depth):
+                curve_dist = np.linspace(0, max(distances) + 50, 500)
+            else:
+                curve_dist = np.sort(np.append(distances, max(distances) + 50))
+            p = travel_times.first_arrival('P', depth, kilometers_to_degrees(curve_dist))
+            s = travel_times.first_arrival('S', depth, kilometers_to_degrees(curve_dist))
+
+        ax.plot(p, curve_dist, color='red', label='P', linewidth=2.0, linestyle=':')
+        ax.plot(s, curve_dist, color='blue', label='S', linewidth=2.0, linestyle=':') 
 
         ax.set_title(f"{origin_time} (M{mag:.1f}, Z= {depth:.1f} km)")
         ax.set_xlabel("Time/Zeit [s]")
@@ -182,14 +223,15 @@ def plot_all_seismograms(raspberry):
             ax.set_ylim(0, max(distances) + 50)
 
         if len(traces) > 0:
-            plt.savefig('waveform_section.png', dpi=200, bbox_inches='tight')
-            plt.show()
+            with span("savefig"):
+                output.show(fig, 'waveform_section.png', dpi=config.plot_dpi, bbox_inches='tight')
 
 
         # Distance vs. amplitude plot. Use it a try-except block to catch any errors 
         # and to avoid empty figures shown in the notebook.
         try:
-            fig, ax = plt.subplots(figsize=(10, 6))
+            fig = Figure(figsize=(10, 6))
+            ax = fig.subplots()
             ax.scatter(dist_labels, np.asarray(peak_amplitudes) * 100, color='tab:cyan',
                        edgecolors='black', s=40)
             ax.set_xlabel("Distance [km]")
@@ -198,10 +240,11 @@ def plot_all_seismograms(raspberry):
             ax.grid(axis='both', linestyle=':', linewidth=0.5, which='both')
             ax.set_yscale('log')
             ax.set_xscale('log')
-            plt.savefig('distance_vs_amplitude.png', dpi=200, bbox_inches='tight')
-            plt.show()
+            with span("savefig"):
+                output.show(fig, 'distance_vs_amplitude.png', dpi=config.plot_dpi,
+                            bbox_inches='tight')
         except Exception as e:
-            print("Error plotting distance vs. amplitude:", e)
+            output.print("Error plotting distance vs. amplitude:", e)
             pass
               
 
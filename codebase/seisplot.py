@@ -3,45 +3,113 @@
 Plots the 3-component seismogram of the selected earthquake as
 recorded at the selected station.
 """
-import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-from IPython.display import display, clear_output
-from obspy.taup import TauPyModel
-from obspy.clients.fdsn import Client
-from obspy.geodetics import gps2dist_azimuth
-from codebase import config
+from obspy.clients.fdsn.header import FDSNNoDataException
+from codebase import config, waveformsource
+from codebase.catalogcache import event_magnitude
+from codebase.waveformcache import waveform_cache
+from codebase.singleflight import single_flight
+from codebase.traveltimes import travel_times
+from codebase.routing import component_channels, routing_table
+from codebase.availability import availability_index
+from codebase.plotutils import PlotOutput, pixel_columns, trace_envelope
+from codebase.processing import process_stream
+from codebase.geodesy import geodesics
+from codebase.timing import profiled, span
 
-def predict_arrivals(station_lon, station_lat, event_lon, event_lat, event_depth_in_km, phase_list):
+def predict_first_arrival(station_lon, station_lat, event_lon, event_lat, event_depth_in_km, kind):
     """
-    Predicts the phase arrivals for the given earthquake and station parameters.
+    Predicts the first arriving P or S phase (kind 'P' or 'S') from the 
+    precomputed travel-time table. Returns the phase name and the travel 
+    time in seconds, or None if there is no arrival.
     """
-    if not isinstance(phase_list, list):
-        phase_list = [phase_list]
+    distance_in_deg = geodesics(station_lat, station_lon, event_lat, event_lon)[3]
+    with span("travel_times", phase=kind):
+        time, name = travel_times.first_arrival_with_name(kind, event_depth_in_km,
+                                                          distance_in_deg)
+        if np.isnan(time):
+            return None
+        return name, time
 
-    model = TauPyModel(model="iasp91")
-    distance, _, _ = gps2dist_azimuth(station_lat, station_lon, 
-                                      event_lat, event_lon)
-    distance = distance / 1000.0
-    arrivals = model.get_travel_times(source_depth_in_km=event_depth_in_km,
-                                      distance_in_degree=distance/111.0,
-                                      phase_list=phase_list)
-    return arrivals
 
+def download_waveforms(network, sta_code, channel, starttime, endtime, timeout, location="*"):
+    """ 
+    Get the waveforms of one station and network from the waveform sources
+    (local archives, then FDSN). Windows that were downloaded before are
+    read from the local waveform cache.
+    """
+    if config.use_waveform_cache:
+        with span("waveform_cache", station=sta_code):
+            stream = waveform_cache.get(network, sta_code, channel, starttime, endtime)
+        if stream:
+            return stream
+
+    def _download():
+        stream, source = waveformsource.get_waveforms(
+            network, sta_code, location, channel, starttime, endtime, timeout)
+        # Only the downloads are cached, the local archives are read directly
+        if config.use_waveform_cache and source.remote:
+            waveform_cache.put(network, sta_code, channel, starttime, endtime, stream)
+        return stream
 
-def get_waveforms(origin_time, timewindow_start, timewindow_end, sta_code):
-    """ Download the waveform data for the selected station and earthquake"""
     try:
-        stream = Client("ETH").get_waveforms(
-            network="S", station=sta_code, location="*", channel="EH*", 
-            starttime=origin_time + timewindow_start - 60,
-            endtime=origin_time + timewindow_end + 60, attach_response=True)
-    except:
+        if not config.use_waveform_cache:
+            stream = _download()
+        else:
+            # The same window requested by other processes at the same time is
+            # downloaded once, the others read it from the waveform cache
+            downloaded = []
+            single_flight.run(("waveforms", network, sta_code, location, channel,
+                               str(starttime), str(endtime)),
+                              lambda: downloaded.append(_download()))
+            stream = downloaded[0] if downloaded else \
+                waveform_cache.get(network, sta_code, channel, starttime, endtime) or _download()
+    except FDSNNoDataException:
+        routing_table.mark_no_data(network, sta_code, starttime, endtime)
+        availability_index.record(network, [sta_code], starttime, endtime, has_data=False)
+        raise
+    availability_index.record(network, [sta_code], starttime, endtime, has_data=True)
+    return stream
+
+
+def get_waveforms(origin_time, timewindow_start, timewindow_end, sta_code, timeout=None,
+                  component=None):
+    """
+    Download the waveform data for the selected station and earthquake,
+    only of the given component (e.g. 'Z') if one is given
+    """
+    if timeout is None:
+        timeout = config.download_timeout
+    starttime = origin_time + timewindow_start - 60
+    endtime = origin_time + timewindow_end + 60
+
+    # Stations in the routing table get exactly one request to their network
+    route = routing_table.route(sta_code)
+    if route is not None:
+        if routing_table.has_no_data(route.network, sta_code, starttime, endtime):
+            return None
         try:
-            stream = Client("ETH").get_waveforms(
-                network="CH", station=sta_code, location="*", channel="HH*",
-                starttime = origin_time + timewindow_start - 60, 
-                endtime = origin_time + timewindow_end + 60, attach_response=True)
+            return download_waveforms(route.network, sta_code,
+                                      component_channels(route.channel, component),
+                                      starttime, endtime, timeout, location=route.location)
+        except Exception as e:
+            return None
+
+    # Unknown stations: try the seismo-at-school network first, then the Swiss network
+    try:
+        if routing_table.has_no_data("S", sta_code, starttime, endtime):
+            raise FDSNNoDataException("No data available")
+        stream = download_waveforms("S", sta_code, component_channels("EH*", component),
+                                    starttime, endtime, timeout)
+    except Exception:
+        try:
+            if routing_table.has_no_data("CH", sta_code, starttime, endtime):
+                raise FDSNNoDataException("No data available")
+            stream = download_waveforms("CH", sta_code, component_channels("HH*", component),
+                                        starttime, endtime, timeout)
         except Exception as e:
             stream = None
 
@@ -53,7 +121,7 @@ def plot_three_component_seismogram(stream, axZ, axN, axE):
     """
     for tr in stream:
         if tr.stats.channel[-1] == 'Z':
-            axZ.plot(tr.times("matplotlib"), tr.data, label=tr.stats.channel,
+            axZ.plot(*trace_envelope(tr, pixel_columns(axZ), "matplotlib"), label=tr.stats.channel,
                     color='black', lw=1, alpha=0.7)
             axZ.xaxis_date()
 
@@ -63,7 +131,7 @@ def plot_three_component_seismogram(stream, axZ, axN, axE):
             axZ.grid(True, which='minor', axis='x', linestyle='--', linewidth=0.5)  # Denser grid for minor            
             
         elif tr.stats.channel[-1] == 'N':
-            axN.plot(tr.times("matplotlib"), tr.data, label=tr.stats.channel,
+            axN.plot(*trace_envelope(tr, pixel_columns(axN), "matplotlib"), label=tr.stats.channel,
                     color='black', lw=1, alpha=0.7)
             axN.xaxis_date()
             
@@ -73,7 +141,7 @@ def plot_three_component_seismogram(stream, axZ, axN, axE):
             axN.grid(True, which='minor', axis='x', linestyle='--', linewidth=0.5)  # Denser grid for minor            
     
         else:
-            axE.plot(tr.times("matplotlib"), tr.data, label=tr.stats.channel,
+            axE.plot(*trace_envelope(tr, pixel_columns(axE), "matplotlib"), label=tr.stats.channel,
                     color='black', lw=1, alpha=0.7)
             axE.xaxis_date()
             axE.set_ylabel('Velocity [m/s]')
@@ -93,8 +161,11 @@ def plot_phase(axes, phase_time, color, phase_name):
         ax.axvline(phase_time, color=color, linestyle='--', lw=2,
                    label=f"{phase_name}")
         
-def seismogram_plot(raspberry):
+@profiled("seismogram_plot", output="seis_output")
+def seismogram_plot(raspberry, directory=None):
     """ Plots the waveform of the selected earthquake at the selected station """
+    from codebase.prefetch import prefetcher
+
     # Get the selected earthquake and station as quakeml and inventory objects
     selected_eq  = raspberry.get_earthquake_quakeml()
     selected_sta = raspberry.get_selected_station_inventory()[0][0]
@@ -102,12 +173,14 @@ def seismogram_plot(raspberry):
     # Event parameters
     event_lon = selected_eq.origins[0].longitude
     event_lat = selected_eq.origins[0].latitude
-    mag = selected_eq.magnitudes[0].mag
+    mag = event_magnitude(selected_eq)
     origin_time = selected_eq.origins[0].time
     region = selected_eq.event_descriptions[0].text
     depth_in_km = selected_eq.origins[0].depth / 1000.0
+    output = PlotOutput(raspberry.seis_output, directory)
+    output.clear()
     if depth_in_km < 0:
-        print(f"The depth is negative at {depth_in_km}, setting it to 0 km")
+        output.print(f"The depth is negative at {depth_in_km}, setting it to 0 km")
         depth_in_km = 0.0
 
     # Station parameters
@@ -121,141 +194,137 @@ def seismogram_plot(raspberry):
         timewindow_start = config.regions["switzerland"]["filt-time-range"][0]
         timewindow_end = config.regions["switzerland"]["filt-time-range"][1]
         fmin, fmax = config.regions["switzerland"]["filt-freq-range"]
+        sampling_rate = config.regions["switzerland"]["sampling-rate"]
     elif raspberry.is_region_europe():
         timewindow_start = config.regions["europe"]["filt-time-range"][0]
         timewindow_end = config.regions["europe"]["filt-time-range"][1]
         fmin, fmax = config.regions["europe"]["filt-freq-range"]
+        sampling_rate = config.regions["europe"]["sampling-rate"]
     else:
         timewindow_start = config.regions["worldwide"]["filt-time-range"][0]
         timewindow_end = config.regions["worldwide"]["filt-time-range"][1]
         fmin, fmax = config.regions["worldwide"]["filt-freq-range"]
+        sampling_rate = config.regions["worldwide"]["sampling-rate"]
 
     # Use the output widget to display the seismogram
-    with raspberry.seis_output:
-        clear_output()
-        
-        print(f"Selected earthquake:")
-        print(f"  Location: {event_lon:.2f} E, {event_lat:.2f} N")
-        print(f"  Magnitude: {mag:.1f}")
-        print(f"  Depth: {depth_in_km:.1f} km")
-        print(f"  Origin time: {origin_time}")
-        print(f"  Region: {region}")
-        print("\n")
-
-        # Get the waveforms for raspberry shake and the closest SED station
-        stream = get_waveforms(origin_time, timewindow_start, timewindow_end, station_name)
-        sed_stream = get_waveforms(origin_time, timewindow_start, timewindow_end, sed_station_name)
+    with output:
+        output.print(f"Selected earthquake:")
+        output.print(f"  Location: {event_lon:.2f} E, {event_lat:.2f} N")
+        output.print(f"  Magnitude: {mag:.1f}")
+        output.print(f"  Depth: {depth_in_km:.1f} km")
+        output.print(f"  Origin time: {origin_time}")
+        output.print(f"  Region: {region}")
+        output.print("\n")
+
+        # Get the waveforms for raspberry shake and the closest SED station,
+        # prefetched in the background if available
+        with span("get_waveforms", station=station_name):
+            stream = prefetcher.take(origin_time, timewindow_start, timewindow_end, station_name)
+            if stream is None:
+                stream = get_waveforms(origin_time, timewindow_start, timewindow_end, station_name)
+        with span("get_waveforms", station=sed_station_name):
+            sed_stream = prefetcher.take(origin_time, timewindow_start, timewindow_end, sed_station_name)
+            if sed_stream is None:
+                sed_stream = get_waveforms(origin_time, timewindow_start, timewindow_end, sed_station_name)
 
         # RasberryShake waveforms
         if stream:
-            fig, (axZ, axN, axE) = plt.subplots(nrows=3, ncols=1, figsize=(11, 4),
-                                            sharex=True, sharey=True)
+            fig = Figure(figsize=(11, 4))
+            axZ, axN, axE = fig.subplots(nrows=3, ncols=1, sharex=True, sharey=True)
             axZ.set_title(f"Raspberry Shake {station_name}", fontsize=12)
 
             # Pre-process before plotting
-            stream.merge(fill_value='interpolate', method=0)
-            stream.detrend('demean')
-            stream.filter('bandpass', freqmin=fmin, freqmax=fmax, corners=4, zerophase=True)
-            stream.remove_response(output="VEL")
-            stream.trim(starttime=origin_time + timewindow_start, 
-                        endtime=origin_time + timewindow_end)
+            with span("process", station=station_name):
+                process_stream(stream, fmin, fmax, origin_time + timewindow_start,
+                               origin_time + timewindow_end, sampling_rate)
             
             # Plot the seismogram on the axes
-            plot_three_component_seismogram(stream, axZ, axN, axE)
+            with span("plot", station=station_name):
+                plot_three_component_seismogram(stream, axZ, axN, axE)
             
-            distance = gps2dist_azimuth(station_lat, station_lon, event_lat, event_lon)[0]
-            print(f"Distance between the event and the station {station_name}: {distance/1000:.1f} km")
-
-            # Predict the P and S arrivals. The first arriving P/S will be 
-            # determined from the list returned by the TauPyModel
-            P_arrival = predict_arrivals(
-                station_lon, station_lat, event_lon, event_lat, depth_in_km, config.p_phases)
-            S_arrival = predict_arrivals(
-                station_lon, station_lat, event_lon, event_lat, depth_in_km, config.s_phases)
-                
-            P_arrival.sort(key=lambda x: x.time)
-            S_arrival.sort(key=lambda x: x.time)
-
-            if P_arrival is not None and len(P_arrival) > 0:
-                print(f"{P_arrival[0].name} arrival at {station_name}: {origin_time + P_arrival[0].time}")
-                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + P_arrival[0].time,
+            distance = geodesics(station_lat, station_lon, event_lat, event_lon)[0]
+            output.print(f"Distance between the event and the station {station_name}: {distance:.1f} km")
+
+            # Predict the first arriving P and S phases from the travel-time table
+            P_arrival = predict_first_arrival(
+                station_lon, station_lat, event_lon, event_lat, depth_in_km, 'P')
+            S_arrival = predict_first_arrival(
+                station_lon, station_lat, event_lon, event_lat, depth_in_km, 'S')
+
+            if P_arrival is not None:
+                output.print(f"{P_arrival[0]} arrival at {station_name}: {origin_time + P_arrival[1]}")
+                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + P_arrival[1],
                            color='tab:red', phase_name='P')
             else:
-                print(f"P arrival at {station_name}: No prediction available")
+                output.print(f"P arrival at {station_name}: No prediction available")
 
-            if S_arrival is not None and len(S_arrival) > 0:
-                print(f"{S_arrival[0].name} arrival at {station_name}: {origin_time + S_arrival[0].time}")
-                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + S_arrival[0].time,
+            if S_arrival is not None:
+                output.print(f"{S_arrival[0]} arrival at {station_name}: {origin_time + S_arrival[1]}")
+                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + S_arrival[1],
                            color='tab:blue', phase_name='S')
             else:
-                print(f"S arrival at {station_name}: No prediction available")
+                output.print(f"S arrival at {station_name}: No prediction available")
 
             
             # Set the x-limit to the time window
             axZ.set_xlim(origin_time + timewindow_start, origin_time + timewindow_end)
 
-            plt.savefig(f"S.{station_name}_seismogram.png", dpi=200, bbox_inches='tight')
-            plt.show()
+            with span("savefig", station=station_name):
+                output.show(fig, f"S.{station_name}_seismogram.png", dpi=config.plot_dpi,
+                            bbox_inches='tight')
             
         else:
-            print(f"No data available for station {station_name} at Raspberry Shake network")
+            output.print(f"No data available for station {station_name} at Raspberry Shake network")
 
         # SED waveforms
         if sed_stream:
-            fig, (axZ, axN, axE) = plt.subplots(nrows=3, ncols=1, figsize=(11, 4),
-                                            sharex=True, sharey=True)
+            fig = Figure(figsize=(11, 4))
+            axZ, axN, axE = fig.subplots(nrows=3, ncols=1, sharex=True, sharey=True)
             axZ.set_title(f"SED {sed_station_name}", fontsize=12)
             # Pre-process before plotting
-            sed_stream.merge(fill_value='interpolate', method=0)
-            sed_stream.detrend('demean')
-            sed_stream.filter('bandpass', freqmin=fmin, freqmax=fmax, corners=4, zerophase=True)
-            sed_stream.remove_response(output="VEL")
-            sed_stream.trim(starttime=origin_time + timewindow_start, 
-                            endtime=origin_time + timewindow_end)
+            with span("process", station=sed_station_name):
+                process_stream(sed_stream, fmin, fmax, origin_time + timewindow_start,
+                               origin_time + timewindow_end, sampling_rate)
             
-            plot_three_component_seismogram(sed_stream, axZ, axN, axE)
+            with span("plot", station=sed_station_name):
+                plot_three_component_seismogram(sed_stream, axZ, axN, axE)
 
             # SED station info
             sed_sta = raspberry.get_sed_station_inventory()[0][0]
             sed_lat = sed_sta.latitude
             sed_lon = sed_sta.longitude
-            distance = gps2dist_azimuth(sed_lat, sed_lon, event_lat, event_lon)[0]
-            print(f"Distance between the event and the station {sed_station_name}: {distance/1000:.1f} km")
+            distance = geodesics(sed_lat, sed_lon, event_lat, event_lon)[0]
+            output.print(f"Distance between the event and the station {sed_station_name}: {distance:.1f} km")
 
-            # Predict the P and S arrivals
-            p_phases = ['p', 'Pg', 'Pn' , 'PmP', 'P', 'PP', 'Pdiff']
-            s_phases = ['s', 'Sg', 'Sn' , 'SmS', 'S', 'SS', 'Sdiff']
-
-            P_arrival = predict_arrivals(
-                sed_lon, sed_lat, event_lon, event_lat, depth_in_km, config.p_phases)
-            S_arrival = predict_arrivals(
-                sed_lon, sed_lat, event_lon, event_lat, depth_in_km, config.s_phases)
-            
-            P_arrival.sort(key=lambda x: x.time)
-            S_arrival.sort(key=lambda x: x.time)
+            # Predict the first arriving P and S phases from the travel-time table
+            P_arrival = predict_first_arrival(
+                sed_lon, sed_lat, event_lon, event_lat, depth_in_km, 'P')
+            S_arrival = predict_first_arrival(
+                sed_lon, sed_lat, event_lon, event_lat, depth_in_km, 'S')
             
-            if P_arrival is not None and len(P_arrival) > 0:
-                print(f"{P_arrival[0].name} arrival at {sed_station_name}: {origin_time + P_arrival[0].time}")
-                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + P_arrival[0].time, 
-                           color='tab:red', phase_name=P_arrival[0].name)
+            if P_arrival is not None:
+                output.print(f"{P_arrival[0]} arrival at {sed_station_name}: {origin_time + P_arrival[1]}")
+                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + P_arrival[1], 
+                           color='tab:red', phase_name=P_arrival[0])
             
             else:
-                print(f"P arrival at {sed_station_name}: No prediction available")
+                output.print(f"P arrival at {sed_station_name}: No prediction available")
 
-            if S_arrival is not None and len(S_arrival) > 0:
-                print(f"{S_arrival[0].name} arrival at {sed_station_name}: {origin_time + S_arrival[0].time}")
-                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + S_arrival[0].time, 
-                           color="tab:blue", phase_name=S_arrival[0].name)
+            if S_arrival is not None:
+                output.print(f"{S_arrival[0]} arrival at {sed_station_name}: {origin_time + S_arrival[1]}")
+                plot_phase(axes=[axZ, axN, axE], phase_time=origin_time + S_arrival[1], 
+                           color="tab:blue", phase_name=S_arrival[0])
             else:
-                print(f"S arrival at {sed_station_name}: No prediction available")
+                output.print(f"S arrival at {sed_station_name}: No prediction available")
 
             # Set the x-limit to the time window
             axZ.set_xlim(origin_time + timewindow_start, origin_time + timewindow_end)
 
-            plt.savefig(f"CH.{sed_station_name}_seismogram.png", dpi=200, bbox_inches='tight')
-            plt.show()
+            with span("savefig", station=sed_station_name):
+                output.show(fig, f"CH.{sed_station_name}_seismogram.png", dpi=config.plot_dpi,
+                            bbox_inches='tight')
 
         else:
-            print(f"No data available for station {sed_station_name} at Swiss network")
+            output.print(f"No data available for station {sed_station_name} at Swiss network")
                     
         
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight coordination of the web service requests across processes,
+e.g. the kernels of all students on a JupyterHub sharing one cache
+directory (config.cache_dir). The first process that requests a key
+fetches it while holding a lock file of the key; the others wait for the
+lock and then reuse the result instead of sending the same request. The
+results are exchanged as small JSON files that expire after
+config.single_flight_ttl seconds; the data itself stays in the regular
+caches or in data files next to the result (see data_path), in inert
+formats such as miniSEED, StationXML and QuakeML. A failed fetch is passed
+on only to the requests that waited for it, as an exception of the same
+type (FDSN exceptions) or as SharedFetchError. Expired results, data and
+lock files are removed every config.single_flight_prune_interval seconds.
+
+The locks are fcntl.flock locks, released by the operating system when a
+process dies. Without fcntl (Windows) they only coordinate the threads of
+one process.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from obspy.clients.fdsn import header
+from codebase import config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Exception types re-raised by the waiting requests, all others are
+# raised as SharedFetchError
+_error_types = {name: cls for name, cls in vars(header).items()
+                if isinstance(cls, type) and issubclass(cls, header.FDSNException)}
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(path):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(path, threading.Lock())
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=None):
+    """
+    Hold an exclusive lock on the lock file at path, shared by processes
+    and threads. Yields True if the lock was free at once and False if it
+    had to be waited for. If it is still taken after timeout seconds,
+    yields None and the block runs without the lock.
+    """
+    if fcntl is None:
+        lock = _thread_lock(path)
+        immediate = lock.acquire(blocking=False)
+        acquired = immediate or lock.acquire(timeout=-1 if timeout is None else timeout)
+        try:
+            yield (immediate if acquired else None)
+        finally:
+            if acquired:
+                lock.release()
+        return
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        attempts, acquired = 0, False
+        while True:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+                break
+            except BlockingIOError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                attempts += 1
+                time.sleep(0.02)
+        try:
+            yield (attempts == 0 if acquired else None)
+        finally:
+            if acquired:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class SharedFetchError(Exception):
+    """ Failed fetch of another request, with the type name of its exception """
+    def __init__(self, type_name, message):
+        super().__init__(f"{type_name}: {message}")
+        self.type_name = type_name
+
+
+def _error(outcome):
+    """ Return the exception of a failed outcome """
+    error = outcome["error"]
+    if error["type"] in _error_types:
+        return _error_types[error["type"]](error["message"])
+    return SharedFetchError(error["type"], error["message"])
+
+
+def _remove_unlocked(lock_path):
+    """ Remove a lock file if no process holds it; returns True if removed """
+    if fcntl is None:
+        with contextlib.suppress(OSError):
+            os.remove(lock_path)
+        return True
+    try:
+        with open(lock_path, "a") as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            with contextlib.suppress(OSError):
+                os.remove(lock_path)
+    except OSError:
+        pass
+    return True
+
+
+class SingleFlight:
+    """
+    Coalesces identical requests of all processes sharing the directory.
+    The hits, waits and fetches of this process are counted, and written
+    to the directory so that statistics(shared=True) sums all processes.
+    """
+    def __init__(self, directory, ttl, timeout):
+        self.directory = directory
+        self.ttl = ttl
+        self.timeout = timeout
+        self.hits = 0      # fresh result of an earlier fetch reused
+        self.waits = 0     # waited for the fetch of another request
+        self.fetches = 0   # requests sent to the server
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest()[:20])
+
+    def data_path(self, key, extension):
+        """
+        Return the path of a data file of the key (e.g. ".xml"), written by
+        the fetch and read by the waiting requests. It expires with the
+        result of the key.
+        """
+        return self._path(key) + ".data" + extension
+
+    def _read(self, path):
+        """ Return the outcome of the last fetch of the key or None """
+        try:
+            with open(path + ".json") as f:
+                outcome = json.load(f)
+            if not isinstance(outcome.get("time"), (int, float)):
+                return None
+            return outcome
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _write(self, path, outcome):
+        tmp_file = path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_file, "w") as f:
+                json.dump(outcome, f)
+            os.replace(tmp_file, path + ".json")
+        except (OSError, TypeError, ValueError):
+            # Results that are not JSON are not shared
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+
+    def prune(self, max_age=None):
+        """
+        Remove the results, data and lock files of the keys that were last
+        written more than max_age seconds ago (default: the time-to-live
+        plus the timeout, so that no request still waits for them). Lock
+        files held by a process are kept.
+        """
+        if max_age is None:
+            max_age = self.ttl + self.timeout
+        self._pruned_at = time.time()
+        if not os.path.isdir(self.directory):
+            return
+        groups = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                with contextlib.suppress(OSError):
+                    groups.setdefault(entry.name.split(".")[0], []).append(
+                        (entry.path, entry.stat().st_mtime))
+        cutoff = time.time() - max_age
+        for files in groups.values():
+            if max(mtime for _, mtime in files) > cutoff:
+                continue
+            lock_path = next((path for path, _ in files if path.endswith(".lock")), None)
+            if lock_path is not None and not _remove_unlocked(lock_path):
+                continue
+            for path, _ in files:
+                if path != lock_path:
+                    with contextlib.suppress(OSError):
+                        os.remove(path)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            counters = {"hits": self.hits, "waits": self.waits, "fetches": self.fetches}
+        directory = os.path.join(self.directory, "counters")
+        filename = os.path.join(directory, f"{socket.gethostname()}_{os.getpid()}.json")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(filename + ".tmp", "w") as f:
+                json.dump(counters, f)
+            os.replace(filename + ".tmp", filename)
+        except OSError:
+            pass
+
+    def run(self, key, fetch):
+        """
+        Return the result of fetch() for the key: a fresh result of another
+        request, the result of a concurrent request after waiting for it,
+        or fetched by this request. The result must be JSON serializable to
+        be shared. Exceptions of the fetch are raised for all requests that
+        waited for it.
+        """
+        if not config.use_single_flight:
+            return fetch()
+        if time.time() - self._pruned_at > config.single_flight_prune_interval:
+            self.prune()
+        path = self._path(key)
+        outcome = self._read(path)
+        if outcome is not None and outcome["error"] is None and \
+                time.time() - outcome["time"] <= self.ttl:
+            self._count("hits")
+            return outcome["value"]
+
+        requested = time.time()
+        with file_lock(path + ".lock", self.timeout) as immediate:
+            outcome = self._read(path)
+            if outcome is not None and outcome["time"] >= requested:
+                # Fetched by another request while this one waited
+                self._count("waits" if immediate is False else "hits")
+                if outcome["error"] is not None:
+                    raise _error(outcome)
+                return outcome["value"]
+            if outcome is not None and outcome["error"] is None and \
+                    time.time() - outcome["time"] <= self.ttl:
+                self._count("hits")
+                return outcome["value"]
+
+            self._count("fetches")
+            try:
+                value = fetch()
+            except Exception as e:
+                self._write(path, {"time": time.time(), "value": None,
+                                   "error": {"type": type(e).__name__, "message": str(e)}})
+                raise
+            self._write(path, {"time": time.time(), "value": value, "error": None})
+            return value
+
+    def statistics(self, shared=False):
+        """
+        Return the hit/wait/fetch counters of this process, or summed over
+        all processes that used the directory with shared=True
+        """
+        if not shared:
+            with self._lock:
+                return {"hits": self.hits, "waits": self.waits, "fetches": self.fetches}
+        totals = {"hits": 0, "waits": 0, "fetches": 0, "processes": 0}
+        directory = os.path.join(self.directory, "counters")
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    counters = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for counter in ("hits", "waits", "fetches"):
+                totals[counter] += counters.get(counter, 0)
+            totals["processes"] += 1
+        return totals
+
+    def clear(self):
+        """ Remove the shared results, data, counters and unused lock files """
+        self.prune(max_age=-1)
+        directory = os.path.join(self.directory, "counters")
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(directory, name))
+        with self._lock:
+            self.hits = self.waits = self.fetches = 0
+
+
+# Coordination shared by all modules
+single_flight = SingleFlight(config.single_flight_dir, config.single_flight_ttl,
+                             config.single_flight_timeout)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory index of the station inventory. It is built once per inventory
+load and replaces the repeated Inventory.select scans of the GUI getters
+with dictionary lookups. Per network, the station coordinates are kept in
+contiguous NumPy arrays, and the responses of all channels and epochs are
+kept per SEED id so they can be attached to downloaded streams without
+another station request. The responses of channels loaded without them
+(from the inventory cache) are read per station on first use.
+"""
+import copy
+import threading
+import numpy as np
+from obspy import Inventory
+from codebase import config
+
+
+class StationIndex:
+    """ Lookups of stations by code and network, coordinate arrays and responses """
+    def __init__(self, inventory=None, full_inventory=None, rs_sta_list=None,
+                 load_responses=None):
+        self.inventory = inventory if inventory is not None else Inventory()
+        self._station_inventories = {}
+        self._network_inventories = {}
+        self.stations = {}
+        self.network_of = {}
+        self.codes = {}
+        self.latitudes = {}
+        self.longitudes = {}
+        self.elevations = {}
+        self._responses = {}
+        self._load_responses = load_responses
+        self._pending = set()
+        self._lock = threading.Lock()
+
+        # RaspberryShake code -> closest SED station code
+        self.sed_stations = {station[0]: station[2]
+                             for station in (rs_sta_list or config.rs_sta_list)}
+
+        for network in self.inventory:
+            codes = self.codes.setdefault(network.code, [])
+            for station in network:
+                self.stations[station.code] = station
+                self.network_of[station.code] = network.code
+                codes.append(station.code)
+
+                # Inventory with only this station, as Inventory.select(station=code)
+                station_network = copy.copy(network)
+                station_network.stations = [station]
+                self._station_inventories.setdefault(station.code, Inventory(
+                    networks=[], source=self.inventory.source)).networks.append(station_network)
+
+        for network_code, codes in self.codes.items():
+            stations = [self.stations[code] for code in codes]
+            self.latitudes[network_code] = np.array([sta.latitude for sta in stations], dtype=float)
+            self.longitudes[network_code] = np.array([sta.longitude for sta in stations], dtype=float)
+            self.elevations[network_code] = np.array([sta.elevation for sta in stations], dtype=float)
+            self._network_inventories[network_code] = Inventory(
+                networks=[network for network in self.inventory if network.code == network_code],
+                source=self.inventory.source)
+
+        # Responses of all channels and epochs. The responses of stations
+        # without any are loaded with load_responses(network, station) on first use.
+        full_inventory = full_inventory if full_inventory is not None else self.inventory
+        self._add_responses(full_inventory)
+        if load_responses is not None:
+            self._pending = {(network.code, station.code) for network in full_inventory
+                             for station in network
+                             if all(channel.response is None for channel in station)}
+
+    def _add_responses(self, inventory):
+        for network in inventory:
+            for station in network:
+                for channel in station:
+                    if channel.response is None:
+                        continue
+                    seed_id = f"{network.code}.{station.code}.{channel.location_code}.{channel.code}"
+                    self._responses.setdefault(seed_id, []).append(
+                        (channel.start_date, channel.end_date, channel.response))
+
+    def _load_station_responses(self, network, station):
+        with self._lock:
+            if (network, station) not in self._pending:
+                return
+            inventory = self._load_responses(network, station)
+            if inventory is not None:
+                self._add_responses(inventory)
+            self._pending.discard((network, station))
+
+    def station_inventory(self, sta_code):
+        """ Return the inventory with only the given station (may be empty) """
+        return self._station_inventories.get(sta_code, Inventory(networks=[], source=""))
+
+    def network_inventory(self, network):
+        """ Return the inventory with only the given network (may be empty) """
+        return self._network_inventories.get(network, Inventory(networks=[], source=""))
+
+    def sed_station(self, rs_code):
+        """ Return the SED station closest to the given RaspberryShake station """
+        return self.sed_stations.get(rs_code)
+
+    def _response_entry(self, seed_id, time):
+        if self._pending:
+            self._load_station_responses(*seed_id.split(".")[:2])
+        for start, end, response in self._responses.get(seed_id, []):
+            if (start is None or start <= time) and (end is None or end >= time):
+                return start, end, response
+        return None, None, None
+
+    def response(self, seed_id, time):
+        """ Return the response of the channel at the given time or None """
+        return self._response_entry(seed_id, time)[2]
+
+    def response_epoch(self, seed_id, time):
+        """ Return the start of the channel epoch at the given time or None """
+        start, _, response = self._response_entry(seed_id, time)
+        return start if response is not None else None
+
+    def attach_responses(self, stream):
+        """
+        Attach the responses from the index to all traces of the stream.
+        Returns True if every trace got a response.
+        """
+        complete = True
+        for tr in stream:
+            response = self.response(tr.id, tr.stats.starttime)
+            if response is None:
+                complete = False
+            else:
+                tr.stats.response = response
+        return complete
+
+
+# The index of the latest inventory load
+_current_index = StationIndex()
+
+
+def get_station_index():
+    """ Return the index of the latest inventory load """
+    return _current_index
+
+
+def set_station_index(index):
+    """ Make the given index the one used by all modules """
+    global _current_index
+    _current_index = index
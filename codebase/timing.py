@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Timing instrumentation of the queries and plots. The stages are wrapped in
+named spans, optionally with arguments such as the station code:
+
+    with span("download", station="GBERN"):
+        ...
+
+The spans are only recorded while config.use_timing is set; otherwise
+span() returns a shared no-op context manager, so the instrumentation
+costs one attribute lookup per stage. The entry points (query_stations,
+fetch_catalog and the plot functions) are decorated with profiled: each
+call starts a new recording and afterwards shows a summary table per
+stage and writes the spans as JSON and as Chrome trace (chrome://tracing
+or https://ui.perfetto.dev) to config.timing_dir.
+
+The recording and the stack of open spans are kept per thread, so that a
+background plot and a query recorded at the same time stay separate. Work
+handed to a pool is added to the recording of the submitting thread by
+wrapping the function with propagate().
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from codebase import config
+from codebase.plotutils import PlotOutput
+
+_no_span = contextlib.nullcontext()
+
+# Recording and stack of the open spans of the current thread
+_local = threading.local()
+
+
+def _stack():
+    return _local.__dict__.setdefault("stack", [])
+
+
+class Tracer:
+    """ Recorder of the spans of one recording, from all threads taking part """
+    def __init__(self, name=None):
+        self.spans = []
+        self.name = name
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def clear(self, name=None):
+        """ Forget the recorded spans and start a new recording """
+        with self._lock:
+            self.spans = []
+            self.name = name
+            self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """ Record the wall and CPU time of the block as a span """
+        stack = _stack()
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            end, cpu = time.perf_counter(), time.thread_time() - cpu
+            stack.pop()
+            thread = threading.current_thread()
+            with self._lock:
+                self.spans.append({
+                    "name": name, "parent": parent, "depth": len(stack),
+                    "start": start - self._origin, "duration": end - start, "cpu": cpu,
+                    "thread": thread.ident, "thread_name": thread.name, "args": args})
+
+    def summary(self):
+        """
+        Return the statistics per span name, in the order of the first
+        start: calls, total, mean and maximum wall time, and total CPU time.
+        """
+        stages = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        for span in spans:
+            stage = stages.setdefault(span["name"], {
+                "name": span["name"], "depth": span["depth"], "calls": 0,
+                "total": 0.0, "max": 0.0, "cpu": 0.0})
+            stage["calls"] += 1
+            stage["total"] += span["duration"]
+            stage["max"] = max(stage["max"], span["duration"])
+            stage["cpu"] += span["cpu"]
+        for stage in stages.values():
+            stage["mean"] = stage["total"] / stage["calls"]
+        return list(stages.values())
+
+    def format_summary(self):
+        """ Return the summary as text table, indented by the nesting of the stages """
+        lines = [f"{'stage':32s} {'calls':>6s} {'total':>9s} {'mean':>9s} {'max':>9s} {'cpu':>9s}"]
+        for stage in self.summary():
+            name = "  " * stage["depth"] + stage["name"]
+            lines.append(f"{name[:32]:32s} {stage['calls']:6d} {stage['total']:8.3f}s "
+                         f"{stage['mean']:8.3f}s {stage['max']:8.3f}s {stage['cpu']:8.3f}s")
+        return "\n".join(lines)
+
+    def export_json(self, filename):
+        """ Write the spans and the summary as JSON """
+        with self._lock:
+            spans = list(self.spans)
+        _write_json(filename, {"name": self.name, "spans": spans, "summary": self.summary()})
+
+    def export_chrome_trace(self, filename):
+        """ Write the spans in the Chrome trace event format """
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = [{"name": span["name"], "ph": "X", "pid": pid, "tid": span["thread"],
+                   "ts": span["start"] * 1e6, "dur": span["duration"] * 1e6,
+                   "args": {key: str(value) for key, value in span["args"].items()}}
+                  for span in spans]
+        events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread,
+                    "args": {"name": name}}
+                   for thread, name in {(span["thread"], span["thread_name"]) for span in spans}]
+        _write_json(filename, {"traceEvents": events, "displayTimeUnit": "ms"})
+
+
+def _write_json(filename, data):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp_file = filename + f".{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, filename)
+
+
+# Recorder of the spans outside of the profiled entry points
+tracer = Tracer()
+
+
+def current_tracer():
+    """ Return the recording of the current thread (or the shared tracer) """
+    return getattr(_local, "tracer", None) or tracer
+
+
+def span(name, **args):
+    """ Context manager timing a stage, a no-op unless config.use_timing """
+    if not config.use_timing:
+        return _no_span
+    return current_tracer().span(name, **args)
+
+
+def propagate(func):
+    """
+    Wrap func, to be run on a worker thread, so that its spans are added to
+    the recording of the calling thread below the current span
+    """
+    recording = getattr(_local, "tracer", None)
+    if not config.use_timing or recording is None:
+        return func
+    stack = list(_stack())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "tracer", None), _stack()
+        _local.tracer, _local.stack = recording, list(stack)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.tracer, _local.stack = previous
+    return wrapper
+
+
+def report(name, output=None, recording=None):
+    """
+    Show the summary of the recording through PlotOutput (in the output
+    widget if given) and write it to <timing_dir>/timing_<name>.json and
+    .trace.json
+    """
+    recording = recording or tracer
+    output = PlotOutput(output)
+    output.print(f"Timing of {name}:\n{recording.format_summary()}\n")
+    directory = config.timing_dir or os.getcwd()
+    try:
+        recording.export_json(os.path.join(directory, f"timing_{name}.json"))
+        recording.export_chrome_trace(os.path.join(directory, f"timing_{name}.trace.json"))
+    except OSError as e:
+        output.print(f"The timing of {name} could not be written: {e}")
+
+
+def profiled(name, output=None):
+    """
+    Decorator for the entry points: the call is recorded as the top-level
+    span of a new recording and reported at the end. output is the name of
+    the output widget attribute of the first argument (the RaspberryShake)
+    for the summary. Calls from within a recording are plain spans.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not config.use_timing:
+                return func(*args, **kwargs)
+            if getattr(_local, "tracer", None) is not None:
+                # Called within a recording of this thread
+                with _local.tracer.span(name):
+                    return func(*args, **kwargs)
+            recording = _local.tracer = Tracer(name)
+            try:
+                with recording.span(name):
+                    return func(*args, **kwargs)
+            finally:
+                _local.tracer = None
+                report(name, getattr(args[0], output, None) if output and args else None,
+                       recording)
+        return wrapper
+    return decorator
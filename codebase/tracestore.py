@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped store of the processed sample arrays of a section plot. The
+processed traces of all stations are copied into one contiguous np.memmap
+block, and the traces keep a view of their part of it: only the
+metadata (stats) stays on the Python heap, the samples are paged in by
+the operating system while the figure is drawn and can be dropped from
+memory again under pressure. The file is removed as soon as it is mapped
+(or when the store is closed, where an open file cannot be removed).
+"""
+import os
+import tempfile
+import numpy as np
+from codebase import config
+
+
+class TraceStore:
+    """ Contiguous memory-mapped block for the samples of up to capacity values """
+    def __init__(self, capacity, dtype=np.float64, directory=None):
+        directory = directory or config.trace_store_dir
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd, self.filename = tempfile.mkstemp(prefix="section_", suffix=".dat", dir=directory)
+        os.close(fd)
+        self.block = np.memmap(self.filename, dtype=dtype, mode="w+", shape=(max(1, capacity),))
+        self.used = 0
+        try:
+            os.remove(self.filename)
+            self.filename = None
+        except OSError:
+            pass
+
+    @property
+    def nbytes(self):
+        """ Bytes of the stored samples """
+        return self.used * self.block.itemsize
+
+    def put(self, data):
+        """ Copy the samples into the block and return the view of them """
+        end = self.used + len(data)
+        if end > len(self.block):
+            raise ValueError("Trace store is full")
+        view = self.block[self.used:end]
+        view[:] = data
+        self.used = end
+        return view
+
+    def close(self):
+        """ Forget the block; the views of the traces stay valid until released """
+        self.block = None
+        if self.filename is not None:
+            try:
+                os.remove(self.filename)
+                self.filename = None
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
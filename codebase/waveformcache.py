@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache for the waveforms downloaded by get_waveforms.
+Every window is stored as raw miniSEED together with the responses that
+were attached to the traces (as StationXML). A cached window is reused for
+any request it fully covers, also for a part of its channels (e.g. EHZ
+from an EH* window), and the least recently used windows are evicted once
+the cache exceeds its size limit. The cache directory can be shared by several
+processes: the index is changed under a lock file and reloaded whenever
+another process has written it.
+"""
+import fnmatch
+import json
+import os
+import threading
+import time
+from obspy import read, read_inventory, UTCDateTime
+from obspy.core.inventory import Channel, Inventory, Network, Station
+from codebase import config
+from codebase.singleflight import file_lock
+
+
+def _response_inventory(stream):
+    """ Return an inventory with the responses attached to the traces """
+    stations = {}
+    for tr in stream:
+        if "response" not in tr.stats:
+            continue
+        station = stations.get((tr.stats.network, tr.stats.station))
+        if station is None:
+            station = stations[(tr.stats.network, tr.stats.station)] = \
+                Station(tr.stats.station, 0, 0, 0)
+        if not any(cha.location_code == tr.stats.location and cha.code == tr.stats.channel
+                   for cha in station.channels):
+            station.channels.append(Channel(tr.stats.channel, tr.stats.location, 0, 0, 0, 0,
+                                            response=tr.stats.response))
+    networks = {}
+    for (network, _), station in stations.items():
+        networks.setdefault(network, Network(network)).stations.append(station)
+    return Inventory(networks=list(networks.values()), source="")
+
+
+def _covers_channels(cached, requested):
+    """ Return True if the cached channel pattern includes all requested channels """
+    return cached == requested or all(
+        any(fnmatch.fnmatchcase(pattern, cached_pattern) for cached_pattern in cached.split(","))
+        for pattern in requested.split(","))
+
+
+class WaveformCache:
+    """
+    Size-bounded LRU cache of waveform windows, keyed by network, station,
+    channel and time window.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._index = None
+        self._index_stat = None
+        self._accessed = {}
+        self._flushed = time.time()
+
+    # Index handling
+    @property
+    def _index_file(self):
+        return os.path.join(self.directory, "index.json")
+
+    @property
+    def _lock_file(self):
+        return os.path.join(self.directory, "index.lock")
+
+    def _stat_index(self):
+        try:
+            stat = os.stat(self._index_file)
+            return stat.st_mtime_ns, stat.st_size, stat.st_ino
+        except OSError:
+            return None
+
+    def _load_index(self):
+        """ Load the index of the cached windows from disk if it changed """
+        stat = self._stat_index()
+        if self._index is not None and stat == self._index_stat:
+            return self._index
+        self._index = {}
+        self._index_stat = stat
+        try:
+            with open(self._index_file) as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            pass
+        # Drop the entries whose files have disappeared
+        for name in list(self._index):
+            if not os.path.exists(os.path.join(self.directory, name)):
+                del self._index[name]
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_file = self._index_file + f".{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_file, self._index_file)
+        self._index_stat = self._stat_index()
+
+    def _remove(self, name):
+        del self._index[name]
+        # .resp files are left over from older versions of the cache
+        for filename in (name, name + ".resp.xml", name + ".resp"):
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+
+    def _touch(self, name):
+        """
+        Note the access of a window. The access times are written to the index
+        in batches (with the next put or every waveform_cache_access_interval
+        seconds), so that the cache hits of the processes sharing the cache
+        need not take the lock and rewrite the index.
+        """
+        now = time.time()
+        self._accessed[name] = now
+        if now - self._flushed >= config.waveform_cache_access_interval:
+            with file_lock(self._lock_file):
+                self._load_index()
+                self._flush_accessed()
+                self._save_index()
+
+    def _flush_accessed(self):
+        """ Merge the pending access times into the loaded index """
+        for name, accessed in self._accessed.items():
+            entry = self._index.get(name)
+            if entry is not None:
+                entry["last_access"] = max(entry["last_access"], accessed)
+        self._accessed.clear()
+        self._flushed = time.time()
+
+    # Public interface
+    def get(self, network, station, channel, starttime, endtime):
+        """
+        Return the cached stream for the given window, trimmed to the window
+        and with the responses attached. Return None if no cached window
+        covers the request.
+        """
+        # The index and the files are replaced atomically, so they are read
+        # without the lock of the other processes, and the files without
+        # the lock of the other threads
+        with self._lock:
+            index = self._load_index()
+            for name, entry in index.items():
+                if (entry["network"], entry["station"]) != (network, station) or \
+                        not _covers_channels(entry["channel"], channel):
+                    continue
+                if UTCDateTime(entry["starttime"]) <= starttime and \
+                        UTCDateTime(entry["endtime"]) >= endtime:
+                    break
+            else:
+                self.misses += 1
+                return None
+
+        try:
+            stream = read(os.path.join(self.directory, name), format="MSEED")
+            responses = read_inventory(os.path.join(self.directory, name + ".resp.xml"),
+                                       format="STATIONXML")
+        except Exception:
+            # Corrupt, partially written or just evicted entry
+            with self._lock, file_lock(self._lock_file):
+                if name in self._load_index():
+                    self._remove(name)
+                    self._save_index()
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self._touch(name)
+            self.hits += 1
+
+        stream.trim(starttime, endtime)
+        patterns = channel.split(",")
+        stream.traces = [tr for tr in stream if any(
+            fnmatch.fnmatchcase(tr.stats.channel, pattern) for pattern in patterns)]
+        for tr in stream:
+            try:
+                tr.stats.response = responses.get_response(tr.id, tr.stats.starttime)
+            except Exception:
+                pass
+        return stream
+
+    def put(self, network, station, channel, starttime, endtime, stream):
+        """ Store the downloaded stream of the given window """
+        if stream is None or len(stream) == 0:
+            return
+        name = f"{network}.{station}.{channel.replace('*', '_')}." \
+               f"{starttime.strftime('%Y%m%dT%H%M%S')}_{endtime.strftime('%Y%m%dT%H%M%S')}.mseed"
+        responses = _response_inventory(stream)
+
+        with self._lock, file_lock(self._lock_file):
+            index = self._load_index()
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, name)
+            tmp_suffix = f".{os.getpid()}.tmp"
+            stream.write(path + tmp_suffix, format="MSEED")
+            responses.write(path + ".resp.xml" + tmp_suffix, format="STATIONXML")
+            os.replace(path + ".resp.xml" + tmp_suffix, path + ".resp.xml")
+            os.replace(path + tmp_suffix, path)
+
+            index[name] = {
+                "network": network, "station": station, "channel": channel,
+                "starttime": str(starttime), "endtime": str(endtime),
+                "size": os.path.getsize(path) + os.path.getsize(path + ".resp.xml"),
+                "last_access": time.time()}
+            self._flush_accessed()
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        """ Remove the least recently used windows until the size limit is met """
+        total = sum(entry["size"] for entry in self._index.values())
+        for name in sorted(self._index, key=lambda n: self._index[n]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[name]["size"]
+            self._remove(name)
+
+    def clear(self):
+        """ Remove all cached windows """
+        with self._lock, file_lock(self._lock_file):
+            self._load_index()
+            for name in list(self._index):
+                self._remove(name)
+            self._save_index()
+
+    def statistics(self):
+        """ Return the hit/miss counters and the current size of the cache """
+        with self._lock:
+            index = self._load_index()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(index),
+                "size": sum(entry["size"] for entry in index.values()),
+                "max_size": self.max_bytes}
+
+
+# Cache instance shared by all plots
+waveform_cache = WaveformCache(config.waveform_cache_dir, config.waveform_cache_size)
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+Sources of the waveforms used by get_waveforms and the bulk downloads. A
+source is either a local SDS archive of miniSEED day files or an FDSN
+dataselect service; config.waveform_sources lists them in the order in
+which they are tried, so a local archive can be used with the remote
+service as a fallback for the stations and days it does not contain.
+
+The SDS archive locates the day files by the path convention
+<root>/<year>/<net>/<sta>/<cha>.D/<net>.<sta>.<loc>.<cha>.D.<year>.<doy>,
+memory-maps them, scans the fixed headers of the records and decodes only
+the records that overlap the requested window. All sources return the
+traces with the responses attached, and can tell which stations have data
+in a window before it is downloaded (available_stations).
+"""
+import glob
+import io
+import mmap
+import os
+import struct
+import threading
+import time
+import numpy as np
+from obspy import Stream, UTCDateTime, read, read_inventory
+from obspy.clients.fdsn.header import FDSNNoDataException
+from codebase import config
+from codebase.clients import get_client, request
+from codebase.stationindex import StationIndex, get_station_index
+from codebase.timing import span
+
+
+class SDSArchive:
+    """ Waveforms of a local SDS (SeisComP Data Structure) miniSEED archive """
+    remote = False
+
+    def __init__(self, root, inventory=None):
+        self.root = root
+        self.inventory = inventory
+        self._index = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"SDSArchive({self.root!r})"
+
+    def _station_index(self):
+        """ Index of the responses: the archive's StationXML or the GUI inventory """
+        if self.inventory is None:
+            return get_station_index()
+        with self._lock:
+            if self._index is None:
+                inventory = read_inventory(self.inventory)
+                self._index = StationIndex(inventory, rs_sta_list=[])
+            return self._index
+
+    def day_files(self, network, station, location, channel, starttime, endtime):
+        """
+        Return the day files that can contain data of the window. Location
+        and channel may be comma separated lists of patterns as used for the
+        FDSN requests ('--' is the empty location code). The day before the
+        window is included, as its last records may reach past midnight.
+        """
+        locations = ["" if loc == "--" else loc for loc in location.split(",")]
+        channels = channel.split(",")
+        first_day = int(UTCDateTime(starttime).timestamp // 86400) - 1
+        last_day = int(UTCDateTime(endtime).timestamp // 86400)
+        filenames = []
+        for day in range(first_day, last_day + 1):
+            date = time.gmtime(day * 86400)
+            year, doy = date.tm_year, date.tm_yday
+            for cha in channels:
+                for loc in locations:
+                    pattern = os.path.join(
+                        self.root, str(year), network, station, f"{cha}.D",
+                        f"{network}.{station}.{loc}.{cha}.D.{year}.{doy:03d}")
+                    filenames.extend(sorted(glob.glob(pattern)))
+        return list(dict.fromkeys(filenames))
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime,
+                      timeout=None):
+        """ Read the window from the archive; raises FDSNNoDataException without data """
+        starttime, endtime = UTCDateTime(starttime), UTCDateTime(endtime)
+        with span("sds_read", station=station):
+            data = b"".join(
+                record for filename in self.day_files(network, station, location, channel,
+                                                      starttime, endtime)
+                for record in read_records(filename, starttime.timestamp, endtime.timestamp))
+            stream = read(io.BytesIO(data), format="MSEED") if data else Stream()
+            stream.trim(starttime, endtime)
+        stream.traces = [tr for tr in stream if tr.stats.npts > 0]
+        if len(stream) == 0:
+            raise FDSNNoDataException(f"No data in {self.root}")
+        if not self._station_index().attach_responses(stream):
+            raise FDSNNoDataException(f"No response for the data in {self.root}")
+        return stream
+
+    def get_waveforms_bulk(self, bulk, timeout=None):
+        """ Read all windows of the bulk list; windows without data are left out """
+        stream = Stream()
+        for network, station, location, channel, starttime, endtime in bulk:
+            try:
+                stream += self.get_waveforms(network, station, location, channel,
+                                             starttime, endtime)
+            except FDSNNoDataException:
+                pass
+        return stream
+
+    def available_stations(self, network, stations, location, channel, starttime, endtime,
+                           timeout=None):
+        """ Return the stations with day files for the window """
+        return {station for station in stations
+                if self.day_files(network, station, location, channel, starttime, endtime)}
+
+
+class FDSNSource:
+    """ Waveforms of an FDSN dataselect service (a key of config.fdsn_servers) """
+    remote = True
+
+    def __init__(self, server):
+        self.server = server
+
+    def __repr__(self):
+        return f"FDSNSource({self.server!r})"
+
+    def _client(self, timeout):
+        # The shared client discovers the services of the server on first use
+        with span("client", server=self.server):
+            return get_client(self.server, timeout)
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime,
+                      timeout=None):
+        """ Download the window; the responses come from the station index if possible """
+        client = self._client(timeout)
+        with span("dataselect", station=station):
+            stream = client.get_waveforms(network=network, station=station, location=location,
+                                          channel=channel, starttime=starttime, endtime=endtime)
+        # Responses from the station index, otherwise with one station request
+        with span("responses", station=station):
+            if not get_station_index().attach_responses(stream):
+                stream.attach_response(client.get_stations(
+                    network=network, station=station, location=location, channel=channel,
+                    starttime=starttime, endtime=endtime, level="response"))
+        return stream
+
+    def get_waveforms_bulk(self, bulk, timeout=None):
+        """ Download all windows of the bulk list with one dataselect request """
+        # The responses are taken from the station index, or fetched with one
+        # bulk station request. attach_response=True would send one station
+        # request per channel.
+        client = self._client(timeout)
+        try:
+            with span("dataselect", stations=len(bulk)):
+                stream = client.get_waveforms_bulk(bulk)
+        except FDSNNoDataException:
+            return Stream()
+        with span("responses", stations=len(bulk)):
+            if len(stream) > 0 and not get_station_index().attach_responses(stream):
+                stream.attach_response(client.get_stations_bulk(bulk, level="response"))
+        return stream
+
+    def available_stations(self, network, stations, location, channel, starttime, endtime,
+                           timeout=None):
+        """
+        Return the stations with data in the window, with one query to the
+        availability service of the server, or None if the server does not
+        answer it
+        """
+        client = self._client(timeout)
+        query = {"network": network, "station": ",".join(stations), "location": location,
+                 "channel": channel, "starttime": str(UTCDateTime(starttime)),
+                 "endtime": str(UTCDateTime(endtime)), "format": "text",
+                 "merge": "samplerate,quality"}
+        url = f"{client.base_url}/fdsnws/availability/1/query?" + "&".join(
+            f"{key}={value}" for key, value in query.items())
+        with span("availability_query", stations=len(stations)):
+            code, content = request(client.session, url, client.request_headers,
+                                    timeout=client.timeout)
+        if code == 204:
+            return set()
+        if code != 200:
+            return None
+        # One "Network Station Location Channel ... Earliest Latest" line per
+        # channel and time span
+        available = set()
+        for line in content.decode(errors="replace").splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and not line.startswith("#") and fields[0] == network:
+                available.add(fields[1])
+        return available
+
+
+_sources = {}
+
+
+def waveform_sources():
+    """ Return the sources of config.waveform_sources in the order they are tried """
+    key = (tuple(tuple(source) for source in config.waveform_sources), config.sds_inventory)
+    if key not in _sources:
+        sources = []
+        for kind, location in config.waveform_sources:
+            if kind == "sds":
+                sources.append(SDSArchive(location, config.sds_inventory))
+            elif kind == "fdsn":
+                sources.append(FDSNSource(location))
+            else:
+                raise ValueError(f"Unknown waveform source: {kind}")
+        _sources[key] = sources
+    return _sources[key]
+
+
+def get_waveforms(network, station, location, channel, starttime, endtime, timeout=None):
+    """
+    Return the stream of the first source with data for the window and the
+    source itself. Raises FDSNNoDataException if no source has data, or the
+    last error if a source failed otherwise.
+    """
+    error = None
+    for source in waveform_sources():
+        try:
+            stream = source.get_waveforms(network, station, location, channel,
+                                          starttime, endtime, timeout)
+        except FDSNNoDataException:
+            continue
+        except Exception as e:
+            error = e
+            continue
+        if len(stream) > 0:
+            return stream, source
+    raise error or FDSNNoDataException("No data available")
+
+
+def available_stations(network, stations, location, channel, starttime, endtime, timeout=None):
+    """
+    Return the stations that have data in the window in any source, or
+    None if a source cannot tell
+    """
+    available = set()
+    for source in waveform_sources():
+        try:
+            found = source.available_stations(network, stations, location, channel,
+                                              starttime, endtime, timeout)
+        except Exception:
+            found = None
+        if found is None:
+            return None
+        available |= found
+    return available
+
+
+def get_waveforms_bulk(bulk, timeout=None):
+    """
+    Return the streams of the bulk windows from all sources as a list of
+    (stream, source), and whether all sources answered. Each source only
+    gets the stations that the sources before it did not return.
+    """
+    results = []
+    complete = True
+    remaining = list(bulk)
+    for source in waveform_sources():
+        try:
+            stream = source.get_waveforms_bulk(remaining, timeout)
+        except Exception:
+            complete = False
+            continue
+        if len(stream) > 0:
+            results.append((stream, source))
+            found = {(tr.stats.network, tr.stats.station) for tr in stream}
+            remaining = [item for item in remaining if (item[0], item[1]) not in found]
+        if not remaining:
+            break
+    return results, complete
+
+
+# Fixed header of a miniSEED record: sequence number, quality, reserved,
+# station, location, channel, network, start time (BTIME), number of
+# samples, sample rate factor and multiplier, activity, I/O and quality
+# flags, number of blockettes, time correction, begin of data and of the
+# first blockette
+_header_format = "6sc1s5s2s3s2sHHBBBBHHhhBBBBiHH"
+_headers = {">": struct.Struct(">" + _header_format), "<": struct.Struct("<" + _header_format)}
+
+# The same fields as NumPy record type, to read the headers of all records
+# of a file with a fixed record length at once
+_header_fields = [("quality", "S1", 6), ("year", "u2", 20), ("doy", "u2", 22),
+                  ("hour", "u1", 24), ("minute", "u1", 25), ("second", "u1", 26),
+                  ("fraction", "u2", 28), ("npts", "u2", 30), ("factor", "i2", 32),
+                  ("multiplier", "i2", 34), ("first_blockette", "u2", 46)]
+
+
+def _sample_rates(factor, multiplier):
+    """ Sample rates of the SEED factors and multipliers (arrays) """
+    factor = np.asarray(factor, dtype=float)
+    multiplier = np.asarray(multiplier, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(factor > 0,
+                        np.where(multiplier > 0, factor * multiplier, -factor / multiplier),
+                        np.where(multiplier > 0, -multiplier / factor, 1.0 / (factor * multiplier)))
+    return np.where((factor == 0) | (multiplier == 0), 0.0, rate)
+
+
+def _start_times(year, doy, hour, minute, second, fraction):
+    """ Epoch seconds of the BTIME start times (arrays) """
+    year_start = (np.asarray(year, dtype=int) - 1970).astype("datetime64[Y]")
+    return (year_start.astype("datetime64[s]").astype(float)
+            + (np.asarray(doy, dtype=float) - 1) * 86400 + np.asarray(hour) * 3600.0
+            + np.asarray(minute) * 60.0 + np.asarray(second) + np.asarray(fraction) * 1e-4)
+
+
+def _record_length(buffer, offset, byteorder, first_blockette):
+    """ Record length from blockette 1000 of the record at offset, or None """
+    position = first_blockette
+    while 0 < position < 4096 and offset + position + 8 <= len(buffer):
+        blockette, next_blockette = struct.unpack_from(byteorder + "HH", buffer, offset + position)
+        if blockette == 1000:
+            return 2 ** buffer[offset + position + 6]
+        if next_blockette <= position:
+            break
+        position = next_blockette
+    return None
+
+
+def _scan_fixed(buffer, byteorder, length):
+    """
+    Headers of all records for a fixed record length, read as one NumPy
+    record array, or None if not every record has this length.
+    """
+    if len(buffer) % length != 0:
+        return None
+    first_blockette = struct.unpack_from(byteorder + "H", buffer, 46)[0]
+    fields = _header_fields + [("blockette", "u2", first_blockette),
+                               ("exponent", "u1", first_blockette + 6)]
+    dtype = np.dtype({"names": [name for name, _, _ in fields],
+                      "formats": [byteorder + kind for _, kind, _ in fields],
+                      "offsets": [offset for _, _, offset in fields], "itemsize": length})
+    headers = np.frombuffer(buffer, dtype=dtype)
+    if np.any(headers["first_blockette"] != first_blockette) or \
+            np.any(headers["blockette"] != 1000) or \
+            np.any(2 ** headers["exponent"].astype(int) != length):
+        return None
+    # Copies of the fields, as no view may outlive the memory map
+    records = {name: headers[name].copy() for name, _, _ in _header_fields}
+    records["offset"] = np.arange(len(headers)) * length
+    records["length"] = np.full(len(headers), length)
+    return records
+
+
+def _scan_records(buffer, byteorder):
+    """ Headers of all records, read record by record """
+    names = ["offset", "length"] + [name for name, _, _ in _header_fields]
+    rows = []
+    offset = 0
+    while offset + 48 <= len(buffer):
+        header = _headers[byteorder].unpack_from(buffer, offset)
+        length = _record_length(buffer, offset, byteorder, header[-1])
+        if length is None or length < 48:
+            break
+        rows.append((offset, length, header[1]) + header[7:12] + header[13:17] + header[-1:])
+        offset += length
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    return {name: np.array(column) for name, column in zip(names, columns)}
+
+
+def read_records(filename, starttime, endtime):
+    """
+    Return the raw miniSEED records of the file that overlap the window
+    (epoch seconds). Only the headers are read through a memory map; for
+    the usual fixed record length they are read as one NumPy array.
+    """
+    try:
+        f = open(filename, "rb")
+    except OSError:
+        return []
+    with f:
+        if os.fstat(f.fileno()).st_size < 48:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # The year of the start time gives the byte order of the file
+            year = struct.unpack_from(">H", buffer, 20)[0]
+            byteorder = ">" if 1900 <= year <= 2100 else "<"
+            length = _record_length(buffer, 0, byteorder,
+                                    struct.unpack_from(byteorder + "H", buffer, 46)[0])
+            if length is None or length < 48:
+                return []
+            records = _scan_fixed(buffer, byteorder, length)
+            if records is None:
+                records = _scan_records(buffer, byteorder)
+            if len(records["offset"]) == 0:
+                return []
+
+            starts = _start_times(*(records[name] for name in (
+                "year", "doy", "hour", "minute", "second", "fraction")))
+            rates = _sample_rates(records["factor"], records["multiplier"])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ends = starts + np.where(rates > 0, records["npts"] / rates, 0.0)
+            # Data records only, with one second of margin for time corrections
+            data = np.isin(records["quality"], [b"D", b"R", b"Q", b"M"])
+            selected = np.flatnonzero(data & (starts <= endtime + 1.0) & (ends >= starttime - 1.0))
+            return [buffer[records["offset"][i]:records["offset"][i] + records["length"][i]]
+                    for i in selected]